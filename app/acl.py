@@ -0,0 +1,121 @@
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+from app.models import SkillModel, TopicAccess
+
+# acc values that every TopicAccess grants, READWRITE covers both directions
+GRANTS: Dict[int, FrozenSet[int]] = {
+    TopicAccess.READ: frozenset({TopicAccess.READ}),
+    TopicAccess.WRITE: frozenset({TopicAccess.WRITE}),
+    TopicAccess.READWRITE: frozenset(
+        {TopicAccess.READ, TopicAccess.WRITE, TopicAccess.READWRITE}
+    ),
+    TopicAccess.SUBSCRIBE: frozenset({TopicAccess.SUBSCRIBE}),
+    TopicAccess.DENY: frozenset(),
+}
+
+READ_OR_SUBSCRIBE = frozenset({TopicAccess.READ, TopicAccess.SUBSCRIBE})
+
+Rule = Tuple[str, FrozenSet[int]]
+
+
+class _Node:
+    __slots__ = ("children", "single", "multi", "rules")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, "_Node"] = {}
+        # child for the "+" wildcard
+        self.single: Optional["_Node"] = None
+        # rules of a "#" filter ending at this level
+        self.multi: List[Rule] = []
+        # rules of a filter ending exactly at this level
+        self.rules: List[Rule] = []
+
+
+class TopicTrie:
+    """MQTT topic filters compiled into a trie with one node for every topic level.
+
+    Filters can contain the "+" and "#" wildcards, matching a topic is a single walk over its levels.
+    """
+
+    def __init__(self) -> None:
+        self.root = _Node()
+
+    def add(self, topic_filter: str, rule: Rule):
+        node = self.root
+        levels = topic_filter.split("/")
+        for i, level in enumerate(levels):
+            if level == "#" and i == len(levels) - 1:
+                node.multi.append(rule)
+                return
+            if level == "+":
+                if node.single is None:
+                    node.single = _Node()
+                node = node.single
+            else:
+                node = node.children.setdefault(level, _Node())
+        node.rules.append(rule)
+
+    def match(self, topic: str) -> List[Rule]:
+        rules: List[Rule] = []
+        nodes = [self.root]
+        for level in topic.split("/"):
+            next_nodes = []
+            for node in nodes:
+                # "#" also matches the parent level
+                rules.extend(node.multi)
+                child = node.children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+                if node.single is not None:
+                    next_nodes.append(node.single)
+            if not next_nodes:
+                return rules
+            nodes = next_nodes
+        for node in nodes:
+            rules.extend(node.rules)
+            rules.extend(node.multi)
+        return rules
+
+
+def builtin_rules(
+    skill_name: str, intents: Optional[List[str]] = None
+) -> Iterable[Tuple[str, Rule]]:
+    """topics that every skill can access regardless of its topic_access.
+
+    With intents the skill can still subscribe to any intent filter but the broker delivers it
+    only the intents it declares.
+    """
+    if intents is None:
+        yield "hermes/intent/+/#", ("intent", READ_OR_SUBSCRIBE)
+    else:
+        yield "hermes/intent/+/#", ("intent_subscribe", frozenset({TopicAccess.SUBSCRIBE}))
+        for intent in intents:
+            yield f"hermes/intent/{intent}", ("intent", READ_OR_SUBSCRIBE)
+    yield f"hermes/intent/{skill_name}/+/#", ("skill_intent", READ_OR_SUBSCRIBE)
+    yield "hermes/dialogueManager/+/#", ("dialogue", frozenset({TopicAccess.WRITE}))
+
+
+class SkillAcl:
+    """the compiled access rules of a single skill"""
+
+    def __init__(self, skill: SkillModel) -> None:
+        self.skill = skill
+        self.builtin = TopicTrie()
+        for topic_filter, rule in builtin_rules(skill.skill_name, skill.intents):
+            self.builtin.add(topic_filter, rule)
+        self.topic_access = TopicTrie()
+        for topic_filter, access in (skill.topic_access or {}).items():
+            rule_name = "deny" if access == TopicAccess.DENY else "topic_access"
+            self.topic_access.add(topic_filter, (rule_name, GRANTS[access]))
+
+    def check(self, topic: str, acc: int) -> Optional[str]:
+        """return the name of the rule that allows the access or None if it is forbidden"""
+        for name, allowed in self.builtin.match(topic):
+            if acc in allowed:
+                return name
+        matched = self.topic_access.match(topic)
+        if any(name == "deny" for name, _ in matched):
+            return None
+        for name, allowed in matched:
+            if acc in allowed:
+                return name
+        return None
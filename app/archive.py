@@ -0,0 +1,145 @@
+from typing import IO, Dict, List, Optional, Tuple
+import os
+import posixpath
+import secrets
+import tarfile
+
+from fastapi import status
+
+from .routers.exceptions import SkillInstallException
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class UnsafeArchiveError(tarfile.ReadError):
+    """the archive has a member that would be extracted outside of its directory"""
+
+
+def copy_stream(
+    source: IO[bytes],
+    path: str,
+    chunk_size: int = CHUNK_SIZE,
+    max_size: Optional[int] = None,
+):
+    """copy a file object to path in chunks of chunk_size bytes, nothing is left on error
+
+    Raises:
+        SkillInstallException: if the file is bigger than max_size bytes
+    """
+    size = 0
+    try:
+        with open(path, "wb") as f:
+            for chunk in iter(lambda: source.read(chunk_size), b""):
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise SkillInstallException(
+                        status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                        detail=f"the archive is bigger than {max_size} bytes",
+                        error_code="archive_too_large",
+                    )
+                f.write(chunk)
+    except BaseException:
+        if os.path.isfile(path):
+            os.remove(path)
+        raise
+
+
+def temp_path(directory: str, name: str) -> str:
+    """unique path in directory for a file uploaded as name"""
+    return os.path.join(directory, f"{secrets.token_hex(8)}_{os.path.basename(name)}")
+
+
+def split_bundle(path: str, directory: str) -> Optional[List[Tuple[str, str]]]:
+    """extract the skill archives of a bundle, a tar of skill tars, in directory.
+
+    The bundle is removed once its archives are extracted.
+
+    Returns:
+        Optional[List[Tuple[str, str]]]: name and path of the archives or None if path is a
+        skill archive and not a bundle
+
+    Raises:
+        tarfile.ReadError: if the file isn't a valid tar archive
+    """
+    archive = SkillArchive(path)
+    try:
+        if "manifest.json" in archive:
+            return None
+        names = [
+            name
+            for name, member in archive.members.items()
+            if member.isfile() and name.endswith(".tar")
+        ]
+        if not names:
+            return None
+        archives = []
+        for name in names:
+            archive_path = temp_path(directory, name)
+            f = archive.tar.extractfile(archive.members[name])
+            copy_stream(f, archive_path)  # type: ignore
+            archives.append((name, archive_path))
+    finally:
+        archive.close()
+    os.remove(path)
+    return archives
+
+
+def _escapes(path: str) -> bool:
+    return posixpath.isabs(path) or path == ".." or path.startswith("../")
+
+
+def check_member(name: str, member: tarfile.TarInfo):
+    """only regular files, directories and links that stay in the archive can be extracted
+
+    Raises:
+        UnsafeArchiveError: if the member is not one of them
+    """
+    if _escapes(name):
+        raise UnsafeArchiveError(f"{member.name} is outside of the archive")
+    if member.issym():
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(name), member.linkname))
+        if posixpath.isabs(member.linkname) or _escapes(target):
+            raise UnsafeArchiveError(f"{member.name} links outside of the archive")
+    elif member.islnk():
+        if _escapes(posixpath.normpath(member.linkname)):
+            raise UnsafeArchiveError(f"{member.name} links outside of the archive")
+    elif not (member.isfile() or member.isdir()):
+        raise UnsafeArchiveError(f"{member.name} is not a regular file")
+
+
+class SkillArchive:
+    """a skill tar archive scanned once into an index of its members.
+
+    Raises:
+        tarfile.ReadError: if the file isn't a valid tar archive
+        UnsafeArchiveError: if a member would be extracted outside of the skill directory
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.tar = tarfile.open(path, "r")
+        try:
+            self.members: Dict[str, tarfile.TarInfo] = {
+                posixpath.normpath(member.name): member
+                for member in self.tar.getmembers()
+            }
+            for name, member in self.members.items():
+                check_member(name, member)
+        except Exception:
+            self.tar.close()
+            raise
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.members
+
+    def read(self, name: str) -> bytes:
+        f = self.tar.extractfile(self.members[name])
+        if f is None:
+            raise KeyError(f"{name} is not a regular file")
+        return f.read()
+
+    def extract(self, path: str):
+        self.tar.extractall(path, members=list(self.members.values()))
+
+    def close(self):
+        self.tar.close()
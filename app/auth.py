@@ -0,0 +1,96 @@
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+
+from app.storage import read_or_create_secret
+
+ARGON2 = "argon2"
+HMAC_SHA256 = "hmac-sha256"
+# the generated skill passwords are 64 hex characters, shorter ones are kept on argon2
+MIN_SECRET_LENGTH = 32
+
+
+class SecretHasher:
+    """keyed HMAC-SHA256 digests of the generated skill passwords.
+
+    The passwords are 256 bit random tokens, guessing one is not easier against a digest than
+    against an argon2 hash, so the key stretching only slowed down every login. The key is created
+    next to the skills store on first use.
+    """
+
+    def __init__(self, key_path: str) -> None:
+        self.key_path = key_path
+        self._key: Optional[bytes] = None
+
+    @property
+    def key(self) -> bytes:
+        if self._key is None:
+            self._key = bytes.fromhex(
+                read_or_create_secret(self.key_path, lambda: secrets.token_hex(32))
+            )
+        return self._key
+
+    def hash(self, password: str) -> str:
+        return hmac.new(self.key, password.encode(), hashlib.sha256).hexdigest()
+
+    def verify(self, hashed_password: str, password: str) -> bool:
+        return hmac.compare_digest(self.hash(password), hashed_password)
+
+
+class CredentialCache:
+    """bounded cache of passwords that were already verified against the argon2 hash.
+
+    Entries are keyed on the skill name and a keyed digest of the presented password, so the plain
+    password is never kept in memory. An entry is valid only while it is younger than ttl and the
+    stored hash did not change.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._key = secrets.token_bytes(32)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, bytes], Tuple[float, str]]" = OrderedDict()
+
+    def _digest(self, password: str) -> bytes:
+        return hmac.new(self._key, password.encode(), hashlib.sha256).digest()
+
+    def check(self, skill_name: str, password: str, hashed_password: str) -> bool:
+        key = (skill_name, self._digest(password))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expire, cached_hash = entry
+                if expire > time.monotonic() and hmac.compare_digest(
+                    cached_hash, hashed_password
+                ):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True
+                del self._entries[key]
+            self.misses += 1
+            return False
+
+    def add(self, skill_name: str, password: str, hashed_password: str):
+        if self.max_size <= 0:
+            return
+        key = (skill_name, self._digest(password))
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, hashed_password)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, skill_name: str):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == skill_name]:
+                del self._entries[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
@@ -1,9 +1,58 @@
+from typing import Optional
+
 from pydantic import BaseSettings
 
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
 
 class Settings(BaseSettings):
     store_directory: str = r"/data"
+    # json or sqlite, the json store is migrated to sqlite on the first start
+    store_backend: str = "json"
     rhasspy_url: str = "http://localhost:12101/api/"
+    # seconds, train and restart use rhasspy_train_timeout
+    rhasspy_timeout: float = 10
+    rhasspy_train_timeout: float = 300
+    rhasspy_retries: int = 2
+    rhasspy_backoff: float = 0.5
+    # verified mqtt credentials are kept for this many seconds
+    credential_cache_ttl: int = 300
+    credential_cache_size: int = 1024
+    # threads reserved to argon2 verification of broker logins
+    auth_workers: int = 2
+    # bytes, bigger skill archives are refused
+    max_archive_size: int = 2 * 1024 ** 3
+    # skill installs that can run at the same time
+    install_workers: int = 2
+    # docker calls of the routes, a stop also waits docker_stop_timeout seconds for the container
+    docker_workers: int = 4
+    docker_timeout: float = 30
+    docker_stop_timeout: int = 10
+    # registry of the manifest images that don't name one, e.g. localhost:5000
+    image_registry: Optional[str] = None
+    # an upgraded container must stay up this many seconds before replacing the old one, or be
+    # healthy within upgrade_timeout seconds when its image has a healthcheck
+    upgrade_health_window: float = 5
+    upgrade_timeout: float = 60
+    # seconds the resource usage of the skill containers is cached by GET /skills?stats=true
+    stats_ttl: float = 10
+    # seconds without new sentences before rhasspy is trained
+    train_quiet_window: float = 2
+    # DEBUG logs every acl check
+    log_level: str = "INFO"
+    # seconds between two saves of the metrics of a worker
+    metrics_interval: float = 5
+    # used by app.hibernate, the skills that opted in are stopped after hibernate_idle_timeout
+    # seconds without mqtt activity, a woken skill has hibernate_wake_timeout seconds to subscribe
+    # before its buffered intents are published anyway
+    hibernate_idle_timeout: float = 600
+    hibernate_wake_timeout: float = 30
+    # used by app.start_skills
+    boot_concurrency: int = 4
+    boot_timeout: float = 60
+    api_url: str = "http://127.0.0.1:9090/"
+    broker_host: str = "127.0.0.1"
+    broker_port: int = 1883
 
     def __hash__(self):
         return hash((type(self),) + tuple(self.__dict__.values()))
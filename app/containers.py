@@ -0,0 +1,274 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+import logging
+import threading
+import time
+
+from docker.client import DockerClient
+from docker.errors import NotFound
+from docker.models.containers import Container
+
+from .metrics import DOCKER_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# container status after each docker event
+EVENT_STATUS = {
+    "start": "running",
+    "restart": "running",
+    "unpause": "running",
+    "pause": "paused",
+    "die": "exited",
+    "stop": "exited",
+}
+
+
+def set_container_status(container: Container, status: str):
+    if isinstance(container.attrs.get("State"), dict):
+        container.attrs["State"]["Status"] = status
+    else:
+        container.attrs["State"] = status
+
+
+def is_skill_container(container: Container, skill_name: str) -> bool:
+    """True for the container of the skill, not the one an upgrade runs next to it"""
+    name = "skill_" + skill_name
+    if container.name is not None:
+        return container.name == name
+    # the containers of a sparse list have only their names
+    return "/" + name in (container.attrs.get("Names") or [])
+
+
+def container_stats(container: Container) -> Dict[str, Any]:
+    """cpu and memory usage of a running container from a single stats sample"""
+    raw = container.stats(stream=False)
+    cpu, precpu = raw.get("cpu_stats") or {}, raw.get("precpu_stats") or {}
+    cpu_delta = (cpu.get("cpu_usage") or {}).get("total_usage", 0) - (
+        precpu.get("cpu_usage") or {}
+    ).get("total_usage", 0)
+    system_delta = cpu.get("system_cpu_usage", 0) - precpu.get("system_cpu_usage", 0)
+    cpus = cpu.get("online_cpus") or len(
+        (cpu.get("cpu_usage") or {}).get("percpu_usage") or []
+    ) or 1
+    memory = raw.get("memory_stats") or {}
+    return {
+        "cpu_percent": round(cpu_delta / system_delta * cpus * 100, 2)
+        if system_delta > 0
+        else 0.0,
+        "memory_usage": memory.get("usage"),
+        "memory_limit": memory.get("limit"),
+    }
+
+
+class ContainerIndex:
+    """skill containers indexed by their skill_name label, only the ones named skill_<slug>.
+
+    The index is filled with a single list call and then kept current by a thread that follows
+    the docker events stream, so lookups don't need a round trip to the daemon. If the stream is
+    interrupted the next lookup rebuilds the index.
+
+    version changes every time a container of the index changes, stats_version every time the
+    resource usage is read again.
+    """
+
+    def __init__(self, docker: DockerClient) -> None:
+        self.docker = docker
+        self.containers: Dict[str, Container] = {}
+        self.version = 0
+        self.stats_version = 0
+        # start time of the running containers, read from docker once per start
+        self._started: Dict[str, str] = {}
+        self._stats: Dict[str, Tuple[float, Optional[Dict[str, Any]]]] = {}
+        self._stats_executor = ThreadPoolExecutor(
+            max_workers=8, thread_name_prefix="container-stats"
+        )
+        self._lock = threading.Lock()
+        self._events: Any = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def watching(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        since = int(time.time())
+        with DOCKER_SECONDS.time(operation="list_containers"):
+            containers: List[Container] = self.docker.containers.list(
+                all=True, sparse=True, filters={"label": "skill_name"}
+            )
+        with self._lock:
+            self.containers = {
+                container.attrs["Labels"]["skill_name"]: container
+                for container in containers
+                if is_skill_container(container, container.attrs["Labels"]["skill_name"])
+            }
+            self._started = {}
+            self.version += 1
+        # the events since the list call are replayed, none is lost
+        self._events = self.docker.events(
+            since=since,
+            decode=True,
+            filters={"type": "container", "label": "skill_name"},
+        )
+        self._thread = threading.Thread(
+            target=self._watch, name="container-index", daemon=True
+        )
+        self._thread.start()
+
+    def close(self):
+        if self._events is not None:
+            self._events.close()
+
+    def _watch(self):
+        try:
+            for event in self._events:
+                self.handle_event(event)
+        except Exception as e:
+            logger.warning("container events stream interrupted: %s", e)
+
+    def handle_event(self, event: Dict[str, Any]):
+        action = event.get("Action") or event.get("status")
+        container_id = event.get("id")
+        attributes = event.get("Actor", {}).get("Attributes", {})
+        skill_name = attributes.get("skill_name")
+        if not skill_name:
+            return
+        if action in ("create", "rename"):
+            # e.g. skill_<slug>_next of an upgrade, it takes the name if the upgrade succeeds
+            name = attributes.get("name")
+            container = None
+            if name is None or name == "skill_" + skill_name:
+                try:
+                    with DOCKER_SECONDS.time(operation="get_container"):
+                        container = self.docker.containers.get(container_id)
+                except NotFound:
+                    return
+                if not is_skill_container(container, skill_name):
+                    container = None
+            with self._lock:
+                indexed = self.containers.get(skill_name)
+                if container is not None:
+                    self.containers[skill_name] = container
+                elif action == "rename" and indexed is not None and indexed.id == container_id:
+                    del self.containers[skill_name]
+                else:
+                    return
+                self._started.pop(skill_name, None)
+                self.version += 1
+            return
+        with self._lock:
+            container = self.containers.get(skill_name)
+            if container is None or container.id != container_id:
+                return
+            if action == "destroy":
+                del self.containers[skill_name]
+            elif action in EVENT_STATUS:
+                set_container_status(container, EVENT_STATUS[action])
+            else:
+                return
+            self._started.pop(skill_name, None)
+            self.version += 1
+
+    def _list(self, skill_name: str) -> Optional[Container]:
+        with DOCKER_SECONDS.time(operation="list_containers"):
+            containers: List[Container] = self.docker.containers.list(
+                all=True, filters={"label": f"skill_name={skill_name}"}
+            )
+        for container in containers:
+            if is_skill_container(container, skill_name):
+                return container
+        return None
+
+    def _ensure_watching(self) -> bool:
+        if self.watching:
+            return True
+        try:
+            self.start()
+            return True
+        except Exception as e:
+            logger.warning("unable to watch container events: %s", e)
+            return False
+
+    def get(self, skill_name: str) -> Optional[Container]:
+        if not self._ensure_watching():
+            return self._list(skill_name)
+        with self._lock:
+            container = self.containers.get(skill_name)
+        if container is None:
+            # the create event of a container that was just created may not be arrived yet
+            container = self._list(skill_name)
+            if container is not None:
+                with self._lock:
+                    self.containers.setdefault(skill_name, container)
+                    self.version += 1
+        return container
+
+    def all(self) -> Dict[str, Container]:
+        """the containers of all the skills"""
+        if not self._ensure_watching():
+            return {}
+        with self._lock:
+            return dict(self.containers)
+
+    def status(self, skill_name: str) -> Optional[Dict[str, Any]]:
+        """status, image and start time of the container of the skill"""
+        with self._lock:
+            container = self.containers.get(skill_name)
+            started_at = self._started.get(skill_name)
+        if container is None:
+            return None
+        state = container.status
+        if state == "running" and started_at is None:
+            # the containers of the list call and of the events have no start time
+            try:
+                with DOCKER_SECONDS.time(operation="inspect_container"):
+                    container.reload()
+                started_at = container.attrs["State"]["StartedAt"]
+            except (NotFound, KeyError, TypeError):
+                started_at = None
+            with self._lock:
+                if started_at is not None and self.containers.get(skill_name) is container:
+                    self._started[skill_name] = started_at
+        return {
+            "id": container.id,
+            "name": container.name,
+            "status": state,
+            "image": container.attrs.get("ImageID", container.attrs.get("Image")),
+            "started_at": started_at if state == "running" else None,
+        }
+
+    def stats(self, ttl: float) -> Dict[str, Optional[Dict[str, Any]]]:
+        """resource usage of the running containers, read again from docker after ttl seconds"""
+        self._ensure_watching()
+        now = time.monotonic()
+        with self._lock:
+            running = {
+                name: container
+                for name, container in self.containers.items()
+                if container.status == "running"
+            }
+            stale = [
+                name
+                for name in running
+                if name not in self._stats or now - self._stats[name][0] > ttl
+            ]
+        if stale:
+
+            def read(name: str) -> Optional[Dict[str, Any]]:
+                try:
+                    with DOCKER_SECONDS.time(operation="container_stats"):
+                        return container_stats(running[name])
+                except Exception as e:
+                    logger.info("no stats for the container of %s: %s", name, e)
+                    return None
+
+            # a stats call waits for a cpu sample, they are read in parallel
+            values = list(self._stats_executor.map(read, stale))
+            with self._lock:
+                for name, value in zip(stale, values):
+                    self._stats[name] = (now, value)
+                for name in set(self._stats) - set(running):
+                    del self._stats[name]
+                self.stats_version += 1
+        with self._lock:
+            return {name: self._stats.get(name, (0, None))[1] for name in running}
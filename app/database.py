@@ -1,52 +1,203 @@
+from app.acl import SkillAcl
+from app.metrics import STORE_READS, STORE_RELOAD_SECONDS
 from app.models import DBFile, SkillModel
-from typing import List, Union
+from app.storage import JsonBackend, SqliteBackend, StoreBackend
+from typing import Dict, Hashable, List, Optional, Union
+from functools import lru_cache
 import os
+import threading
+
+
+class StoreSnapshot:
+    """the skills of the store at one point in time, its lookups never read the store"""
+
+    def __init__(self, index: Dict[str, SkillModel], acls: Dict[str, SkillAcl]) -> None:
+        self.index = index
+        # compiled acls, shared with the DB while its index is the same
+        self._acls = acls
+
+    def get_skill(self, skill_name: str) -> Union[SkillModel, None]:
+        return self.index.get(skill_name)
+
+    def get_acl(self, skill_name: str) -> Union[SkillAcl, None]:
+        """return the compiled acl of the skill, it is rebuilt only when the skill changes"""
+        skill = self.index.get(skill_name)
+        if skill is None:
+            return None
+        acl = self._acls.get(skill_name)
+        if acl is None or acl.skill is not skill:
+            acl = SkillAcl(skill)
+            self._acls[skill_name] = acl
+        return acl
 
 
 class DB:
-    def __init__(self, path: str, use_cache=False) -> None:
-        self.path = path
+    """skills store with an in-memory index on top of a StoreBackend.
+
+    When use_cache is enabled the backend is read only when its signature changed since the last
+    read, otherwise lookups are served from the index. Without a backend the json store at path
+    is used.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        use_cache=False,
+        backend: Optional[StoreBackend] = None,
+    ) -> None:
+        if backend is None:
+            if path is None:
+                raise ValueError("path or backend is required")
+            backend = JsonBackend(path)
+        self.backend = backend
         self.use_cache = use_cache
-        if not os.path.isfile(path):
-            print("Genereting db...")
-            par_dir = os.path.dirname(path)
-            if not os.path.exists(par_dir):
-                os.makedirs(par_dir, exist_ok=True)
-            with open(path, "w") as f:
-                f.write(DBFile(skills=[]).json())
+        # number of reads served from the in-memory index
+        self.hits = 0
+        # number of times the backend was read to rebuild the index
+        self.reloads = 0
+        # changes every time the index changes
+        self.version = 0
+        self._lock = threading.Lock()
+        # serializes the writers of this process
+        self._write_lock = threading.Lock()
+        self._signature: Optional[Hashable] = None
+        self._index: Dict[str, SkillModel] = {}
+        self._acls: Dict[str, SkillAcl] = {}
 
     def insert_skill(self, skill: SkillModel, over_write=True) -> bool:
-        data = self.read_file()
-        for skill_json in data.skills:
-            if skill_json.skill_name == skill.skill_name:
-                if not over_write:
-                    return False
-                else:
-                    data.skills.remove(skill_json)
-        data.skills.append(skill)
-        self.write_file(data)
-        return True
+        with self._write_lock, self.backend.writing():
+            index = self._load_locked()
+            if not over_write and skill.skill_name in index:
+                return False
+            self.backend.put(skill)
+            index = dict(index)
+            index[skill.skill_name] = skill
+            self._update_locked(index)
+            return True
+
+    def replace_skill(self, current: SkillModel, skill: SkillModel) -> bool:
+        """write skill only if the stored one is still current, also for the other processes"""
+        with self._write_lock, self.backend.writing():
+            index = self._load_locked()
+            if index.get(current.skill_name) != current:
+                return False
+            self.backend.put(skill)
+            index = dict(index)
+            index[skill.skill_name] = skill
+            self._update_locked(index)
+            return True
+
+    def remove_skill(self, skill_name: str) -> bool:
+        with self._write_lock, self.backend.writing():
+            index = self._load_locked()
+            if skill_name not in index:
+                return False
+            self.backend.delete(skill_name)
+            index = dict(index)
+            del index[skill_name]
+            self._update_locked(index)
+            return True
+
+    def _update_locked(self, index: Dict[str, SkillModel]):
+        # the store is locked, nobody else changed it since the load
+        with self._lock:
+            self._index = index
+            self._signature = self.backend.signature()
+            self.version += 1
+
+    def _load_locked(self) -> Dict[str, SkillModel]:
+        signature = self.backend.signature()
+        with self._lock:
+            if self.use_cache and signature == self._signature:
+                self.hits += 1
+                STORE_READS.inc(result="hit")
+                return self._index
+        with STORE_RELOAD_SECONDS.time():
+            index = self.backend.read()
+        STORE_READS.inc(result="reload")
+        with self._lock:
+            # without the cache every read may return a different index
+            self.version += 1
+            if self.use_cache:
+                self._index = index
+                self._acls = {}
+                self._signature = signature
+                self.reloads += 1
+        return index
 
     def read_file(self) -> DBFile:
-        return DBFile.parse_file(self.path)
+        with self.backend.reading():
+            return DBFile(skills=list(self.backend.read().values()))
 
     def write_file(self, data: DBFile):
-        with open(self.path, "w") as f:
-            f.write(data.json())
+        """replace the whole store"""
+        with self._write_lock, self.backend.writing():
+            self.backend.replace(data.skills)
+        self.invalidate()
+
+    def invalidate(self):
+        """drop the in-memory index, the next read will load the store again"""
+        with self._lock:
+            self._signature = None
+
+    def is_fresh(self) -> bool:
+        """True if the in-memory index matches the store and a read won't load it"""
+        return self.use_cache and self.backend.signature() == self._signature
+
+    def get_index(self) -> Dict[str, SkillModel]:
+        """return the skills indexed by name"""
+        if self.is_fresh():
+            with self._lock:
+                self.hits += 1
+            STORE_READS.inc(result="hit")
+            return self._index
+        with self.backend.reading():
+            return self._load_locked()
 
     def get_skills(self) -> List[SkillModel]:
-        return self.read_file().skills
+        return list(self.get_index().values())
 
     def get_skill(self, skill_name: str) -> Union[SkillModel, None]:
-        for skill in self.get_skills():
-            if skill.skill_name == skill_name:
-                return skill
+        return self.get_index().get(skill_name)
 
-    def remove_skill(self, skill_name: str) -> bool:
-        skill = self.get_skill(skill_name)
-        if not skill:
-            return False
-        data = self.read_file()
-        data.skills.remove(skill)
-        self.write_file(data)
-        return True
+    def get_acl(self, skill_name: str) -> Union[SkillAcl, None]:
+        """return the compiled acl of the skill, it is rebuilt only when the skill changes"""
+        return self.snapshot().get_acl(skill_name)
+
+    def snapshot(self, reload: bool = True) -> Optional[StoreSnapshot]:
+        """return the current index for many lookups that must not read the store again.
+
+        Without reload None is returned instead of loading a store that changed.
+        """
+        if self.is_fresh():
+            with self._lock:
+                self.hits += 1
+                snapshot = StoreSnapshot(self._index, self._acls)
+            STORE_READS.inc(result="hit")
+            return snapshot
+        if not reload:
+            return None
+        with self.backend.reading():
+            index = self._load_locked()
+        with self._lock:
+            return StoreSnapshot(index, self._acls if index is self._index else {})
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "reloads": self.reloads, "skills": len(self._index)}
+
+
+def create_backend(store_directory: str, backend: str = "json") -> StoreBackend:
+    json_path = os.path.join(store_directory, "store.json")
+    if backend == "json":
+        return JsonBackend(json_path)
+    if backend == "sqlite":
+        return SqliteBackend(
+            os.path.join(store_directory, "store.sqlite3"), migrate_from=json_path
+        )
+    raise ValueError(f"unknown store backend {backend}")
+
+
+@lru_cache()
+def get_shared_db(store_directory: str, backend: str = "json") -> DB:
+    """return the process-wide cached DB of the store"""
+    return DB(backend=create_backend(store_directory, backend), use_cache=True)
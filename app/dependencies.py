@@ -1,18 +1,27 @@
 from docker.client import DockerClient
-from docker.models.containers import Container
 from fastapi.param_functions import Depends
 from fastapi import HTTPException, status
 from app.models import SkillModel
 import os
 from . import config
-from typing import Dict, List, Union
-from app.database import DB
+from typing import Dict, List, Optional, Union
+from app.database import DB, StoreSnapshot, get_shared_db
+from app.auth import ARGON2, HMAC_SHA256, CredentialCache, SecretHasher
+from app.containers import ContainerIndex
+from app.docker_gateway import DockerGateway
+from app.hibernate import ActivityMarker
+from app.jobs import JobManager
+from app.rhasspy import RhasspyClient, TrainingScheduler
 from argon2 import PasswordHasher
 import docker
+import logging
 import secrets
 from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from starlette.concurrency import run_in_threadpool
 
 ph = PasswordHasher()
+logger = logging.getLogger(__name__)
 
 
 @lru_cache()
@@ -20,8 +29,92 @@ def get_settings():
     return config.Settings()
 
 
+credential_cache = CredentialCache(
+    get_settings().credential_cache_size, get_settings().credential_cache_ttl
+)
+
+# argon2 runs here so broker logins can't exhaust the threadpool used by the other routes
+auth_executor = ThreadPoolExecutor(
+    max_workers=get_settings().auth_workers, thread_name_prefix="auth"
+)
+
+@lru_cache()
+def get_jobs(settings: config.Settings = Depends(get_settings)) -> JobManager:
+    return JobManager(
+        settings.install_workers,
+        directory=os.path.join(settings.store_directory, "jobs"),
+    )
+
+
+@lru_cache()
+def get_rhasspy(settings: config.Settings = Depends(get_settings)) -> RhasspyClient:
+    return RhasspyClient(
+        settings.rhasspy_url,
+        timeout=settings.rhasspy_timeout,
+        train_timeout=settings.rhasspy_train_timeout,
+        retries=settings.rhasspy_retries,
+        backoff=settings.rhasspy_backoff,
+    )
+
+
+@lru_cache()
+def get_trainer(settings: config.Settings = Depends(get_settings)) -> TrainingScheduler:
+    return TrainingScheduler(
+        get_rhasspy(settings),
+        settings.train_quiet_window,
+        lock_path=os.path.join(settings.store_directory, "rhasspy.lock"),
+        state_path=os.path.join(settings.store_directory, "rhasspy_state.json"),
+    )
+
+
 def get_db(settings: config.Settings = Depends(get_settings)) -> DB:
-    yield DB(os.path.join(settings.store_directory, "store.json"))
+    yield get_shared_db(settings.store_directory, settings.store_backend)
+
+
+async def get_auth_settings() -> config.Settings:
+    """same as get_settings but resolved on the event loop, used by the broker auth routes"""
+    return get_settings()
+
+
+async def get_auth_db(settings: config.Settings = Depends(get_auth_settings)) -> DB:
+    """same store as get_db but resolved on the event loop, used by the broker auth routes"""
+    return get_shared_db(settings.store_directory, settings.store_backend)
+
+
+async def get_auth_snapshot(db: DB = Depends(get_auth_db)) -> StoreSnapshot:
+    """the skills seen by a whole broker auth request.
+
+    The store is parsed in the threadpool only when it changed, otherwise the lookups are served
+    from memory without leaving the event loop.
+    """
+    snapshot = db.snapshot(reload=False)
+    if snapshot is None:
+        snapshot = await run_in_threadpool(db.snapshot)
+    return snapshot
+
+
+@lru_cache()
+def get_secret_hasher(settings: config.Settings = Depends(get_settings)) -> SecretHasher:
+    return SecretHasher(os.path.join(settings.store_directory, "credential.key"))
+
+
+async def get_auth_hasher(
+    settings: config.Settings = Depends(get_auth_settings),
+) -> SecretHasher:
+    # the key is read at startup, the login route doesn't leave the event loop for it
+    return get_secret_hasher(settings)
+
+
+@lru_cache()
+def get_activity(settings: config.Settings) -> ActivityMarker:
+    return ActivityMarker(os.path.join(settings.store_directory, "activity"))
+
+
+async def get_auth_activity(
+    settings: config.Settings = Depends(get_auth_settings),
+) -> ActivityMarker:
+    # a sync dependency would cost a thread hop on every acl check
+    return get_activity(settings)
 
 
 def get_skills_dir(settings: config.Settings = Depends(get_settings)):
@@ -31,40 +124,55 @@ def get_skills_dir(settings: config.Settings = Depends(get_settings)):
     return skills_dir
 
 
+@lru_cache()
 def get_docker() -> DockerClient:
     return docker.from_env()
 
+
+@lru_cache()
+def get_container_index(docker: DockerClient = Depends(get_docker)) -> ContainerIndex:
+    return ContainerIndex(docker)
+
+
+@lru_cache()
+def get_docker_gateway(
+    docker: DockerClient = Depends(get_docker),
+    settings: config.Settings = Depends(get_settings),
+) -> DockerGateway:
+    return DockerGateway(
+        docker,
+        get_container_index(docker),
+        max_workers=settings.docker_workers,
+        timeout=settings.docker_timeout,
+        stop_timeout=settings.docker_stop_timeout,
+    )
+
+
 def get_skill(skill_name: str, db: DB = Depends(get_db)) -> SkillModel:
     skill = db.get_skill(skill_name)
     if not skill:
         raise HTTPException(status.HTTP_404_NOT_FOUND, detail="skill not found")
     return skill
 
-def get_container_by_skill_name(
-    docker: DockerClient, skill_name: str
-) -> Union[Container, None]:
-    containers: List[Container] = docker.containers.list(
-        all=True, filters={"label": f"skill_name={skill_name}"}
-    )
-    if len(containers) != 0:
-        return containers[0]
-    return None
-
-
 @lru_cache()
 def get_temp_directory(settings: config.Settings = Depends(get_settings)) -> str:
     if os.path.isdir("/tmp"):
         return "/tmp"
     temp_dir = os.path.join(settings.store_directory, "temp")
-    print(os.listdir())
     if not os.path.isdir(temp_dir):
-        print("creating temp folder...")
+        logger.info("creating temp folder %s", temp_dir)
         os.makedirs(temp_dir)
     return temp_dir
 
 
 def create_skill(
-    db: DB, slug: str, topic_access: Union[None, Dict[str, int]], start_on_boot: bool
+    db: DB,
+    slug: str,
+    topic_access: Union[None, Dict[str, int]],
+    start_on_boot: bool,
+    intents: Optional[List[str]] = None,
+    hibernate: bool = False,
+    hasher: Optional[SecretHasher] = None,
 ) -> str:
     """create a skill and then insert in the database
 
@@ -72,18 +180,27 @@ def create_skill(
         db (DB): the database instances
         slug (str): the skill name
         topic_access (Union[None, Dict[str, str]]): topics that the skills can access
+        intents (Optional[List[str]]): intents declared by the skill, None gives access to all
+        hasher (Optional[SecretHasher]): the password is hashed with argon2 without it
 
     Returns:
         str: plain password
     """
     password = secrets.token_hex(32)
-    hash_password = ph.hash(password)
+    if hasher is None:
+        hash_password, scheme = ph.hash(password), ARGON2
+    else:
+        hash_password, scheme = hasher.hash(password), HMAC_SHA256
+    credential_cache.invalidate(slug)
     db.insert_skill(
         SkillModel(
             skill_name=slug,
             hashed_password=hash_password,
+            password_scheme=scheme,
             topic_access=topic_access,
             start_on_boot=start_on_boot,
+            hibernate=hibernate,
+            intents=intents,
         )
     )
     return password
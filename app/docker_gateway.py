@@ -0,0 +1,87 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+import asyncio
+import functools
+import logging
+import time
+
+from docker.client import DockerClient
+from docker.models.containers import Container
+from fastapi import HTTPException, status
+
+from .containers import ContainerIndex
+from .metrics import DOCKER_SECONDS, DOCKER_TIMEOUTS
+
+logger = logging.getLogger(__name__)
+
+
+class DockerGateway:
+    """the docker calls of the routes, run on a dedicated executor so they never block the event
+    loop nor take the threads of the other routes.
+
+    Every call is timed in DOCKER_SECONDS by operation and fails with a 504 after its timeout,
+    the call itself can't be interrupted and keeps its thread until the daemon answers.
+    """
+
+    def __init__(
+        self,
+        docker: DockerClient,
+        index: ContainerIndex,
+        max_workers: int = 4,
+        timeout: float = 30,
+        stop_timeout: int = 10,
+    ) -> None:
+        self.docker = docker
+        self.index = index
+        self.timeout = timeout
+        # seconds docker waits for a container to stop before killing it
+        self.stop_timeout = stop_timeout
+        self.timeouts: Dict[str, float] = {
+            "stop_container": stop_timeout + timeout,
+            "remove_container": stop_timeout + timeout,
+        }
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="docker"
+        )
+
+    async def run(self, operation: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+        timeout = self.timeouts.get(operation, self.timeout)
+
+        def timed():
+            with DOCKER_SECONDS.time(operation=operation):
+                return func(*args, **kwargs)
+
+        future = asyncio.get_event_loop().run_in_executor(self.executor, timed)
+        start = time.perf_counter()
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            DOCKER_TIMEOUTS.inc(operation=operation)
+            logger.warning(
+                "docker %s timed out after %.1fs", operation, time.perf_counter() - start
+            )
+            raise HTTPException(
+                status.HTTP_504_GATEWAY_TIMEOUT,
+                detail=f"docker did not complete {operation} within {timeout:.0f}s",
+            )
+
+    async def container(self, skill_name: str) -> Optional[Container]:
+        # served by the index, docker is called only when the index is not watching
+        return await self.run("get_container", self.index.get, skill_name)
+
+    async def stop(self, container: Container, force: bool = False):
+        if force:
+            await self.run("kill_container", container.kill)
+        else:
+            await self.run("stop_container", container.stop, timeout=self.stop_timeout)
+
+    async def start(self, container: Container):
+        await self.run("start_container", container.start)
+
+    async def remove(self, container: Container, force: bool = False):
+        await self.run("remove_container", container.remove, v=True, force=force)
+
+    async def remove_image(self, tag: str, force: bool = False):
+        await self.run(
+            "remove_image", functools.partial(self.docker.images.remove, tag, force=force)
+        )
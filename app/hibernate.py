@@ -0,0 +1,319 @@
+"""stops the idle skills that opted in to hibernation and starts them again on their intents.
+
+Runs next to the api as python -m app.hibernate. A skill with hibernate set is stopped after
+hibernate_idle_timeout seconds without mqtt activity, the process listens on hermes/intent/# with
+its own broker user and when an intent of a stopped skill arrives it starts the container, keeps
+the intent until the skill subscribes again and then publishes it once more.
+
+The api records the activity of the hibernating skills from their acl checks in
+<store>/activity, that is how this process knows a skill is idle or connected again.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+
+import docker as dc
+from docker.client import DockerClient
+from docker.errors import APIError, NotFound
+from docker.models.containers import Container
+
+from .config import LOG_FORMAT, Settings
+from .database import DB, create_backend
+from .intents import skill_intents
+from .metrics import DOCKER_SECONDS, REGISTRY, SKILL_HIBERNATIONS, SKILL_WAKE_SECONDS
+from .storage import atomic_write, read_or_create_secret
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:  # only this process needs it, the api runs without
+    mqtt = None
+
+logger = logging.getLogger(__name__)
+
+# broker user of this process, it can only access hermes/intent/#
+MANAGER_USERNAME = "rhasspy_skills_manager"
+INTENT_PREFIX = "hermes/intent/"
+
+# topic, payload, qos and the time it was received
+Message = Tuple[str, bytes, int, float]
+
+
+def manager_password(store_directory: str) -> str:
+    """the password of MANAGER_USERNAME"""
+    return read_or_create_secret(
+        os.path.join(store_directory, "manager.secret"), lambda: secrets.token_hex(32)
+    )
+
+
+class ActivityMarker:
+    """the last mqtt activity of the hibernating skills, shared by the processes as file mtimes"""
+
+    def __init__(self, directory: str, interval: float = 10) -> None:
+        self.directory = directory
+        # a worker touches the marker of a skill at most every interval seconds
+        self.interval = interval
+        self._marked: Dict[str, float] = {}
+
+    def mark(self, skill_name: str, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._marked.get(skill_name, -self.interval) < self.interval:
+            return
+        self._marked[skill_name] = now
+        path = os.path.join(self.directory, skill_name)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, "a"):
+                os.utime(path)
+        except OSError as e:
+            logger.warning("unable to mark the activity of %s: %s", skill_name, e)
+
+    def last(self, skill_name: str) -> float:
+        try:
+            return os.path.getmtime(os.path.join(self.directory, skill_name))
+        except OSError:
+            return 0.0
+
+
+class Hibernator:
+    def __init__(
+        self, settings: Settings, docker: DockerClient, db: DB, client: Any = None
+    ) -> None:
+        self.settings = settings
+        self.docker = docker
+        self.db = db
+        self.client = client
+        self.skills_dir = os.path.join(settings.store_directory, "skills")
+        self.activity = ActivityMarker(os.path.join(settings.store_directory, "activity"))
+        self.state_path = os.path.join(settings.store_directory, "hibernate.json")
+        self.state: Dict[str, Dict[str, Any]] = self._load_state()
+        # intent name -> skill, only for the skills that hibernate
+        self.intents: Dict[str, str] = {}
+        self.skills: Set[str] = set()
+        self.containers: Dict[str, Container] = {}
+        # when the skill was last seen running or received an intent, time.time()
+        self.seen: Dict[str, float] = {}
+        # intents received while the skill wakes up
+        self.pending: Dict[str, List[Message]] = {}
+        self.lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=settings.boot_concurrency, thread_name_prefix="wake"
+        )
+
+    def _load_state(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.state_path) as f:
+                return json.load(f).get("skills", {})
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self):
+        try:
+            atomic_write(self.state_path, json.dumps({"skills": self.state}))
+        except OSError as e:
+            logger.warning("unable to save the hibernation state: %s", e)
+
+    def refresh(self):
+        """read again the hibernating skills, their intents and their containers"""
+        hibernating = [skill for skill in self.db.get_skills() if skill.hibernate]
+        skills = {skill.skill_name for skill in hibernating}
+        intents = {}
+        for skill in hibernating:
+            declared = skill.intents
+            if declared is None:
+                # installed before the intents were recorded
+                path = os.path.join(self.skills_dir, skill.skill_name, "sentences.ini")
+                declared = skill_intents(path)
+            for intent in declared:
+                intents[intent] = skill.skill_name
+        with DOCKER_SECONDS.time(operation="list_containers"):
+            containers: List[Container] = self.docker.containers.list(
+                all=True, sparse=True, filters={"label": "skill_name"}
+            )
+        by_skill = {}
+        for container in containers:
+            skill_name = container.attrs["Labels"]["skill_name"]
+            # not the container started next to it by an upgrade
+            if skill_name in skills and "/skill_" + skill_name in container.attrs["Names"]:
+                by_skill[skill_name] = container
+        now = time.time()
+        with self.lock:
+            self.skills = skills
+            self.intents = intents
+            for skill_name, container in by_skill.items():
+                # a container found running gets a whole idle window
+                if container.status == "running" and skill_name not in self.seen:
+                    self.seen[skill_name] = now
+                elif container.status != "running":
+                    self.seen.pop(skill_name, None)
+            self.containers = by_skill
+
+    def owner(self, topic: str) -> Optional[str]:
+        """the hibernating skill an intent topic is for"""
+        if not topic.startswith(INTENT_PREFIX):
+            return None
+        name = topic[len(INTENT_PREFIX) :]
+        skill_name = self.intents.get(name)
+        if skill_name is None:
+            # hermes/intent/<skill_name>/... is reserved to the skill
+            first = name.split("/", 1)[0]
+            if first in self.skills:
+                skill_name = first
+        return skill_name
+
+    def on_message(self, client: Any, userdata: Any, message: Any):
+        self.handle(message.topic, message.payload, message.qos)
+
+    def handle(self, topic: str, payload: bytes, qos: int) -> Optional[str]:
+        """buffer the intent of a stopped skill and wake it, returns the skill that is woken"""
+        received = time.time()
+        with self.lock:
+            skill_name = self.owner(topic)
+            if skill_name is None:
+                return None
+            if skill_name in self.pending:
+                self.pending[skill_name].append((topic, payload, qos, received))
+                return None
+            container = self.containers.get(skill_name)
+            if container is None or container.status == "running":
+                self.seen[skill_name] = received
+                return None
+            self.pending[skill_name] = [(topic, payload, qos, received)]
+        self.executor.submit(self.wake, skill_name)
+        return skill_name
+
+    def wake(self, skill_name: str):
+        """start the container, wait until the skill subscribes and publish its buffered intents"""
+        received = self.pending[skill_name][0][3]
+        result = "connected"
+        try:
+            with DOCKER_SECONDS.time(operation="start_container"):
+                container = self.docker.containers.get("skill_" + skill_name)
+                container.start()
+                container.reload()
+        except (APIError, NotFound) as e:
+            logger.error("unable to wake skill %s: %s", skill_name, e)
+            with self.lock:
+                dropped = self.pending.pop(skill_name)
+            logger.warning("dropped %d intents of %s", len(dropped), skill_name)
+            return
+        deadline = time.monotonic() + self.settings.hibernate_wake_timeout
+        while self.activity.last(skill_name) < received:
+            if time.monotonic() >= deadline:
+                result = "timeout"
+                break
+            time.sleep(0.05)
+        with self.lock:
+            messages = self.pending.pop(skill_name)
+            self.containers[skill_name] = container
+            self.seen[skill_name] = time.time()
+        self._publish(messages)
+        latency = time.time() - received
+        SKILL_WAKE_SECONDS.observe(latency, result=result)
+        if result == "timeout":
+            logger.warning(
+                "skill %s did not subscribe within %.0fs, published %d intents anyway",
+                skill_name,
+                self.settings.hibernate_wake_timeout,
+                len(messages),
+            )
+        else:
+            logger.info("woke skill %s in %.2fs", skill_name, latency)
+        with self._state_lock:
+            skill_state = self.state.setdefault(skill_name, {})
+            skill_state["wakes"] = skill_state.get("wakes", 0) + 1
+            skill_state["last_wake"] = received
+            skill_state["last_wake_seconds"] = round(latency, 3)
+            skill_state["hibernated"] = None
+            self._save_state()
+
+    def _publish(self, messages: List[Message]):
+        for topic, payload, qos, _ in messages:
+            self.client.publish(topic, payload, qos=qos)
+
+    def _idle_for(self, skill_name: str, now: float) -> float:
+        return now - max(self.seen.get(skill_name, now), self.activity.last(skill_name))
+
+    def sweep(self):
+        """stop the running hibernating skills that have been idle for too long"""
+        self.refresh()
+        for skill_name, container in list(self.containers.items()):
+            now = time.time()
+            with self.lock:
+                if (
+                    container.status != "running"
+                    or skill_name in self.pending
+                    or self._idle_for(skill_name, now) < self.settings.hibernate_idle_timeout
+                ):
+                    continue
+                idle_seconds = self._idle_for(skill_name, now)
+                # the intents received while the container stops are buffered
+                self.pending[skill_name] = []
+            try:
+                with DOCKER_SECONDS.time(operation="stop_container"):
+                    container.stop()
+                    container.reload()
+                stopped = True
+            except APIError as e:
+                logger.warning("unable to hibernate skill %s: %s", skill_name, e)
+                stopped = False
+            with self.lock:
+                messages = self.pending[skill_name]
+                if stopped:
+                    self.seen.pop(skill_name, None)
+                if not (stopped and messages):
+                    del self.pending[skill_name]
+            if not stopped:
+                self._publish(messages)
+                continue
+            if messages:
+                self.executor.submit(self.wake, skill_name)
+            SKILL_HIBERNATIONS.inc()
+            logger.info("hibernated skill %s after %.0fs idle", skill_name, idle_seconds)
+            with self._state_lock:
+                self.state.setdefault(skill_name, {})["hibernated"] = now
+                self._save_state()
+
+
+def main():
+    settings = Settings()
+    logging.basicConfig(level=settings.log_level, format=LOG_FORMAT)
+    if mqtt is None:
+        logger.error("paho-mqtt is not installed, skills will not hibernate")
+        return
+    db = DB(backend=create_backend(settings.store_directory, settings.store_backend))
+    client = mqtt.Client(client_id=MANAGER_USERNAME)
+    client.username_pw_set(MANAGER_USERNAME, manager_password(settings.store_directory))
+    hibernator = Hibernator(settings, dc.from_env(), db, client)
+    hibernator.refresh()
+
+    def on_connect(client: Any, userdata: Any, flags: Any, rc: int):
+        if rc == 0:
+            client.subscribe(INTENT_PREFIX + "#", qos=1)
+        else:
+            logger.error("broker refused the connection: %s", mqtt.connack_string(rc))
+
+    client.on_connect = on_connect
+    client.on_message = hibernator.on_message
+    client.connect_async(settings.broker_host, settings.broker_port)
+    client.loop_start()
+    metrics_directory = os.path.join(settings.store_directory, "metrics")
+    while True:
+        time.sleep(settings.metrics_interval)
+        try:
+            hibernator.sweep()
+        except Exception as e:
+            logger.error("hibernation sweep failed: %s", e)
+        try:
+            REGISTRY.save(metrics_directory)
+        except OSError as e:
+            logger.warning("unable to save the metrics: %s", e)
+
+
+if __name__ == "__main__":
+    main()
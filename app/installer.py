@@ -0,0 +1,611 @@
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tarfile
+import time
+from socket import gethostname
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from docker.client import DockerClient
+from docker.errors import APIError, BuildError, ImageNotFound
+from docker.models.containers import Container
+from docker.models.images import Image
+from docker.models.networks import Network
+from docker.utils import parse_repository_tag
+from fastapi import status
+from pydantic import ValidationError
+from rhasspy_skills_cli.manifest import Manifest
+
+from .archive import SkillArchive, UnsafeArchiveError
+from .config import Settings
+from .database import DB
+from .auth import SecretHasher
+from .dependencies import create_skill, credential_cache, get_secret_hasher
+from .intents import skill_intents
+from .jobs import Job, JobManager
+from .metrics import DOCKER_SECONDS, IMAGE_BUILD_SECONDS, IMAGE_PULL_SECONDS
+from .models import JobStage, JobState, TrainingRunModel
+from .rhasspy import TrainingScheduler
+from .routers.exceptions import SkillInstallException
+
+logger = logging.getLogger(__name__)
+
+# label of the skill images with the digest of the build context they were built from
+CONTEXT_DIGEST_LABEL = "skill_context_digest"
+# files of the skill directory never needed by the build
+BUILD_IGNORED = ["data", "config.json", ".dockerignore"]
+# needed only when the dockerfile copies them, the whole directory or a pattern
+BUILD_OPTIONAL = ["sentences.ini", "manifest.json"]
+COPY_ALL = re.compile(
+    r"^\s*(COPY|ADD)\s+(--\S+\s+)*\.\.?/?\s", re.IGNORECASE | re.MULTILINE
+)
+# a source like *.ini may match them, the brackets of the exec form are taken as a pattern too
+COPY_PATTERN = re.compile(r"^\s*(COPY|ADD)\s[^\n]*[*?[]", re.IGNORECASE | re.MULTILINE)
+
+
+def prepare_build_context(skill_path: str) -> Tuple[str, int]:
+    """exclude the files not needed by the build with a .dockerignore.
+
+    Returns:
+        Tuple[str, int]: the sha256 digest of the build context and its size in bytes
+    """
+    ignored = list(BUILD_IGNORED)
+    with open(os.path.join(skill_path, "Dockerfile"), "r") as f:
+        # the instructions continued on the next lines
+        dockerfile = f.read().replace("\\\n", " ")
+    if not (COPY_ALL.search(dockerfile) or COPY_PATTERN.search(dockerfile)):
+        ignored.extend(name for name in BUILD_OPTIONAL if name not in dockerfile)
+    dockerignore_path = os.path.join(skill_path, ".dockerignore")
+    lines = []
+    if os.path.isfile(dockerignore_path):
+        with open(dockerignore_path, "r") as f:
+            lines = f.read().splitlines()
+    with open(dockerignore_path, "w") as f:
+        f.write("\n".join(lines + ignored) + "\n")
+
+    digest = hashlib.sha256()
+    size = 0
+    for root, dirs, files in os.walk(skill_path):
+        rel_root = os.path.relpath(root, skill_path)
+        if rel_root == ".":
+            dirs[:] = [name for name in dirs if name not in ignored]
+            files = [name for name in files if name not in ignored]
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.normpath(os.path.join(rel_root, name)).encode() + b"\0")
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+            size += os.path.getsize(path)
+    return digest.hexdigest(), size
+
+
+def image_reference(image: str, registry: Optional[str]) -> str:
+    """prefix the image with the registry unless it already names one"""
+    first = image.split("/", 1)[0]
+    if not registry or (
+        "/" in image and ("." in first or ":" in first or first == "localhost")
+    ):
+        return image
+    return f"{registry.rstrip('/')}/{image}"
+
+
+class PullProgress:
+    """reports the events of an image pull in the job log.
+
+    The status changes of the layers are logged as they arrive, the download progress only when
+    the overall percentage passes a multiple of ten.
+    """
+
+    def __init__(self, job: Job) -> None:
+        self.job = job
+        self.layers: Dict[str, Tuple[int, int]] = {}
+        self.reported = -1
+
+    def update(self, event: Dict[str, Any]):
+        detail = event.get("progressDetail") or {}
+        layer = event.get("id")
+        if layer and detail.get("total"):
+            if event.get("status") == "Downloading":
+                self.layers[layer] = (detail.get("current", 0), detail["total"])
+                self._report()
+            return
+        if layer and event.get("status") == "Download complete" and layer in self.layers:
+            self.layers[layer] = (self.layers[layer][1], self.layers[layer][1])
+            self._report()
+        status_line = event.get("status")
+        if status_line:
+            self.job.log(f"{layer}: {status_line}" if layer else status_line)
+
+    def _report(self):
+        current = sum(current for current, _ in self.layers.values())
+        total = sum(total for _, total in self.layers.values())
+        percent = current * 100 // total // 10 * 10
+        if percent > self.reported:
+            self.reported = percent
+            self.job.log(f"downloaded {percent}% of {total / 1e6:.1f} MB")
+
+
+def log_training(job: Job, run: TrainingRunModel):
+    if run.skipped:
+        job.log("sentences already deployed, rhasspy not trained")
+    else:
+        job.log(f"trained rhasspy in run {run.id} with {', '.join(run.operations)}")
+
+
+def open_skill_archive(file_path: str) -> Tuple[SkillArchive, Manifest]:
+    """open an uploaded archive and validate its manifest and content.
+
+    The archive file is removed if it is not valid.
+
+    Raises:
+        SkillInstallException: if the archive isn't a valid skill
+    """
+    try:
+        tar = SkillArchive(file_path)
+    except UnsafeArchiveError as e:
+        os.remove(file_path)
+        raise SkillInstallException(
+            status.HTTP_400_BAD_REQUEST,
+            detail=str(e),
+            error_code="unsafe_archive",
+        )
+    except tarfile.ReadError:
+        os.remove(file_path)
+        raise SkillInstallException(
+            status.HTTP_400_BAD_REQUEST,
+            detail="archive is in a invalid format",
+            error_code="invalid_archive",
+        )
+    try:
+        if "manifest.json" not in tar:
+            raise SkillInstallException(
+                status.HTTP_400_BAD_REQUEST,
+                detail="the archive do not contain a manifest.json",
+                error_code="manifest_not_present",
+            )
+        try:
+            manifest = Manifest.parse_raw(tar.read("manifest.json"))
+        except ValidationError as e:
+            raise SkillInstallException(
+                status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=e.errors(),
+                error_code="invalid_manifest",
+            )
+        if not manifest.image and "Dockerfile" not in tar:
+            raise SkillInstallException(
+                status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="no dockerfile and image detected",
+                error_code="image_not_present",
+            )
+        # TODO add multi language support
+        if "sentences.ini" not in tar:
+            raise SkillInstallException(
+                status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="the archive do not contain a sentences.ini",
+                error_code="sentences_not_present",
+            )
+    except SkillInstallException:
+        tar.close()
+        os.remove(file_path)
+        raise
+    return tar, manifest
+
+
+def host_data_path(docker: DockerClient, data_skill_path: str) -> Union[str, None]:
+    """translate a path under /data to the path on the docker host"""
+    self_container: Container = docker.containers.get(gethostname())
+    mounts = docker.api.inspect_container(self_container.id)["Mounts"]
+    path_host = None
+    for mount in mounts:
+        if mount["Destination"] == "/data":
+            path_host = mount["Source"]
+
+    return (
+        os.path.join(
+            os.path.dirname(path_host),
+            data_skill_path.replace("/", "", 1),
+        )
+        if path_host
+        else None
+    )
+
+
+def run_skill_container(
+    docker: DockerClient,
+    db: DB,
+    slug: str,
+    tag: str,
+    data_skill_path: str,
+    topic_access: Union[None, Dict[str, int]],
+    start_on_boot: bool,
+    internet_access: bool,
+    name: Optional[str] = None,
+    password: Optional[str] = None,
+    intents: Optional[List[str]] = None,
+    hibernate: bool = False,
+    hasher: Optional[SecretHasher] = None,
+) -> str:
+    """issue new mqtt credentials to the skill and run its container from the image tag
+
+    The container is named as the tag unless name is given, with password the credentials of the
+    skill are not issued again and the container uses the given password. intents and hibernate
+    are stored with the new credentials, hashed by hasher.
+
+    Returns:
+        str: the data path of the skill on the docker host
+    """
+    bind_path = host_data_path(docker, data_skill_path)
+    if password is None:
+        password = create_skill(
+            db,
+            slug,
+            topic_access,
+            start_on_boot,
+            intents=intents,
+            hibernate=hibernate,
+            hasher=hasher,
+        )
+    container: Container = docker.containers.run(
+        tag,
+        environment={
+            "MQTT_PASS": password,
+            "MQTT_USER": slug,
+        },
+        network="mqtt-net",
+        detach=True,
+        name=name or tag,
+        labels={"skill_name": slug},
+        volumes={bind_path: {"bind": "/data", "mode": "rw"}},
+    )
+    if internet_access:
+        net_bridge: Network = docker.networks.list(names=["bridge"])[0]
+        net_bridge.connect(container)
+    return bind_path
+
+
+class SkillInstaller:
+    """installs validated skill archives, every blocking step runs on the job executor"""
+
+    def __init__(
+        self,
+        db: DB,
+        docker: DockerClient,
+        settings: Settings,
+        skill_dir: str,
+        jobs: JobManager,
+        trainer: TrainingScheduler,
+    ) -> None:
+        self.db = db
+        self.docker = docker
+        self.settings = settings
+        self.skill_dir = skill_dir
+        self.jobs = jobs
+        self.trainer = trainer
+
+    def check_not_installed(self, manifest: Manifest, force: bool):
+        if not force and os.path.isdir(os.path.join(self.skill_dir, manifest.slug)):
+            raise SkillInstallException(
+                status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="skill with the same name already exist",
+                error_code="skill_already_installed",
+            )
+
+    def submit(
+        self,
+        tar: SkillArchive,
+        manifest: Manifest,
+        force: bool,
+        start_on_boot: bool,
+        train: bool = True,
+    ) -> Job:
+        return self.jobs.submit(
+            "install",
+            lambda job: self.install(job, tar, manifest, force, start_on_boot, train),
+        )
+
+    def submit_bulk(
+        self,
+        archives: List[Tuple[SkillArchive, Manifest]],
+        force: bool,
+        start_on_boot: bool,
+    ) -> Tuple[Job, Dict[str, Job]]:
+        """install every archive in its own job and train rhasspy once when all are done.
+
+        Returns:
+            Tuple[Job, Dict[str, Job]]: the bulk job and the install job of every skill
+        """
+        skill_jobs = {
+            manifest.slug: self.submit(tar, manifest, force, start_on_boot, train=False)
+            for tar, manifest in archives
+        }
+        manifests = {manifest.slug: manifest for _, manifest in archives}
+        # it only waits for the install jobs, it can't take one of their slots
+        job = self.jobs.submit(
+            "bulk_install",
+            lambda job: self.install_bulk(job, skill_jobs, manifests),
+            limited=False,
+        )
+        return job, skill_jobs
+
+    async def install_bulk(
+        self, job: Job, skill_jobs: Dict[str, Job], manifests: Dict[str, Manifest]
+    ) -> Dict[str, Any]:
+        skills: Dict[str, Any] = {}
+        sentences: Dict[str, str] = {}
+        trained: List[str] = []
+        for slug, skill_job in skill_jobs.items():
+            await self.jobs.wait(skill_job)
+            model = skill_job.model
+            job.log(f"{slug}: {model.state.value}")
+            skills[slug] = {"job": skill_job.id, "state": model.state.value}
+            if model.state == JobState.SUCCESS:
+                skills[slug]["result"] = model.result
+                if manifests[slug].auto_train:
+                    sentences.update(self._sentences(slug))
+                    trained.append(slug)
+            else:
+                skills[slug]["error"] = model.error
+        installed = sum(skill["state"] == JobState.SUCCESS.value for skill in skills.values())
+        if installed == len(skills):
+            state = "success"
+        elif installed:
+            state = "partial"
+        else:
+            state = "failed"
+        result: Dict[str, Any] = {
+            "state": state,
+            "detail": f"installed {installed} of {len(skills)} skills",
+            "skills": skills,
+        }
+        if trained:
+            job.set_stage(JobStage.TRAIN)
+            run = await self.trainer.submit(f"install {', '.join(trained)}", sentences)
+            log_training(job, run)
+            result["training"] = run.dict(include={"id", "operations", "skipped"})
+        return result
+
+    async def install(
+        self,
+        job: Job,
+        tar: SkillArchive,
+        manifest: Manifest,
+        force: bool,
+        start_on_boot: bool,
+        train: bool = True,
+    ) -> Dict[str, Any]:
+        skill_path = os.path.join(self.skill_dir, manifest.slug)
+        try:
+            job.set_stage(JobStage.EXTRACT)
+            await self.jobs.run_blocking(self._extract, tar, skill_path, force)
+            data_skill_path = os.path.join(skill_path, "data")
+            tag = "skill_" + manifest.slug
+            await self.jobs.run_blocking(self._remove_conflicting, tag, force)
+            if manifest.image:
+                job.set_stage(JobStage.PULL)
+                image = await self.jobs.run_blocking(self._pull, job, manifest.image, tag)
+            else:
+                job.set_stage(JobStage.BUILD)
+                image = await self.jobs.run_blocking(self._build, job, skill_path, tag)
+            job.set_stage(JobStage.RUN)
+            bind_path = await self.jobs.run_blocking(
+                self._run, manifest, tag, data_skill_path, start_on_boot
+            )
+        except SkillInstallException as e:
+            logger.warning(
+                "install failed skill=%s error=%s, cleaning up", manifest.slug, e.error_code
+            )
+            await self.jobs.run_blocking(
+                self._clean_up,
+                tar,
+                manifest.slug,
+                skill_path,
+                e.error_code != "skill_already_installed",
+            )
+            raise
+        result = {
+            "state": "success",
+            "detail": f"installed {manifest.name} in {os.path.dirname(bind_path)}",
+            "pull" if manifest.image else "build": image,
+        }
+        if manifest.auto_train and train:
+            job.set_stage(JobStage.TRAIN)
+            run = await self._train(job, manifest)
+            result["training"] = run.dict(include={"id", "operations", "skipped"})
+        return result
+
+    def _clean_up(self, tar: SkillArchive, slug: str, skill_path: str, remove_skill: bool):
+        """remove the archive and, with remove_skill, what a failed install left"""
+        tar.close()
+        if os.path.isfile(tar.path):
+            os.remove(tar.path)
+        if remove_skill and os.path.isdir(skill_path):
+            self.db.remove_skill(slug)
+            credential_cache.invalidate(slug)
+            shutil.rmtree(skill_path)
+
+    def _extract(self, tar: SkillArchive, skill_path: str, force: bool):
+        try:
+            os.mkdir(skill_path)
+        except FileExistsError:
+            if force:
+                shutil.rmtree(skill_path)
+            else:
+                raise SkillInstallException(
+                    status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail="skill with the same name already exist",
+                    error_code="skill_already_installed",
+                )
+        try:
+            tar.extract(skill_path)
+        finally:
+            tar.close()
+            os.remove(tar.path)
+        data_skill_path = os.path.join(skill_path, "data")
+        os.mkdir(data_skill_path)
+        config_skill_path = os.path.join(skill_path, "config.json")
+        if os.path.isfile(config_skill_path):
+            shutil.copy(config_skill_path, os.path.join(data_skill_path, "config.json"))
+
+    def _remove_conflicting(self, tag: str, force: bool):
+        with DOCKER_SECONDS.time(operation="list_containers"):
+            containers: List[Container] = self.docker.containers.list(
+                all=True, filters={"name": tag}
+            )
+        for container in containers:
+            if tag == container.name:
+                if force:
+                    container.remove(force=True)
+                else:
+                    raise SkillInstallException(
+                        status.HTTP_422_UNPROCESSABLE_ENTITY,
+                        detail=f"The container name {tag} is already in use by another container {container.id}",
+                        error_code="container_name_already_used",
+                    )
+
+    def _current_image(self, tag: str) -> Optional[Image]:
+        try:
+            with DOCKER_SECONDS.time(operation="get_image"):
+                return self.docker.images.get(tag)
+        except ImageNotFound:
+            return None
+
+    def _build(self, job: Job, skill_path: str, tag: str) -> Dict[str, Any]:
+        """build the image, skipped when the image of tag was built from the same context"""
+        start = time.perf_counter()
+        try:
+            digest, context_size = prepare_build_context(skill_path)
+            job.log(f"build context: {context_size} bytes, digest {digest}")
+            current = self._current_image(tag)
+            if current is not None and current.labels.get(CONTEXT_DIGEST_LABEL) == digest:
+                job.log(f"image {tag} is up to date, build skipped")
+                elapsed = time.perf_counter() - start
+                IMAGE_BUILD_SECONDS.observe(elapsed, result="skipped")
+                return {"skipped": True, "context_size": context_size, "seconds": elapsed}
+            image_id = None
+            for chunk in self.docker.api.build(
+                path=skill_path,
+                tag=tag,
+                rm=True,
+                decode=True,
+                labels={CONTEXT_DIGEST_LABEL: digest},
+            ):
+                if "stream" in chunk:
+                    line = chunk["stream"].rstrip()
+                    if line:
+                        job.log(line)
+                if "error" in chunk:
+                    raise BuildError(chunk["error"], [])
+                if isinstance(chunk.get("aux"), dict):
+                    image_id = chunk["aux"].get("ID", image_id)
+        except Exception as e:
+            IMAGE_BUILD_SECONDS.observe(time.perf_counter() - start, result="failed")
+            raise SkillInstallException(
+                status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f"failed to build image. Error: {str(e)}",
+                error_code="build_image",
+            )
+        elapsed = time.perf_counter() - start
+        IMAGE_BUILD_SECONDS.observe(elapsed, result="success")
+        job.log(f"built image {tag} in {elapsed:.1f}s")
+        self._remove_replaced(current, image_id, tag)
+        return {"skipped": False, "context_size": context_size, "seconds": elapsed}
+
+    def _pull(self, job: Job, image: str, tag: str) -> Dict[str, Any]:
+        """pull the manifest image and tag it as the skill image.
+
+        An image pinned by digest is pulled only if it is not present yet, the layers of the
+        other images already on the host are reused by docker.
+        """
+        start = time.perf_counter()
+        reference = image_reference(image, self.settings.image_registry)
+        current = self._current_image(tag)
+        pulled = self._current_image(reference) if "@" in reference else None
+        skipped = pulled is not None
+        try:
+            if pulled is None:
+                job.log(f"pulling {reference}")
+                progress = PullProgress(job)
+                for event in self.docker.api.pull(reference, stream=True, decode=True):
+                    if "error" in event:
+                        raise APIError(event["error"])
+                    progress.update(event)
+                with DOCKER_SECONDS.time(operation="get_image"):
+                    pulled = self.docker.images.get(reference)
+            else:
+                job.log(f"image {reference} already present, pull skipped")
+            with DOCKER_SECONDS.time(operation="tag_image"):
+                pulled.tag(tag)
+        except Exception as e:
+            IMAGE_PULL_SECONDS.observe(time.perf_counter() - start, result="failed")
+            raise SkillInstallException(
+                status.HTTP_424_FAILED_DEPENDENCY,
+                detail=f"failed to pull image {reference}. Error: {str(e)}",
+                error_code="pull_image",
+            )
+        elapsed = time.perf_counter() - start
+        IMAGE_PULL_SECONDS.observe(elapsed, result="skipped" if skipped else "success")
+        self._remove_replaced(current, pulled.id, tag)
+        repository = parse_repository_tag(reference)[0]
+        digest = None
+        for repo_digest in pulled.attrs.get("RepoDigests") or []:
+            if repo_digest.split("@", 1)[0] == repository:
+                digest = repo_digest.split("@", 1)[1]
+        return {
+            "image": reference,
+            "digest": digest,
+            "skipped": skipped,
+            "seconds": elapsed,
+        }
+
+    def _remove_replaced(self, current: Optional[Image], image_id: Optional[str], tag: str):
+        if current is None or image_id is None or current.id == image_id:
+            return
+        # the previous image is now untagged, its layers shared with the new one are kept
+        try:
+            with DOCKER_SECONDS.time(operation="remove_image"):
+                self.docker.images.remove(current.id)
+        except APIError as e:
+            logger.info("previous image of %s not removed: %s", tag, e)
+
+    def _run(
+        self, manifest: Manifest, tag: str, data_skill_path: str, start_on_boot: bool
+    ) -> str:
+        try:
+            with DOCKER_SECONDS.time(operation="run_container"):
+                return run_skill_container(
+                    self.docker,
+                    self.db,
+                    manifest.slug,
+                    tag,
+                    data_skill_path,
+                    manifest.topic_access,
+                    start_on_boot,
+                    manifest.internet_access,
+                    intents=skill_intents(
+                        os.path.join(self.skill_dir, manifest.slug, "sentences.ini")
+                    ),
+                    hasher=get_secret_hasher(self.settings),
+                )
+        except Exception as e:
+            raise SkillInstallException(
+                status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=str(e),
+                error_code="container_creation",
+            )
+
+    def _sentences(self, slug: str) -> Dict[str, str]:
+        """the sentences of the skill as they are sent to rhasspy"""
+        # TODO add multi language support
+        with open(os.path.join(self.skill_dir, slug, "sentences.ini"), "r") as f:
+            return {f"intents/skills/{slug}/sentences.ini": f.read()}
+
+    async def _train(self, job: Job, manifest: Manifest, operation: str = "install"):
+        run = await self.trainer.submit(
+            f"{operation} {manifest.slug}", self._sentences(manifest.slug)
+        )
+        log_training(job, run)
+        return run
@@ -0,0 +1,34 @@
+"""the intents declared by the skills, from the sections of their sentences.ini"""
+from typing import Dict, Iterable, List
+import re
+
+from app.models import SkillModel
+
+INTENT_SECTION = re.compile(r"^\s*\[([^\]\s]+)\]\s*$", re.MULTILINE)
+
+
+def parse_intents(sentences: str) -> List[str]:
+    intents: List[str] = []
+    for intent in INTENT_SECTION.findall(sentences):
+        if intent not in intents:
+            intents.append(intent)
+    return intents
+
+
+def skill_intents(sentences_path: str) -> List[str]:
+    """the intents of a sentences.ini, none if it can't be read"""
+    try:
+        with open(sentences_path) as f:
+            return parse_intents(f.read())
+    except OSError:
+        return []
+
+
+def intent_index(skills: Iterable[SkillModel]) -> Dict[str, List[str]]:
+    """intent name -> skills that declare it, the skills installed before the intents were
+    recorded (intents is None) are left out"""
+    index: Dict[str, List[str]] = {}
+    for skill in skills:
+        for intent in skill.intents or []:
+            index.setdefault(intent, []).append(skill.skill_name)
+    return index
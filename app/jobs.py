@@ -0,0 +1,257 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
+import asyncio
+import fcntl
+import functools
+import logging
+import os
+import threading
+import time
+import uuid
+
+from fastapi import HTTPException
+from app.models import JobModel, JobStage, JobState
+from app.routers.exceptions import SkillInstallException
+
+logger = logging.getLogger(__name__)
+
+
+def worker_alive(directory: str, worker: Optional[str]) -> bool:
+    """True while the worker holds the lock of its file in directory"""
+    if not worker or not worker.isalnum():
+        return False
+    path = os.path.join(directory, worker + ".lock")
+    try:
+        with open(path, "a") as f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            # the lock was released when the worker exited
+            os.remove(path)
+    except OSError:
+        pass
+    return False
+
+
+class Job:
+    """a long running operation executed in background by the JobManager"""
+
+    # seconds between two saves triggered by new log lines
+    SAVE_INTERVAL = 1
+
+    def __init__(self, kind: str, directory: Optional[str] = None) -> None:
+        self.model = JobModel(id=uuid.uuid4().hex, kind=kind, created=time.time())
+        self.task: Optional["asyncio.Task[Any]"] = None
+        self.path = os.path.join(directory, self.id + ".json") if directory else None
+        self._save_lock = threading.Lock()
+        self._saved = 0.0
+
+    @property
+    def id(self) -> str:
+        return self.model.id
+
+    def set_stage(self, stage: JobStage):
+        self.model.stage = stage
+        self.log(f"stage: {stage.value}")
+        self.save(force=True)
+
+    def log(self, line: str):
+        # called also from the executor threads, list.append is atomic
+        self.model.log.append(line)
+        self.save()
+
+    def save(self, force: bool = False):
+        """write the job state where the other workers can read it"""
+        if self.path is None or (
+            not force and time.monotonic() - self._saved < self.SAVE_INTERVAL
+        ):
+            return
+        with self._save_lock:
+            self._saved = time.monotonic()
+            try:
+                with open(self.path + ".tmp", "w") as f:
+                    f.write(self.model.json())
+                os.replace(self.path + ".tmp", self.path)
+            except OSError as e:
+                logger.warning("unable to save job %s: %s", self.id, e)
+
+    def fail(self, exc: Union[SkillInstallException, HTTPException]):
+        self.model.error = {"status_code": exc.status_code, "detail": exc.detail}
+        if isinstance(exc, SkillInstallException):
+            self.model.error["error_code"] = exc.error_code
+
+    def raise_error(self):
+        """raise again the error of a failed job as it would be raised by the route"""
+        error = self.model.error or {}
+        raise SkillInstallException(
+            error.get("status_code", 500),
+            error.get("error_code", "job_failed"),
+            error.get("detail", "job failed"),
+        )
+
+
+class JobManager:
+    """runs jobs as asyncio tasks, at most max_workers at the same time.
+
+    The blocking steps of a job (docker build, container creation...) must go through run_blocking
+    so they are executed on a dedicated executor of the same size instead of the event loop.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 2,
+        max_finished: int = 100,
+        directory: Optional[str] = None,
+    ) -> None:
+        self.max_workers = max_workers
+        self.max_finished = max_finished
+        # where the jobs are saved, so every worker can report the jobs of the others
+        self.directory = directory
+        self.jobs: Dict[str, Job] = {}
+        self.worker = uuid.uuid4().hex
+        # held until the process exits, tells the other workers this one still runs its jobs
+        self._worker_lock: Any = None
+        if directory:
+            os.makedirs(self.workers_directory, exist_ok=True)
+            lock_path = os.path.join(self.workers_directory, self.worker + ".lock")
+            self._worker_lock = open(lock_path, "w")
+            fcntl.flock(self._worker_lock.fileno(), fcntl.LOCK_EX)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="job"
+        )
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @property
+    def workers_directory(self) -> str:
+        return os.path.join(self.directory, "workers")
+
+    def submit(
+        self,
+        kind: str,
+        func: Callable[[Job], Awaitable[Dict[str, Any]]],
+        limited: bool = True,
+    ) -> Job:
+        """run func in background, a job that only waits for other jobs must not be limited"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        job = Job(kind, self.directory)
+        job.model.worker = self.worker
+        self.jobs[job.id] = job
+        job.save(force=True)
+        job.task = asyncio.ensure_future(
+            self._run(job, func) if limited else self._execute(job, func)
+        )
+        self._prune()
+        return job
+
+    async def _run(self, job: Job, func: Callable[[Job], Awaitable[Dict[str, Any]]]):
+        async with self._semaphore:
+            await self._execute(job, func)
+
+    async def _execute(self, job: Job, func: Callable[[Job], Awaitable[Dict[str, Any]]]):
+        job.model.state = JobState.RUNNING
+        try:
+            job.model.result = await func(job)
+            job.model.state = JobState.SUCCESS
+            job.set_stage(JobStage.DONE)
+        except (SkillInstallException, HTTPException) as e:
+            job.fail(e)
+            job.model.state = JobState.FAILED
+            job.log(f"failed: {e.detail}")
+        except Exception as e:
+            job.model.error = {"status_code": 500, "detail": str(e)}
+            job.model.state = JobState.FAILED
+            job.log(f"failed: {e}")
+        finally:
+            job.model.finished = time.time()
+            job.save(force=True)
+
+    async def run_blocking(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def wait(self, job: Job) -> Job:
+        # the job keeps running even if the waiting request is cancelled
+        await asyncio.shield(job.task)
+        return job
+
+    def _load(self, file_name: str) -> Optional[Job]:
+        try:
+            model = JobModel.parse_file(os.path.join(self.directory, file_name))
+        except (OSError, ValueError):
+            return None
+        job = Job(model.kind)
+        job.model = model
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        job = self.jobs.get(job_id)
+        if job is None and self.directory and job_id.isalnum():
+            # the job may be running in another worker
+            job = self._load(job_id + ".json")
+        return job
+
+    def list(self) -> List[Job]:
+        jobs = dict(self.jobs)
+        if self.directory:
+            for file_name in os.listdir(self.directory):
+                job_id, ext = os.path.splitext(file_name)
+                if ext == ".json" and job_id not in jobs:
+                    job = self._load(file_name)
+                    if job is not None:
+                        jobs[job_id] = job
+        return sorted(jobs.values(), key=lambda job: job.model.created)
+
+    def recover(self):
+        """fail the saved jobs left unfinished by a worker that stopped, called at startup"""
+        if not self.directory:
+            return
+        for file_name in os.listdir(self.directory):
+            job_id, ext = os.path.splitext(file_name)
+            if ext != ".json" or job_id in self.jobs:
+                continue
+            job = self._load(file_name)
+            if job is None or job.model.finished:
+                continue
+            if worker_alive(self.workers_directory, job.model.worker):
+                continue
+            job.path = os.path.join(self.directory, file_name)
+            job.fail(
+                SkillInstallException(
+                    500, "job_interrupted", "the worker running the job stopped"
+                )
+            )
+            job.model.state = JobState.FAILED
+            job.model.finished = time.time()
+            job.save(force=True)
+            logger.warning("job %s of a stopped worker marked as failed", job.id)
+
+    def _prune(self):
+        finished = [job for job in self.jobs.values() if job.model.finished]
+        for job in finished[: max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job.id]
+        if self.directory:
+            self._prune_files()
+
+    def _prune_files(self):
+        """remove the oldest files of finished jobs, whichever worker ran them"""
+        files = []
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith(".json"):
+                try:
+                    mtime = os.path.getmtime(os.path.join(self.directory, file_name))
+                except OSError:
+                    continue
+                files.append((mtime, file_name))
+        files.sort(reverse=True)
+        for _, file_name in files[self.max_finished :]:
+            job = self._load(file_name)
+            # a job file is replaced atomically, one that can't be read is corrupted
+            if job is not None and not job.model.finished:
+                continue
+            try:
+                os.remove(os.path.join(self.directory, file_name))
+            except OSError:
+                pass
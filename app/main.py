@@ -1,14 +1,78 @@
 from fastapi import FastAPI, status, Response
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import logging
+import os
+from .config import LOG_FORMAT
+from .dependencies import get_jobs, get_rhasspy, get_secret_hasher, get_settings
+from .metrics import REGISTRY
+from .routers.jobs import jobs_router
 from .routers.mqtt import mqtt_router
 from .routers.skill import skill_router
 
+logging.basicConfig(level=get_settings().log_level, format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
 
 app = FastAPI(debug=True, version="0.0.1")
 app.include_router(mqtt_router, prefix="/api")
 app.include_router(skill_router, prefix="/api")
+app.include_router(jobs_router, prefix="/api")
 
 
 @app.get("/")
 def read_root(response: Response):
     response.status_code = status.HTTP_307_TEMPORARY_REDIRECT
     response.headers["Location"] = "/docs"
+
+
+def metrics_directory() -> str:
+    return os.path.join(get_settings().store_directory, "metrics")
+
+
+@app.get("/metrics", tags=["metrics"])
+def read_metrics():
+    """metrics of all the workers in the prometheus text format"""
+    settings = get_settings()
+    snapshots = REGISTRY.collect(
+        metrics_directory(), max_age=settings.metrics_interval * 3
+    )
+    return Response(
+        REGISTRY.render(snapshots), media_type="text/plain; version=0.0.4"
+    )
+
+
+async def save_metrics():
+    while True:
+        await asyncio.sleep(get_settings().metrics_interval)
+        try:
+            await run_in_threadpool(REGISTRY.save, metrics_directory())
+        except OSError as e:
+            logger.warning("unable to save the metrics: %s", e)
+
+
+@app.on_event("startup")
+async def open_rhasspy_client():
+    # opened here so the first install doesn't pay for it
+    get_rhasspy(get_settings()).client
+
+
+@app.on_event("startup")
+async def load_credential_key():
+    # created before app.start_skills needs it, both run as rhasspy-skills
+    await run_in_threadpool(lambda: get_secret_hasher(get_settings()).key)
+
+
+@app.on_event("startup")
+async def recover_jobs():
+    # the jobs of a worker that was restarted are reported as failed, not running forever
+    await run_in_threadpool(lambda: get_jobs(get_settings()).recover())
+
+
+@app.on_event("startup")
+async def start_saving_metrics():
+    asyncio.ensure_future(save_metrics())
+
+
+@app.on_event("shutdown")
+async def close_rhasspy_client():
+    await get_rhasspy(get_settings()).aclose()
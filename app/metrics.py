@@ -0,0 +1,274 @@
+"""in-process metrics exported in the prometheus text format on /metrics.
+
+Every worker of the api keeps its own values and saves them periodically in the metrics
+directory, the /metrics endpoint sums the values saved by all the workers that are alive.
+"""
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Sequence, Tuple, TypeVar
+import copy
+import json
+import os
+import threading
+import time
+
+from app.storage import atomic_write
+
+LabelValues = Tuple[str, ...]
+M = TypeVar("M", bound="Metric")
+
+
+class Metric:
+    kind = ""
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[LabelValues, Any] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} requires the labels {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def snapshot(self) -> List[List[Any]]:
+        with self._lock:
+            return [[list(key), copy.deepcopy(value)] for key, value in self._values.items()]
+
+    def merge(self, total: Any, value: Any) -> Any:
+        raise NotImplementedError
+
+    def samples(self, key: LabelValues, value: Any) -> Iterable[Tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def format_labels(self, key: LabelValues, extra: str = "") -> str:
+        labels = [
+            '{}="{}"'.format(
+                name,
+                value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+            )
+            for name, value in zip(self.labelnames, key)
+        ]
+        if extra:
+            labels.append(extra)
+        return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def merge(self, total: Any, value: Any) -> Any:
+        return (total or 0) + value
+
+    def samples(self, key: LabelValues, value: Any) -> Iterable[Tuple[str, str, float]]:
+        yield self.name, self.format_labels(key), value
+
+
+class Histogram(Metric):
+    """the value of every label set is [counts per bucket, sum, count]"""
+
+    kind = "histogram"
+    # from the sub millisecond acl checks to the image builds
+    BUCKETS = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300
+    )
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key) or [
+                [0] * len(self.buckets),
+                0.0,
+                0,
+            ]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = [counts, total + value, count + 1]
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """observe the time spent in the block, also when it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        value = self._values.get(self._key(labels))
+        return value[2] if value else 0
+
+    def merge(self, total: Any, value: Any) -> Any:
+        if total is None:
+            return value
+        return [
+            [a + b for a, b in zip(total[0], value[0])],
+            total[1] + value[1],
+            total[2] + value[2],
+        ]
+
+    def samples(self, key: LabelValues, value: Any) -> Iterable[Tuple[str, str, float]]:
+        counts, total, count = value
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            yield self.name + "_bucket", self.format_labels(key, f'le="{bound}"'), cumulative
+        yield self.name + "_bucket", self.format_labels(key, 'le="+Inf"'), count
+        yield self.name + "_sum", self.format_labels(key), total
+        yield self.name + "_count", self.format_labels(key), count
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: M) -> M:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self) -> Dict[str, List[List[Any]]]:
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def save(self, directory: str):
+        """save the values of this process where the other workers can collect them"""
+        os.makedirs(directory, exist_ok=True)
+        atomic_write(
+            os.path.join(directory, f"{os.getpid()}.json"), json.dumps(self.snapshot())
+        )
+
+    def collect(
+        self, directory: str, max_age: float = 60
+    ) -> List[Dict[str, List[List[Any]]]]:
+        """return the values of this process and the ones saved by the other workers.
+
+        The files not updated for max_age seconds belong to workers that are gone and are removed.
+        """
+        snapshots = [self.snapshot()]
+        if not os.path.isdir(directory):
+            return snapshots
+        for file_name in os.listdir(directory):
+            if not file_name.endswith(".json") or file_name == f"{os.getpid()}.json":
+                continue
+            path = os.path.join(directory, file_name)
+            try:
+                if time.time() - os.path.getmtime(path) > max_age:
+                    os.remove(path)
+                    continue
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def render(self, snapshots: Iterable[Dict[str, List[List[Any]]]]) -> str:
+        merged: Dict[str, Dict[LabelValues, Any]] = {name: {} for name in self.metrics}
+        for snapshot in snapshots:
+            for name, values in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is None:
+                    continue
+                for key, value in values:
+                    key = tuple(key)
+                    merged[name][key] = metric.merge(merged[name].get(key), value)
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for key, value in sorted(merged[name].items()):
+                for sample, labels, sample_value in metric.samples(key, value):
+                    lines.append(f"{sample}{labels} {sample_value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames))
+
+
+LOGIN_SECONDS = histogram(
+    "rhasspy_skills_login_seconds",
+    "duration of the mqtt login checks by result (keyed, cached, verified, denied, not_found)",
+    ["result"],
+)
+CREDENTIAL_CACHE = counter(
+    "rhasspy_skills_credential_cache_total", "credential cache lookups", ["result"]
+)
+ARGON2_SECONDS = histogram(
+    "rhasspy_skills_argon2_verify_seconds", "time spent verifying an argon2 hash"
+)
+AUTH_QUEUE_SECONDS = histogram(
+    "rhasspy_skills_auth_queue_seconds",
+    "time a password verification waited for a free auth thread",
+)
+ACL_SECONDS = histogram(
+    "rhasspy_skills_acl_seconds", "duration of the mqtt acl requests", ["endpoint"]
+)
+ACL_CHECKS = counter(
+    "rhasspy_skills_acl_checks_total",
+    "acl checks by verdict and by the type of the rule that allowed them",
+    ["verdict", "rule"],
+)
+STORE_READS = counter(
+    "rhasspy_skills_store_reads_total",
+    "skills store lookups served by the index (hit) or by reading the store (reload)",
+    ["result"],
+)
+STORE_RELOAD_SECONDS = histogram(
+    "rhasspy_skills_store_reload_seconds", "time spent reading and parsing the skills store"
+)
+DOCKER_SECONDS = histogram(
+    "rhasspy_skills_docker_seconds", "duration of the docker api calls", ["operation"]
+)
+DOCKER_TIMEOUTS = counter(
+    "rhasspy_skills_docker_timeouts_total",
+    "docker calls of the routes abandoned after their timeout",
+    ["operation"],
+)
+IMAGE_BUILD_SECONDS = histogram(
+    "rhasspy_skills_image_build_seconds", "duration of the skill image builds", ["result"]
+)
+IMAGE_PULL_SECONDS = histogram(
+    "rhasspy_skills_image_pull_seconds", "duration of the skill image pulls", ["result"]
+)
+RHASSPY_SECONDS = histogram(
+    "rhasspy_skills_rhasspy_request_seconds",
+    "duration of the rhasspy api round trips",
+    ["endpoint", "result"],
+)
+SKILL_WAKE_SECONDS = histogram(
+    "rhasspy_skills_wake_seconds",
+    "time from the intent of a hibernated skill to its delivery by result (connected, timeout)",
+    ["result"],
+)
+SKILL_HIBERNATIONS = counter(
+    "rhasspy_skills_hibernations_total", "idle skill containers stopped by app.hibernate"
+)
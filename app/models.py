@@ -1,5 +1,5 @@
-from typing import Dict, List, Optional
-from enum import IntEnum
+from typing import Any, Dict, List, Optional
+from enum import Enum, IntEnum
 from pydantic.main import BaseModel
 
 
@@ -14,8 +14,15 @@ class TopicAccess(IntEnum):
 class SkillModel(BaseModel):
     skill_name: str
     hashed_password: str
+    # argon2 or hmac-sha256, see app.auth
+    password_scheme: str = "argon2"
     start_on_boot: bool = False
     topic_access: Optional[Dict[str, TopicAccess]] = {}
+    # stopped when idle and started again by app.hibernate on its intents
+    hibernate: bool = False
+    # intents declared by its sentences.ini, None for the skills installed before they were
+    # recorded, these can still read every intent
+    intents: Optional[List[str]] = None
 
     class Config:
         use_enum_values = True
@@ -23,3 +30,61 @@ class SkillModel(BaseModel):
 
 class DBFile(BaseModel):
     skills: List[SkillModel]
+
+
+class AclCheck(BaseModel):
+    username: str
+    topic: str
+    acc: int
+
+
+class AclVerdict(BaseModel):
+    allowed: bool
+    # status code that /acl would have answered for the same check
+    status_code: int
+
+
+class JobStage(str, Enum):
+    QUEUED = "queued"
+    EXTRACT = "extract"
+    PULL = "pull"
+    BUILD = "build"
+    RUN = "run"
+    HEALTH = "health"
+    SWAP = "swap"
+    TRAIN = "train"
+    DONE = "done"
+
+
+class JobState(str, Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCESS = "success"
+    FAILED = "failed"
+
+
+class JobModel(BaseModel):
+    id: str
+    kind: str
+    stage: JobStage = JobStage.QUEUED
+    state: JobState = JobState.PENDING
+    created: float
+    finished: Optional[float]
+    log: List[str] = []
+    result: Optional[Dict[str, Any]]
+    error: Optional[Dict[str, Any]]
+    # the api worker running the job
+    worker: Optional[str]
+
+
+class TrainingRunModel(BaseModel):
+    id: int
+    # operations whose sentences were sent in this run
+    operations: List[str]
+    files: List[str]
+    state: JobState = JobState.PENDING
+    started: Optional[float]
+    finished: Optional[float]
+    error: Optional[Dict[str, Any]]
+    # the sentences were already deployed, rhasspy was not trained
+    skipped: bool = False
@@ -0,0 +1,288 @@
+from typing import Any, Dict, List, Optional
+import asyncio
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+
+import httpx
+from fastapi import status
+
+from app.metrics import RHASSPY_SECONDS
+from app.models import JobState, TrainingRunModel
+from app.routers.exceptions import SkillInstallException
+from app.storage import atomic_write
+
+logger = logging.getLogger(__name__)
+
+
+def sentences_digest(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+# errors raised before the request reached rhasspy
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class RhasspyClient:
+    """application wide http client for the rhasspy api.
+
+    Connections are pooled and kept alive between calls, the requests that failed to connect are
+    retried with an exponential backoff and the latency of every call is recorded per endpoint.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        timeout: float = 10,
+        train_timeout: float = 300,
+        retries: int = 2,
+        backoff: float = 0.5,
+    ) -> None:
+        self.url = url
+        self.timeout = timeout
+        # train and restart can take minutes on small devices
+        self.train_timeout = train_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.latency: Dict[str, Dict[str, float]] = {}
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.url,
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+            )
+        return self._client
+
+    async def post(self, endpoint: str, **kwargs: Any) -> httpx.Response:
+        if endpoint in ("train", "restart"):
+            kwargs.setdefault("timeout", self.train_timeout)
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                res = await self.client.post(endpoint, **kwargs)
+            except httpx.TransportError as e:
+                self._record(endpoint, time.perf_counter() - start, error=True)
+                # the posts are not idempotent, a request rhasspy may have received, e.g. a train
+                # that timed out while reading the answer, must not be sent again
+                if attempt >= self.retries or not isinstance(e, RETRYABLE_ERRORS):
+                    raise
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+                continue
+            self._record(endpoint, time.perf_counter() - start)
+            return res
+
+    def _record(self, endpoint: str, elapsed: float, error: bool = False):
+        stats = self.latency.setdefault(
+            endpoint, {"count": 0, "errors": 0, "total": 0.0, "max": 0.0}
+        )
+        stats["count"] += 1
+        stats["errors"] += int(error)
+        stats["total"] += elapsed
+        stats["max"] = max(stats["max"], elapsed)
+        RHASSPY_SECONDS.observe(
+            elapsed, endpoint=endpoint, result="error" if error else "success"
+        )
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class TrainingScheduler:
+    """merges the sentences of many operations into a single rhasspy training.
+
+    Every submit resets a quiet window, once no operation was submitted for quiet_window seconds
+    all the pending sentences are sent with one sentences request followed by one train and one
+    restart. The runs are serialized, operations submitted while rhasspy is training are merged
+    into the next run. With lock_path the runs are serialized also with the other processes.
+
+    With state_path the digests of the deployed sentences files are recorded, files already
+    deployed with the same content are not sent again and when none is left rhasspy is not
+    trained at all.
+    """
+
+    def __init__(
+        self,
+        rhasspy: RhasspyClient,
+        quiet_window: float = 2,
+        keep_runs: int = 20,
+        lock_path: Optional[str] = None,
+        state_path: Optional[str] = None,
+    ) -> None:
+        self.rhasspy = rhasspy
+        self.lock_path = lock_path
+        # digests of the sentences files deployed on rhasspy
+        self.state_path = state_path
+        self.quiet_window = quiet_window
+        self.keep_runs = keep_runs
+        self.runs: List[TrainingRunModel] = []
+        self._sentences: Dict[str, str] = {}
+        self._operations: List[str] = []
+        self._waiters: List["asyncio.Future[TrainingRunModel]"] = []
+        self._deadline = 0.0
+        self._flusher: Optional["asyncio.Task[None]"] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._next_id = 1
+
+    async def submit(self, operation: str, sentences: Dict[str, str]) -> TrainingRunModel:
+        """queue the sentences files of an operation and wait for the training that includes them
+
+        Args:
+            operation (str): label reported in the run
+            sentences (Dict[str, str]): sentences files by rhasspy path, empty to remove them
+
+        Raises:
+            SkillInstallException: if the training failed
+        """
+        loop = asyncio.get_event_loop()
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        deployed = self.deployed()
+        # a file waiting in the batch may be replaced, it must be sent even if unchanged
+        sentences = {
+            path: text
+            for path, text in sentences.items()
+            if path in self._sentences or deployed.get(path) != sentences_digest(text)
+        }
+        if not sentences:
+            now = time.time()
+            run = TrainingRunModel(
+                id=self._next_id,
+                operations=[operation],
+                files=[],
+                state=JobState.SUCCESS,
+                started=now,
+                finished=now,
+                skipped=True,
+            )
+            self._next_id += 1
+            self.runs.append(run)
+            del self.runs[: -self.keep_runs]
+            return run
+        self._sentences.update(sentences)
+        self._operations.append(operation)
+        waiter = loop.create_future()
+        self._waiters.append(waiter)
+        self._deadline = loop.time() + self.quiet_window
+        if self._flusher is None:
+            self._flusher = asyncio.ensure_future(self._flush())
+        return await asyncio.shield(waiter)
+
+    async def _flush(self):
+        loop = asyncio.get_event_loop()
+        delay = self._deadline - loop.time()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self._deadline - loop.time()
+        # from now on submits start a new batch
+        sentences, operations, waiters = self._sentences, self._operations, self._waiters
+        self._sentences, self._operations, self._waiters = {}, [], []
+        self._flusher = None
+        run = TrainingRunModel(
+            id=self._next_id, operations=operations, files=list(sentences)
+        )
+        self._next_id += 1
+        self.runs.append(run)
+        del self.runs[: -self.keep_runs]
+        async with self._lock:
+            run.state = JobState.RUNNING
+            run.started = time.time()
+            try:
+                await self._train_exclusive(sentences)
+            except Exception as e:
+                if not isinstance(e, SkillInstallException):
+                    e = SkillInstallException(
+                        status.HTTP_424_FAILED_DEPENDENCY,
+                        detail=f"rhasspy training failed: {e}",
+                        error_code="rhasspy_error",
+                    )
+                run.state = JobState.FAILED
+                run.error = {
+                    "status_code": e.status_code,
+                    "detail": e.detail,
+                    "error_code": e.error_code,
+                }
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+                return
+            finally:
+                run.finished = time.time()
+            run.state = JobState.SUCCESS
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(run)
+
+    def deployed(self) -> Dict[str, str]:
+        """digests of the sentences files by path as they were last sent to rhasspy"""
+        if self.state_path is None or not os.path.isfile(self.state_path):
+            return {}
+        try:
+            with open(self.state_path, "r") as f:
+                return json.load(f)["sentences"]
+        except (OSError, ValueError, KeyError):
+            logger.warning("ignoring the corrupted rhasspy state %s", self.state_path)
+            return {}
+
+    def _save_deployed(self, sentences: Dict[str, str]):
+        if self.state_path is None:
+            return
+        deployed = self.deployed()
+        deployed.update(
+            {path: sentences_digest(text) for path, text in sentences.items()}
+        )
+        atomic_write(self.state_path, json.dumps({"sentences": deployed}))
+
+    async def _train_exclusive(self, sentences: Dict[str, str]):
+        if self.lock_path is None:
+            await self._train(sentences)
+            self._save_deployed(sentences)
+            return
+        with open(self.lock_path, "a") as lock_file:
+            # the lock can be held for minutes by the training of another worker
+            await asyncio.get_event_loop().run_in_executor(
+                None, fcntl.flock, lock_file.fileno(), fcntl.LOCK_EX
+            )
+            try:
+                await self._train(sentences)
+                self._save_deployed(sentences)
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    async def _train(self, sentences: Dict[str, str]):
+        try:
+            res = await self.rhasspy.post(
+                "sentences",
+                headers=httpx.Headers({"Content-Type": "application/json"}),
+                json=sentences,
+            )
+            if res.status_code != 200:
+                logger.warning(
+                    "rhasspy refused the sentences status=%s response=%s",
+                    res.status_code,
+                    res.text,
+                )
+                raise SkillInstallException(
+                    status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail={"status_code": res.status_code, "response": res.text},
+                    error_code="rhasspy_error",
+                )
+            # train and restart rhasspy
+            await self.rhasspy.post("train")
+            await self.rhasspy.post("restart")
+        except httpx.HTTPError:
+            raise SkillInstallException(
+                status.HTTP_424_FAILED_DEPENDENCY,
+                detail="unable to comunicate with rhasspy",
+                error_code="rhasspy_unreachable",
+            )
@@ -0,0 +1,33 @@
+from typing import List
+from fastapi import APIRouter, Depends, HTTPException
+from ..dependencies import get_jobs, get_trainer
+from ..jobs import JobManager
+from ..models import JobModel, TrainingRunModel
+from ..rhasspy import TrainingScheduler
+
+jobs_router = APIRouter(
+    tags=["jobs"],
+    responses={
+        404: {"detail": "Job not found"},
+    },
+)
+
+
+@jobs_router.get("/jobs", response_model=List[JobModel])
+def get_jobs_list(jobs: JobManager = Depends(get_jobs)):
+    return [job.model for job in jobs.list()]
+
+
+@jobs_router.get("/jobs/{job_id}", response_model=JobModel)
+def get_job(job_id: str, since: int = 0, jobs: JobManager = Depends(get_jobs)):
+    """return the state of the job, only the log lines after since are included"""
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.model.copy(update={"log": job.model.log[since:]})
+
+
+@jobs_router.get("/trainings", response_model=List[TrainingRunModel])
+def get_trainings(trainer: TrainingScheduler = Depends(get_trainer)):
+    """the last rhasspy trainings and the operations that each one covered"""
+    return trainer.runs
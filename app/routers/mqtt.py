@@ -1,7 +1,36 @@
+from typing import List, Optional
 from fastapi import APIRouter, Depends, HTTPException, Response, Form, status
-from ..dependencies import get_db, ph
-from app.database import DB
-import re
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+from ..dependencies import (
+    auth_executor,
+    credential_cache,
+    get_auth_activity,
+    get_auth_db,
+    get_auth_hasher,
+    get_auth_settings,
+    get_auth_snapshot,
+    ph,
+)
+from app.auth import HMAC_SHA256, MIN_SECRET_LENGTH, SecretHasher
+from app.config import Settings
+from app.database import DB, StoreSnapshot
+from app.hibernate import INTENT_PREFIX, MANAGER_USERNAME, ActivityMarker, manager_password
+from app.metrics import (
+    ACL_CHECKS,
+    ACL_SECONDS,
+    ARGON2_SECONDS,
+    AUTH_QUEUE_SECONDS,
+    CREDENTIAL_CACHE,
+    LOGIN_SECONDS,
+)
+from app.models import AclCheck, AclVerdict, SkillModel, TopicAccess
+import asyncio
+import hmac
+import logging
+import time
+
+logger = logging.getLogger(__name__)
 
 mqtt_router = APIRouter(
     tags=["mqtt"],
@@ -13,62 +42,153 @@ mqtt_router = APIRouter(
 )
 
 
+def check_acl(
+    snapshot: StoreSnapshot,
+    username: str,
+    topic: str,
+    acc: int,
+    activity: Optional[ActivityMarker] = None,
+) -> int:
+    """evaluate a single acl check and return the status code of the answer.
+
+    The allowed checks of the hibernating skills are recorded as their activity.
+    """
+    if username == MANAGER_USERNAME:
+        if topic.startswith(INTENT_PREFIX):
+            ACL_CHECKS.inc(verdict="allow", rule="manager")
+            return status.HTTP_204_NO_CONTENT
+        ACL_CHECKS.inc(verdict="deny", rule="none")
+        return status.HTTP_403_FORBIDDEN
+    skill_acl = snapshot.get_acl(username)
+    if skill_acl is None:
+        ACL_CHECKS.inc(verdict="not_found", rule="none")
+        return status.HTTP_404_NOT_FOUND
+    rule = skill_acl.check(topic, acc)
+    if rule is None:
+        ACL_CHECKS.inc(verdict="deny", rule="none")
+        return status.HTTP_403_FORBIDDEN
+    ACL_CHECKS.inc(verdict="allow", rule=rule)
+    if activity is not None and skill_acl.skill.hibernate:
+        # the subscription to its intents tells a woken skill is connected again
+        activity.mark(
+            username,
+            force=acc == TopicAccess.SUBSCRIBE and topic.startswith(INTENT_PREFIX),
+        )
+    return status.HTTP_204_NO_CONTENT
+
+
+def verify_password(hashed_password: str, password: str, submitted: float):
+    # runs on the auth executor, submitted tells how long it waited for a thread
+    AUTH_QUEUE_SECONDS.observe(time.perf_counter() - submitted)
+    with ARGON2_SECONDS.time():
+        return ph.verify(hashed_password, password)
+
+
+def upgrade_password(db: DB, skill: SkillModel, password: str, hasher: SecretHasher):
+    """replace the argon2 hash of a verified generated password with its keyed digest"""
+    upgraded = skill.copy(
+        update={"hashed_password": hasher.hash(password), "password_scheme": HMAC_SHA256}
+    )
+    try:
+        if db.replace_skill(skill, upgraded):
+            logger.info("upgraded the password of skill=%s to %s", skill.skill_name, HMAC_SHA256)
+    except OSError as e:
+        logger.warning("password of skill=%s not upgraded: %s", skill.skill_name, e)
+
+
 @mqtt_router.post("/login")
-def login_mqtt(
+async def login_mqtt(
     username: str = Form(None),
     password: str = Form(""),
-    db: DB = Depends(get_db),
+    db: DB = Depends(get_auth_db),
+    snapshot: StoreSnapshot = Depends(get_auth_snapshot),
+    settings: Settings = Depends(get_auth_settings),
+    hasher: SecretHasher = Depends(get_auth_hasher),
 ):
     # TODO improve security
-    skill = db.get_skill(username)
+    start = time.perf_counter()
+    if username == MANAGER_USERNAME:
+        if hmac.compare_digest(password, manager_password(settings.store_directory)):
+            return
+        logger.info("login denied to the manager user")
+        raise HTTPException(status_code=401, detail="Incorrect password")
+    skill = snapshot.get_skill(username)
     if skill is None:
+        LOGIN_SECONDS.observe(time.perf_counter() - start, result="not_found")
         raise HTTPException(status_code=404, detail="Skill not found")
-    else:
-        try:
-            ph.verify(skill.hashed_password, password=password)
-        except Exception:
-            raise HTTPException(status_code=401, detail="Incorrect password")
+    if skill.password_scheme == HMAC_SHA256:
+        # a single digest, cheaper than a thread hop to the auth executor
+        if hasher.verify(skill.hashed_password, password):
+            LOGIN_SECONDS.observe(time.perf_counter() - start, result="keyed")
+            return
+        LOGIN_SECONDS.observe(time.perf_counter() - start, result="denied")
+        logger.info("login denied skill=%s", username)
+        raise HTTPException(status_code=401, detail="Incorrect password")
+    if credential_cache.check(username, password, skill.hashed_password):
+        CREDENTIAL_CACHE.inc(result="hit")
+        LOGIN_SECONDS.observe(time.perf_counter() - start, result="cached")
+        return
+    CREDENTIAL_CACHE.inc(result="miss")
+    try:
+        await asyncio.get_event_loop().run_in_executor(
+            auth_executor,
+            verify_password,
+            skill.hashed_password,
+            password,
+            time.perf_counter(),
+        )
+    except Exception:
+        LOGIN_SECONDS.observe(time.perf_counter() - start, result="denied")
+        logger.info("login denied skill=%s", username)
+        raise HTTPException(status_code=401, detail="Incorrect password")
+    credential_cache.add(username, password, skill.hashed_password)
+    LOGIN_SECONDS.observe(time.perf_counter() - start, result="verified")
+    if len(password) >= MIN_SECRET_LENGTH:
+        await run_in_threadpool(upgrade_password, db, skill, password, hasher)
 
 
 @mqtt_router.post("/acl")
-def acl_mqtt(
-    response: Response,
+async def acl_mqtt(
     username: str = Form(None),
     topic: str = Form(""),
     acc: str = Form(""),
-    db: DB = Depends(get_db),
+    snapshot: StoreSnapshot = Depends(get_auth_snapshot),
+    activity: ActivityMarker = Depends(get_auth_activity),
 ):
-    print(f" username: {username} topic {topic}, acc: {acc}")
-    skill = db.get_skill(username)
-    if skill is None:
+    logger.debug("acl check skill=%s topic=%s acc=%s", username, topic, acc)
+    with ACL_SECONDS.time(endpoint="acl"):
+        status_code = check_acl(snapshot, username, topic, int(acc), activity)
+    if status_code == status.HTTP_404_NOT_FOUND:
         raise HTTPException(status_code=404, detail="Skill not found")
-    match_intent_old = re.match(r"^hermes/intent/([^/]+)", topic)
-    if match_intent_old is not None:
-        # READ or SUBSCRIBE
-        if int(acc) == 1 or int(acc) == 4:
-            return Response(status_code=status.HTTP_204_NO_CONTENT)
-    match_intent = re.match(f"^hermes/intent/{username}/([^/]+)", topic)
-    if match_intent is not None:
-        # READ or SUBSCRIBE
-        if int(acc) == 1 or int(acc) == 4:
-            return Response(status_code=status.HTTP_204_NO_CONTENT)
-    match_dialogue = re.match(r"hermes/dialogueManager/([^/]+)", topic)
-    if match_dialogue is not None:
-        # WRITE
-        if int(acc) == 2:
-            return Response(status_code=status.HTTP_204_NO_CONTENT)
-    if skill.topic_access is None:
-        raise HTTPException(status_code=403, detail="topic forbidden")
-    # TODO change with regex
-    if topic in skill.topic_access:
-        if skill.topic_access[topic] != int(acc):
-            raise HTTPException(status_code=403, detail="topic forbidden")
-    else:
+    if status_code == status.HTTP_403_FORBIDDEN:
         raise HTTPException(status_code=403, detail="topic forbidden")
-    response.status_code = status.HTTP_204_NO_CONTENT
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+@mqtt_router.post("/acl/batch", response_model=List[AclVerdict])
+async def acl_batch_mqtt(
+    checks: List[AclCheck],
+    snapshot: StoreSnapshot = Depends(get_auth_snapshot),
+    activity: ActivityMarker = Depends(get_auth_activity),
+):
+    """evaluate many acl checks in one request, verdicts are returned in the same order"""
+    verdicts = []
+    with ACL_SECONDS.time(endpoint="batch"):
+        for check in checks:
+            status_code = check_acl(
+                snapshot, check.username, check.topic, check.acc, activity
+            )
+            verdicts.append(
+                {
+                    "allowed": status_code == status.HTTP_204_NO_CONTENT,
+                    "status_code": status_code,
+                }
+            )
+    # the verdicts are already valid, skip the response_model validation
+    return JSONResponse(verdicts)
 
 
 @mqtt_router.post("/superuser")
-def super_user_mqtt(username: str = Form("")):
-    print(f"SuperUser: {username}")
+async def super_user_mqtt(username: str = Form("")):
+    logger.info("superuser check refused skill=%s", username)
     raise HTTPException(status_code=403, detail="Superuser not allowed")
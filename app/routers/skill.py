@@ -1,20 +1,17 @@
+import json
+import logging
 import os
 import shutil
 import tarfile
-from socket import gethostname
-from typing import Callable, List, Union
-from urllib.parse import urljoin
-
-import httpx
-from app.models import SkillModel
-from docker.client import DockerClient
-from docker.models.containers import Container
-from docker.models.networks import Network
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+from app.models import JobState, SkillModel
 from docker.errors import ImageNotFound
 from fastapi import (
     APIRouter,
     File,
     HTTPException,
+    Query,
     Request,
     Response,
     UploadFile,
@@ -22,24 +19,36 @@ from fastapi import (
 )
 from fastapi.param_functions import Depends
 from fastapi.routing import APIRoute
-from pydantic import ValidationError
 from rhasspy_skills_cli.manifest import Manifest
+from starlette.concurrency import run_in_threadpool
 from starlette.responses import JSONResponse
 
+from ..archive import SkillArchive, copy_stream, split_bundle, temp_path
 from ..config import Settings
 from ..database import DB
+from ..containers import ContainerIndex
+from ..docker_gateway import DockerGateway
 from ..dependencies import (
-    create_skill,
-    get_container_by_skill_name,
+    credential_cache,
+    get_container_index,
     get_db,
-    get_docker,
+    get_docker_gateway,
+    get_jobs,
     get_settings,
     get_skill,
     get_skills_dir,
     get_temp_directory,
+    get_trainer,
 )
+from ..installer import SkillInstaller, open_skill_archive
+from ..intents import intent_index
+from ..upgrade import SkillUpgrader
+from ..jobs import JobManager
+from ..rhasspy import TrainingScheduler
 from .exceptions import SkillInstallException
 
+logger = logging.getLogger(__name__)
+
 
 class APIRouteExceptionHandling(APIRoute):
     def get_route_handler(self) -> Callable:
@@ -67,196 +76,262 @@ skill_router = APIRouter(
 
 
 @skill_router.get("/skills")
-def get_skills(db: DB = Depends(get_db)):
-    return db.get_skills()
+def get_skills(
+    request: Request,
+    with_status: bool = Query(False, alias="status"),
+    stats: bool = False,
+    db: DB = Depends(get_db),
+    containers: ContainerIndex = Depends(get_container_index),
+    settings: Settings = Depends(get_settings),
+):
+    """list the skills, with status also their container and with stats its resource usage.
+
+    The containers are served from the index kept current by the docker events. The response
+    has an ETag, a request with the same If-None-Match gets an empty 304 response.
+    """
+    skills = db.get_skills()
+    usage = containers.stats(settings.stats_ttl) if stats else {}
+    # the versions are per process, the pid keeps apart the ETags of different workers
+    parts = [os.getpid(), db.version, int(with_status), int(stats)]
+    if with_status or stats:
+        by_skill = containers.all()
+        parts.append(containers.version)
+    if stats:
+        parts.append(containers.stats_version)
+    etag = 'W/"{}"'.format("-".join(str(part) for part in parts))
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    if not (with_status or stats):
+        content = [json.loads(skill.json()) for skill in skills]
+    else:
+        content = []
+        for skill in skills:
+            item = json.loads(skill.json())
+            item["container"] = (
+                containers.status(skill.skill_name)
+                if skill.skill_name in by_skill
+                else None
+            )
+            if stats:
+                item["stats"] = usage.get(skill.skill_name)
+            content.append(item)
+    return JSONResponse(content, headers={"ETag": etag})
+
+
+@skill_router.get("/intents")
+def get_intents(db: DB = Depends(get_db)):
+    """the skills declaring every intent.
+
+    The skills installed before their intents were recorded are listed in unscoped, the broker
+    still delivers them all the intents.
+    """
+    skills = db.get_skills()
+    return {
+        "intents": intent_index(skills),
+        "unscoped": [skill.skill_name for skill in skills if skill.intents is None],
+    }
 
 
-@skill_router.post("/skills", responses={400: {"detail": "file is required"}})
+@skill_router.post(
+    "/skills",
+    status_code=status.HTTP_202_ACCEPTED,
+    responses={400: {"detail": "file is required"}},
+)
 async def install_skill(
     file: UploadFile = File(None),
     force: bool = False,
     db: DB = Depends(get_db),
-    docker: DockerClient = Depends(get_docker),
+    gateway: DockerGateway = Depends(get_docker_gateway),
     temp_directory: str = Depends(get_temp_directory),
     settings: Settings = Depends(get_settings),
     skill_dir=Depends(get_skills_dir),
+    jobs: JobManager = Depends(get_jobs),
+    trainer: TrainingScheduler = Depends(get_trainer),
     start_on_boot: bool = False,
+    wait: bool = False,
 ):
+    """validate the archive and install the skill in background.
+
+    The response contains the id of the install job that can be polled on /jobs/{job_id}.
+    With wait the response is sent only once the skill is installed.
+    """
     if file is None:
         raise SkillInstallException(
             status.HTTP_400_BAD_REQUEST,
             detail="file is required",
             error_code="file_required",
         )
-    file_path = os.path.join(temp_directory, file.filename)
-    with open(file_path, "wb") as f:
-        f.write(await file.read())
+    file_path = temp_path(temp_directory, file.filename)
+    await run_in_threadpool(
+        copy_stream, file.file, file_path, max_size=settings.max_archive_size
+    )
+    tar, manifest = await run_in_threadpool(open_skill_archive, file_path)
+    installer = SkillInstaller(db, gateway.docker, settings, skill_dir, jobs, trainer)
     try:
-        tar = tarfile.open(file_path, "r")
-
-    except tarfile.ReadError:
-        os.remove(file_path)
-        raise SkillInstallException(
-            status.HTTP_400_BAD_REQUEST,
-            detail="archive is in a invalid format",
-            error_code="invalid_archive",
-        )
-    if "manifest.json" not in tar.getnames():
+        installer.check_not_installed(manifest, force)
+    except SkillInstallException:
         tar.close()
         os.remove(file_path)
+        raise
+    job = installer.submit(tar, manifest, force, start_on_boot)
+    if wait:
+        await jobs.wait(job)
+        if job.model.state == JobState.FAILED:
+            job.raise_error()
+        return JSONResponse(status_code=status.HTTP_200_OK, content=job.model.result)
+    return {
+        "state": "pending",
+        "detail": f"installing {manifest.name}",
+        "job": job.id,
+    }
+
+
+@skill_router.post(
+    "/skills/bulk",
+    status_code=status.HTTP_202_ACCEPTED,
+    responses={400: {"detail": "file is required"}},
+)
+async def install_skills(
+    files: List[UploadFile] = File(None),
+    force: bool = False,
+    db: DB = Depends(get_db),
+    gateway: DockerGateway = Depends(get_docker_gateway),
+    temp_directory: str = Depends(get_temp_directory),
+    settings: Settings = Depends(get_settings),
+    skill_dir=Depends(get_skills_dir),
+    jobs: JobManager = Depends(get_jobs),
+    trainer: TrainingScheduler = Depends(get_trainer),
+    start_on_boot: bool = False,
+    wait: bool = False,
+):
+    """validate all the archives, then install them in parallel and train rhasspy once.
+
+    files can also be a single bundle, a tar of skill archives. Nothing is installed if one of the
+    archives is not valid. The response contains the id of the bulk job and of the install job
+    of every skill.
+    """
+    if not files:
         raise SkillInstallException(
             status.HTTP_400_BAD_REQUEST,
-            detail="the archive do not contain a manifest.json",
-            error_code="manifest_not_present",
-        )
-    manifest_tar = tar.extractfile("manifest.json")
-    try:
-        manifest = Manifest.parse_raw(manifest_tar.read())
-    except ValidationError as e:
-        tar.close()
-        os.remove(file_path)
-        raise SkillInstallException(
-            status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail=e.errors(),
-            error_code="invalid_manifest",
+            detail="file is required",
+            error_code="file_required",
         )
-    skill_path = os.path.join(skill_dir, manifest.slug)
+    uploads: List[Tuple[str, str]] = []
     try:
-        if not manifest.image and not ("Dockerfile" in tar.getnames()):
-            raise SkillInstallException(
-                status.HTTP_422_UNPROCESSABLE_ENTITY,
-                detail="no dockerfile and image detected",
-                error_code="image_not_present",
-            )
-        # TODO add multi language support
-        if "sentences.ini" not in tar.getnames():
-            raise SkillInstallException(
-                status.HTTP_422_UNPROCESSABLE_ENTITY,
-                detail="the archive do not contain a sentences.ini",
-                error_code="sentences_not_present",
+        for file in files:
+            file_path = temp_path(temp_directory, file.filename)
+            await run_in_threadpool(
+                copy_stream, file.file, file_path, max_size=settings.max_archive_size
             )
+            uploads.append((file.filename, file_path))
+    except SkillInstallException:
+        for _, file_path in uploads:
+            os.remove(file_path)
+        raise
+    if len(uploads) == 1:
+        try:
+            bundle = await run_in_threadpool(split_bundle, uploads[0][1], temp_directory)
+        except tarfile.ReadError:
+            bundle = None
+        if bundle is not None:
+            uploads = bundle
+
+    installer = SkillInstaller(db, gateway.docker, settings, skill_dir, jobs, trainer)
+    archives: List[Tuple[SkillArchive, Manifest]] = []
+    errors: Dict[str, Any] = {}
+    for name, file_path in uploads:
         try:
-            os.mkdir(skill_path)
-        except FileExistsError:
-            if force:
-                shutil.rmtree(skill_path)
-            else:
+            tar, manifest = await run_in_threadpool(open_skill_archive, file_path)
+        except SkillInstallException as e:
+            errors[name] = {"detail": e.detail, "error_code": e.error_code}
+            continue
+        archives.append((tar, manifest))
+        try:
+            if any(other.slug == manifest.slug for _, other in archives[:-1]):
                 raise SkillInstallException(
                     status.HTTP_422_UNPROCESSABLE_ENTITY,
-                    detail="skill with the same name already exist",
-                    error_code="skill_already_installed",
+                    detail=f"the skill {manifest.slug} is present more than once",
+                    error_code="duplicated_skill",
                 )
-        try:
-            tar.extractall(skill_path)
-        finally:
+            installer.check_not_installed(manifest, force)
+        except SkillInstallException as e:
+            errors[name] = {"detail": e.detail, "error_code": e.error_code}
+    if errors:
+        for tar, _ in archives:
             tar.close()
-            os.remove(file_path)
-        data_skill_path = os.path.join(skill_path, "data")
-        os.mkdir(data_skill_path)
-        config_skill_path = os.path.join(skill_path, "config.json")
-        if os.path.isfile(config_skill_path):
-            shutil.copy(config_skill_path, os.path.join(data_skill_path, "config.json"))
-        tag = "skill_" + manifest.slug
-        containers: List[Container] = docker.containers.list(all=True)
-        for container in containers:
-            if tag == container.name:
-                if force:
-                    container.remove(force=True)
-                else:
-                    raise SkillInstallException(
-                        status.HTTP_422_UNPROCESSABLE_ENTITY,
-                        detail=f"The container name {tag} is already in use by another container {container.id}",
-                        error_code="container_name_already_used",
-                    )
-        try:
-            docker.images.build(path=skill_path, tag=tag)
-        except Exception as e:
-            raise SkillInstallException(
-                status.HTTP_422_UNPROCESSABLE_ENTITY,
-                detail=f"failed to build image. Error: {str(e)}",
-                error_code="build_image",
-            )
+            os.remove(tar.path)
+        raise SkillInstallException(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=errors,
+            error_code="invalid_archives",
+        )
+    job, skill_jobs = installer.submit_bulk(archives, force, start_on_boot)
+    if wait:
+        await jobs.wait(job)
+        if job.model.state == JobState.FAILED:
+            job.raise_error()
+        return JSONResponse(status_code=status.HTTP_200_OK, content=job.model.result)
+    return {
+        "state": "pending",
+        "detail": f"installing {len(skill_jobs)} skills",
+        "job": job.id,
+        "jobs": {slug: skill_job.id for slug, skill_job in skill_jobs.items()},
+    }
 
-        try:
-            self_container: Container = docker.containers.get(gethostname())
-            mounts = docker.api.inspect_container(self_container.id)["Mounts"]
-            path_host = None
-            for mount in mounts:
-                if mount["Destination"] == "/data":
-                    path_host = mount["Source"]
-
-            bind_path = (
-                os.path.join(
-                    os.path.dirname(path_host),
-                    data_skill_path.replace("/", "", 1),
-                )
-                if path_host
-                else None
-            )
-            container: Container = docker.containers.run(
-                tag,
-                environment={
-                    "MQTT_PASS": create_skill(
-                        db, manifest.slug, manifest.topic_access, start_on_boot
-                    ),
-                    "MQTT_USER": manifest.slug,
-                },
-                network="mqtt-net",
-                detach=True,
-                name=tag,
-                labels={"skill_name": manifest.slug},
-                volumes={bind_path: {"bind": "/data", "mode": "rw"}},
-            )
-            if manifest.internet_access:
-                net_bridge: Network = docker.networks.list(names=["bridge"])[0]
-                net_bridge.connect(container)
-        except Exception as e:
-            raise SkillInstallException(
-                status.HTTP_422_UNPROCESSABLE_ENTITY,
-                detail=str(e),
-                error_code="container_creation",
-            )
-    except SkillInstallException as e:
-        print("Error cleaning up installation...")
-        tar.close()
-        if os.path.isfile(file_path):
-            os.remove(file_path)
-        if e.error_code != "skill_already_installed" and os.path.isdir(skill_path):
-            db.remove_skill(manifest.slug)
-            shutil.rmtree(skill_path)
-        raise
 
-    if manifest.auto_train:
-        # TODO add multi language support
-        sentences_file = os.path.join(skill_path, "sentences.ini")
-        async with httpx.AsyncClient() as client:
-            try:
-                res = await client.post(
-                    urljoin(settings.rhasspy_url, "sentences"),
-                    headers=httpx.Headers({"Content-Type": "application/json"}),
-                    json={
-                        f"intents/skills/{manifest.slug}/sentences.ini": open(
-                            sentences_file, "r"
-                        ).read()
-                    },
-                )
-            except Exception:
-                raise HTTPException(
-                    status.HTTP_424_FAILED_DEPENDENCY,
-                    detail="unable to comunicate with rhasspy",
-                )
-            if res.status_code != 200:
-                print(res.text)
-                raise HTTPException(
-                    status.HTTP_422_UNPROCESSABLE_ENTITY,
-                    detail={"status_code": res.status_code, "response": res.text},
-                )
-            # train and restart rhasspy
-            await client.post(urljoin(settings.rhasspy_url, "train"))
-            await client.post(urljoin(settings.rhasspy_url, "restart"))
+@skill_router.post(
+    "/skills/{skill_name}/upgrade",
+    status_code=status.HTTP_202_ACCEPTED,
+    responses={400: {"detail": "file is required"}, 404: {"detail": "skill not found"}},
+)
+async def upgrade_skill(
+    skill_name: str,
+    file: UploadFile = File(None),
+    db: DB = Depends(get_db),
+    gateway: DockerGateway = Depends(get_docker_gateway),
+    temp_directory: str = Depends(get_temp_directory),
+    settings: Settings = Depends(get_settings),
+    skill_dir=Depends(get_skills_dir),
+    jobs: JobManager = Depends(get_jobs),
+    trainer: TrainingScheduler = Depends(get_trainer),
+    skill: SkillModel = Depends(get_skill),
+    wait: bool = False,
+):
+    """upgrade the skill with a new archive while its container keeps running.
+
+    The data of the skill is kept, if the new container doesn't become healthy the skill is left
+    as it was.
+    """
+    if file is None:
+        raise SkillInstallException(
+            status.HTTP_400_BAD_REQUEST,
+            detail="file is required",
+            error_code="file_required",
+        )
+    file_path = temp_path(temp_directory, file.filename)
+    await run_in_threadpool(
+        copy_stream, file.file, file_path, max_size=settings.max_archive_size
+    )
+    tar, manifest = await run_in_threadpool(open_skill_archive, file_path)
+    if manifest.slug != skill_name:
+        tar.close()
+        os.remove(file_path)
+        raise SkillInstallException(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"the archive contains the skill {manifest.slug} and not {skill_name}",
+            error_code="skill_mismatch",
+        )
+    upgrader = SkillUpgrader(db, gateway.docker, settings, skill_dir, jobs, trainer)
+    job = upgrader.submit_upgrade(tar, manifest, skill)
+    if wait:
+        await jobs.wait(job)
+        if job.model.state == JobState.FAILED:
+            job.raise_error()
+        return JSONResponse(status_code=status.HTTP_200_OK, content=job.model.result)
     return {
-        "state": "success",
-        "detail": f"installed {manifest.name} in {os.path.dirname(bind_path)}",
+        "state": "pending",
+        "detail": f"upgrading {skill_name}",
+        "job": job.id,
     }
 
 
@@ -265,42 +340,36 @@ async def delete_skill(
     skill_name: str,
     force: bool = False,
     db: DB = Depends(get_db),
-    docker: DockerClient = Depends(get_docker),
-    settings: Settings = Depends(get_settings),
+    gateway: DockerGateway = Depends(get_docker_gateway),
+    trainer: TrainingScheduler = Depends(get_trainer),
     skills_dir = Depends(get_skills_dir),
     skill: SkillModel = Depends(get_skill)
 ):
-    container = get_container_by_skill_name(docker, skill_name)
+    container = await gateway.container(skill_name)
     if container:
         if not force:
-            container.stop()
-        container.remove(v=True, force=force)
+            await gateway.stop(container)
+        await gateway.remove(container, force=force)
     else:
-        print(f"No container found for {skill_name}")
-    # TODO add support for remote docker image
+        logger.warning("no container found for skill=%s", skill_name)
+    # the image pulled for the manifest keeps its own tag, so a reinstall won't download it
     tag = "skill_" + skill_name
     try:
-        docker.images.remove(tag, force=force)
+        await gateway.remove_image(tag, force=force)
     except ImageNotFound:
         if not force:
             raise
-    shutil.rmtree(os.path.join(skills_dir, skill_name))
-    db.remove_skill(skill_name)
-    try:
-        async with httpx.AsyncClient() as client:
-            await client.post(
-                urljoin(settings.rhasspy_url, "sentences"),
-                headers=httpx.Headers({"Content-Type": "application/json"}),
-                json={f"intents/skills/{skill_name}/sentences.ini": ""},
-            )
-            await client.post(urljoin(settings.rhasspy_url, "train"))
-            await client.post(urljoin(settings.rhasspy_url, "restart"))
-    except Exception:
-        raise HTTPException(
-            status.HTTP_424_FAILED_DEPENDENCY,
-            detail="unable to comunicate with rhasspy",
-        )
-    return {"state": "success", "detail": f"uninstalled {skill_name}"}
+    await run_in_threadpool(shutil.rmtree, os.path.join(skills_dir, skill_name))
+    await run_in_threadpool(db.remove_skill, skill_name)
+    credential_cache.invalidate(skill_name)
+    run = await trainer.submit(
+        f"delete {skill_name}", {f"intents/skills/{skill_name}/sentences.ini": ""}
+    )
+    return {
+        "state": "success",
+        "detail": f"uninstalled {skill_name}",
+        "training": run.dict(include={"id", "operations", "skipped"}),
+    }
 
 
 @skill_router.post(
@@ -311,13 +380,13 @@ async def stop_skill(
     skill_name: str,
     force: bool = False,
     db: DB = Depends(get_db),
-    docker: DockerClient = Depends(get_docker),
+    gateway: DockerGateway = Depends(get_docker_gateway),
     skill: SkillModel = Depends(get_skill)
 ):
-    container = get_container_by_skill_name(docker, skill_name)
+    container = await gateway.container(skill_name)
     if container:
         if container.status == "running":
-            container.kill() if force else container.stop()
+            await gateway.stop(container, force=force)
             return JSONResponse(
                 status_code=status.HTTP_200_OK,
                 content={
@@ -348,10 +417,10 @@ async def stop_skill(
 async def start_skill(
     skill_name: str,
     db: DB = Depends(get_db),
-    docker: DockerClient = Depends(get_docker),
+    gateway: DockerGateway = Depends(get_docker_gateway),
     skill: SkillModel = Depends(get_skill)
 ):
-    container = get_container_by_skill_name(docker, skill_name)
+    container = await gateway.container(skill_name)
     if container:
         if container.status == "running":
             return JSONResponse(
@@ -363,7 +432,7 @@ async def start_skill(
                 },
             )
         if container.status == "exited":
-            container.start()
+            await gateway.start(container)
             return JSONResponse(
                 status_code=status.HTTP_200_OK,
                 content={
@@ -378,6 +447,38 @@ async def start_skill(
     )
 
 
+@skill_router.post(
+    "/skills/{skill_name}/hibernate",
+    responses={
+        404: {"detail": "skill not found"},
+        409: {"detail": "skill changed while updating it"},
+    },
+)
+async def hibernate_skill(
+    skill_name: str,
+    enabled: bool = True,
+    db: DB = Depends(get_db),
+    skill: SkillModel = Depends(get_skill)
+):
+    """let app.hibernate stop the skill when idle and start it again on its intents"""
+    for _ in range(3):
+        updated = skill.copy(update={"hibernate": enabled})
+        if await run_in_threadpool(db.replace_skill, skill, updated):
+            break
+        # changed since it was read, e.g. its password was issued again
+        skill = await run_in_threadpool(db.get_skill, skill_name)
+        if skill is None:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, detail="skill not found")
+    else:
+        raise HTTPException(
+            status.HTTP_409_CONFLICT, detail="skill changed while updating it"
+        )
+    return {
+        "state": "success",
+        "detail": f"hibernation {'enabled' if enabled else 'disabled'} for {skill_name}",
+    }
+
+
 @skill_router.get(
     "/skills/{skill_name}",
     response_model=SkillModel,
@@ -1,25 +1,158 @@
-import docker as dc
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import logging
 import os
-from .models import DBFile
-from .dependencies import get_container_by_skill_name
-
-docker = dc.from_env()
-
-config = DBFile.parse_file(
-    os.path.join(os.environ.get("store_directory".upper(), "/data"), "store.json")
-)
-
-for skill in config.skills:
-    if skill.start_on_boot:
-        container = get_container_by_skill_name(docker, skill.skill_name)
-        # TODO create container if not present
-        if not container:
-            print(f"Skill {skill.skill_name} has not a container")
-            continue
-        if container.status != "running":
+import socket
+import time
+
+import docker as dc
+import httpx
+from docker.client import DockerClient
+from docker.errors import ImageNotFound
+from docker.models.containers import Container
+from rhasspy_skills_cli.manifest import Manifest
+
+from .auth import SecretHasher
+from .config import LOG_FORMAT, Settings
+from .containers import is_skill_container
+from .database import DB, create_backend
+from .dependencies import get_secret_hasher
+from .installer import run_skill_container
+from .models import SkillModel
+
+logger = logging.getLogger(__name__)
+
+
+def wait_ready(settings: Settings) -> bool:
+    """wait until the api answers and the broker accepts connections, at most boot_timeout seconds"""
+    deadline = time.monotonic() + settings.boot_timeout
+    api_ready = broker_ready = False
+    while time.monotonic() < deadline:
+        if not api_ready:
             try:
-                container.start()
-            except Exception:
-                print(
-                    f"failed to start container {container.id} of skill {skill.skill_name}"
-                )
+                api_ready = httpx.get(settings.api_url, timeout=1).status_code < 500
+            except httpx.HTTPError:
+                pass
+        if not broker_ready:
+            try:
+                socket.create_connection(
+                    (settings.broker_host, settings.broker_port), timeout=1
+                ).close()
+                broker_ready = True
+            except OSError:
+                pass
+        if api_ready and broker_ready:
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def recreate_container(
+    docker: DockerClient,
+    db: DB,
+    skills_dir: str,
+    skill: SkillModel,
+    hasher: Optional[SecretHasher] = None,
+):
+    """run a new container for a skill whose container was removed, its image must exist"""
+    tag = "skill_" + skill.skill_name
+    docker.images.get(tag)
+    skill_path = os.path.join(skills_dir, skill.skill_name)
+    manifest = Manifest.parse_file(os.path.join(skill_path, "manifest.json"))
+    run_skill_container(
+        docker,
+        db,
+        skill.skill_name,
+        tag,
+        os.path.join(skill_path, "data"),
+        skill.topic_access,
+        skill.start_on_boot,
+        manifest.internet_access,
+        intents=skill.intents,
+        hibernate=skill.hibernate,
+        hasher=hasher,
+    )
+
+
+def start_skill(
+    docker: DockerClient,
+    db: DB,
+    skills_dir: str,
+    skill: SkillModel,
+    container: Optional[Container],
+    hasher: Optional[SecretHasher] = None,
+) -> Tuple[str, str, float]:
+    start = time.perf_counter()
+    try:
+        if container is None:
+            try:
+                recreate_container(docker, db, skills_dir, skill, hasher)
+            except ImageNotFound:
+                logger.warning("skill %s has not a container nor an image", skill.skill_name)
+                return skill.skill_name, "missing", time.perf_counter() - start
+            state = "recreated"
+        elif skill.hibernate and container.status != "running":
+            # started by app.hibernate on its first intent
+            state = "hibernated"
+        elif container.status != "running":
+            container.start()
+            state = "started"
+        else:
+            state = "running"
+    except Exception as e:
+        logger.error("failed to start skill %s: %s", skill.skill_name, e)
+        state = "failed"
+    return skill.skill_name, state, time.perf_counter() - start
+
+
+def main():
+    settings = Settings()
+    logging.basicConfig(level=settings.log_level, format=LOG_FORMAT)
+    boot_start = time.perf_counter()
+    if not wait_ready(settings):
+        logger.warning("api or broker not ready, starting the skills anyway")
+    ready_time = time.perf_counter() - boot_start
+    docker = dc.from_env()
+    db = DB(backend=create_backend(settings.store_directory, settings.store_backend))
+    skills_dir = os.path.join(settings.store_directory, "skills")
+    containers: List[Container] = docker.containers.list(
+        all=True, sparse=True, filters={"label": "skill_name"}
+    )
+    by_skill: Dict[str, Container] = {
+        container.attrs["Labels"]["skill_name"]: container
+        for container in containers
+        if is_skill_container(container, container.attrs["Labels"]["skill_name"])
+    }
+    skills = [skill for skill in db.get_skills() if skill.start_on_boot]
+    hasher = get_secret_hasher(settings)
+    with ThreadPoolExecutor(max_workers=settings.boot_concurrency) as executor:
+        results = list(
+            executor.map(
+                lambda skill: start_skill(
+                    docker,
+                    db,
+                    skills_dir,
+                    skill,
+                    by_skill.get(skill.skill_name),
+                    hasher,
+                ),
+                skills,
+            )
+        )
+    for skill_name, state, elapsed in results:
+        logger.info("%-30s %-10s %.2fs", skill_name, state, elapsed)
+    counts: Dict[str, int] = {}
+    for _, state, _ in results:
+        counts[state] = counts.get(state, 0) + 1
+    summary = ", ".join(f"{count} {state}" for state, count in sorted(counts.items()))
+    logger.info(
+        "booted %d skills in %.2fs (waited %.2fs for api and broker): %s",
+        len(skills),
+        time.perf_counter() - boot_start,
+        ready_time,
+        summary or "nothing to do",
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+from abc import ABC, abstractmethod
+from app.models import DBFile, SkillModel
+from contextlib import contextmanager
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Dict,
+    Hashable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+def fsync_dir(path: str):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path: str, content: str):
+    """write the file through a temporary file and a rename, a crash leaves the old or new content"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(path)
+
+
+def read_or_create_secret(path: str, create: Callable[[], str]) -> str:
+    """read a secret only readable by its owner, the first process that needs it creates it"""
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(create())
+    try:
+        # fails if another process created it in the meantime, its secret wins
+        os.link(tmp_path, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp_path)
+    with open(path) as f:
+        return f.read().strip()
+
+
+class StoreBackend(ABC):
+    """how the skills are persisted, DB keeps the in-memory index on top of it.
+
+    read, put and delete must be called inside reading or writing, writing excludes every
+    other reader and writer of the store, also from other processes.
+    """
+
+    @abstractmethod
+    def signature(self) -> Hashable:
+        """cheap token that changes when another process modifies the store"""
+
+    @abstractmethod
+    def reading(self) -> ContextManager[None]:
+        """shared access to the store"""
+
+    @abstractmethod
+    def writing(self) -> ContextManager[None]:
+        """exclusive access to the store"""
+
+    @abstractmethod
+    def read(self) -> Dict[str, SkillModel]:
+        pass
+
+    @abstractmethod
+    def put(self, skill: SkillModel):
+        pass
+
+    @abstractmethod
+    def delete(self, skill_name: str):
+        pass
+
+    @abstractmethod
+    def replace(self, skills: List[SkillModel]):
+        pass
+
+
+class JsonBackend(StoreBackend):
+    """json snapshot plus an append-only journal of the later changes.
+
+    Every write appends a single line to the journal, once compact_every entries are appended the
+    journal is merged in a new snapshot that replaces the old one with an atomic rename. Writers
+    of every process take an exclusive lock on path.lock, readers take a shared one.
+    """
+
+    def __init__(self, path: str, compact_every: int = 100) -> None:
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.lock_path = path + ".lock"
+        self.compact_every = compact_every
+        self.journal_entries = 0
+        if not os.path.isfile(path):
+            logger.info("generating the skills store %s", path)
+            par_dir = os.path.dirname(path)
+            if not os.path.exists(par_dir):
+                os.makedirs(par_dir, exist_ok=True)
+            with self.writing():
+                if not os.path.isfile(path):
+                    atomic_write(path, DBFile(skills=[]).json())
+
+    @contextmanager
+    def _file_lock(self, operation: int) -> Iterator[None]:
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f.fileno(), operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def reading(self):
+        return self._file_lock(fcntl.LOCK_SH)
+
+    def writing(self):
+        return self._file_lock(fcntl.LOCK_EX)
+
+    def signature(self) -> Tuple[int, ...]:
+        st = os.stat(self.path)
+        try:
+            journal = os.stat(self.journal_path)
+            journal_signature: Tuple[int, ...] = (
+                journal.st_ino,
+                journal.st_mtime_ns,
+                journal.st_size,
+            )
+        except FileNotFoundError:
+            journal_signature = ()
+        return (st.st_ino, st.st_mtime_ns, st.st_size) + journal_signature
+
+    def read(self) -> Dict[str, SkillModel]:
+        index = {skill.skill_name: skill for skill in DBFile.parse_file(self.path).skills}
+        entries = 0
+        if os.path.isfile(self.journal_path):
+            with open(self.journal_path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn write of the last entry
+                        logger.warning("ignoring corrupted journal entry")
+                        continue
+                    if entry["op"] == "put":
+                        skill = SkillModel.parse_obj(entry["skill"])
+                        index[skill.skill_name] = skill
+                    elif entry["op"] == "delete":
+                        index.pop(entry["skill_name"], None)
+                    entries += 1
+        self.journal_entries = entries
+        return index
+
+    def put(self, skill: SkillModel):
+        self._append({"op": "put", "skill": json.loads(skill.json())})
+
+    def delete(self, skill_name: str):
+        self._append({"op": "delete", "skill_name": skill_name})
+
+    def replace(self, skills: List[SkillModel]):
+        self._compact({skill.skill_name: skill for skill in skills})
+
+    def compact(self):
+        """merge the journal in a new snapshot"""
+        with self.writing():
+            self._compact(self.read())
+
+    def _append(self, entry: Dict[str, Any]):
+        self._repair_journal()
+        with open(self.journal_path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_entries += 1
+        if self.journal_entries >= self.compact_every:
+            self._compact(self.read())
+
+    def _repair_journal(self):
+        """drop a torn last entry so the next one starts on a new line"""
+        if not os.path.isfile(self.journal_path) or not os.path.getsize(self.journal_path):
+            return
+        with open(self.journal_path, "rb+") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.seek(0)
+                f.truncate(f.read().rfind(b"\n") + 1)
+
+    def _compact(self, index: Dict[str, SkillModel]):
+        atomic_write(self.path, DBFile(skills=list(index.values())).json())
+        # a crash before the truncation only replays entries already in the snapshot
+        with open(self.journal_path, "w") as f:
+            os.fsync(f.fileno())
+        self.journal_entries = 0
+
+
+class SqliteBackend(StoreBackend):
+    """sqlite database in WAL mode, safe for concurrent readers and writers of many processes.
+
+    The topic_access of the skills is kept in its own table, the fields without a column are
+    stored as json in extra. When the database is created the skills of migrate_from, the json
+    store, are imported and the json file is renamed with the .migrated suffix.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS skills (
+        id INTEGER PRIMARY KEY,
+        skill_name TEXT NOT NULL,
+        hashed_password TEXT NOT NULL,
+        start_on_boot INTEGER NOT NULL DEFAULT 0,
+        -- 0 when topic_access is null
+        has_topic_access INTEGER NOT NULL DEFAULT 1,
+        extra TEXT NOT NULL DEFAULT '{}'
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS skills_skill_name ON skills (skill_name);
+    CREATE TABLE IF NOT EXISTS topic_access (
+        skill_id INTEGER NOT NULL REFERENCES skills (id) ON DELETE CASCADE,
+        topic TEXT NOT NULL,
+        access INTEGER NOT NULL,
+        PRIMARY KEY (skill_id, topic)
+    );
+    """
+    COLUMNS = {"skill_name", "hashed_password", "start_on_boot", "topic_access"}
+
+    def __init__(self, path: str, migrate_from: Optional[str] = None) -> None:
+        self.path = path
+        par_dir = os.path.dirname(path)
+        if par_dir and not os.path.exists(par_dir):
+            os.makedirs(par_dir, exist_ok=True)
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        with self.writing():
+            if self.conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+                for statement in self.SCHEMA.split(";"):
+                    if statement.strip():
+                        self.conn.execute(statement)
+                if migrate_from:
+                    self._migrate(migrate_from)
+                self.conn.execute("PRAGMA user_version=1")
+        # signature() is called on the event loop, it reads data_version on its own connection so
+        # it never waits for a transaction of this process, that can wait 30s for other workers
+        self._version_conn = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._version_lock = threading.Lock()
+
+    def _migrate(self, json_path: str):
+        if not os.path.isfile(json_path):
+            return
+        json_store = JsonBackend(json_path)
+        with json_store.reading():
+            skills = list(json_store.read().values())
+        for skill in skills:
+            self.put(skill)
+        logger.info("migrated %d skills from %s", len(skills), json_path)
+        for path in (json_path, json_store.journal_path):
+            if os.path.isfile(path):
+                os.replace(path, path + ".migrated")
+
+    @contextmanager
+    def _transaction(self, begin: str) -> Iterator[None]:
+        with self._lock:
+            self.conn.execute(begin)
+            try:
+                yield
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def reading(self):
+        return self._transaction("BEGIN")
+
+    def writing(self):
+        return self._transaction("BEGIN IMMEDIATE")
+
+    def signature(self) -> int:
+        # data_version changes when another connection commits, also the writer of this process,
+        # so a write of this process costs one more read of the store
+        with self._version_lock:
+            return self._version_conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def read(self) -> Dict[str, SkillModel]:
+        topic_access: Dict[int, Dict[str, int]] = {}
+        for skill_id, topic, access in self.conn.execute(
+            "SELECT skill_id, topic, access FROM topic_access"
+        ):
+            topic_access.setdefault(skill_id, {})[topic] = access
+        index = {}
+        for row in self.conn.execute(
+            "SELECT id, skill_name, hashed_password, start_on_boot, has_topic_access, extra"
+            " FROM skills"
+        ):
+            skill_id, skill_name, hashed_password, start_on_boot, has_topic_access, extra = row
+            index[skill_name] = SkillModel(
+                skill_name=skill_name,
+                hashed_password=hashed_password,
+                start_on_boot=bool(start_on_boot),
+                topic_access=topic_access.get(skill_id, {}) if has_topic_access else None,
+                **json.loads(extra),
+            )
+        return index
+
+    def put(self, skill: SkillModel):
+        self.delete(skill.skill_name)
+        extra = json.loads(skill.json(exclude=self.COLUMNS))
+        cursor = self.conn.execute(
+            "INSERT INTO skills (skill_name, hashed_password, start_on_boot, has_topic_access,"
+            " extra) VALUES (?, ?, ?, ?, ?)",
+            (
+                skill.skill_name,
+                skill.hashed_password,
+                int(skill.start_on_boot),
+                int(skill.topic_access is not None),
+                json.dumps(extra),
+            ),
+        )
+        self.conn.executemany(
+            "INSERT INTO topic_access (skill_id, topic, access) VALUES (?, ?, ?)",
+            [
+                (cursor.lastrowid, topic, int(access))
+                for topic, access in (skill.topic_access or {}).items()
+            ],
+        )
+
+    def delete(self, skill_name: str):
+        self.conn.execute("DELETE FROM skills WHERE skill_name = ?", (skill_name,))
+
+    def replace(self, skills: List[SkillModel]):
+        self.conn.execute("DELETE FROM skills")
+        for skill in skills:
+            self.put(skill)
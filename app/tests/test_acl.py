@@ -0,0 +1,66 @@
+import pathlib
+
+from ..acl import SkillAcl, TopicTrie
+from ..intents import intent_index, skill_intents
+from ..models import SkillModel, TopicAccess
+
+
+def test_topic_trie_wildcards():
+    trie = TopicTrie()
+    trie.add("a/+/c", ("single", frozenset()))
+    trie.add("a/#", ("multi", frozenset()))
+    trie.add("a/b", ("exact", frozenset()))
+    assert {name for name, _ in trie.match("a/b")} == {"multi", "exact"}
+    assert {name for name, _ in trie.match("a/x/c")} == {"single", "multi"}
+    assert {name for name, _ in trie.match("a")} == {"multi"}
+    assert trie.match("b/a") == []
+
+
+def test_skill_acl():
+    acl = SkillAcl(
+        SkillModel(
+            skill_name="weather",
+            hashed_password="",
+            topic_access={
+                "weather/+/state": TopicAccess.READWRITE,
+                "weather/#": TopicAccess.SUBSCRIBE,
+                "weather/secret": TopicAccess.DENY,
+                "hermes/tts/say": TopicAccess.WRITE,
+            },
+        )
+    )
+    assert acl.check("hermes/intent/GetWeather", TopicAccess.SUBSCRIBE) == "intent"
+    assert acl.check("hermes/intent/GetWeather", TopicAccess.WRITE) is None
+    assert acl.check("hermes/dialogueManager/endSession", TopicAccess.WRITE) == "dialogue"
+    assert acl.check("hermes/tts/say", TopicAccess.WRITE) == "topic_access"
+    assert acl.check("hermes/tts/say", TopicAccess.READ) is None
+    assert acl.check("weather/kitchen/state", TopicAccess.READ) == "topic_access"
+    assert acl.check("weather/kitchen/state", TopicAccess.WRITE) == "topic_access"
+    assert acl.check("weather/kitchen", TopicAccess.SUBSCRIBE) == "topic_access"
+    assert acl.check("weather/secret", TopicAccess.SUBSCRIBE) is None
+    assert acl.check("other/topic", TopicAccess.READ) is None
+
+
+def test_skill_acl_intents():
+    acl = SkillAcl(
+        SkillModel(skill_name="weather", hashed_password="", intents=["GetWeather"])
+    )
+    assert acl.check("hermes/intent/#", TopicAccess.SUBSCRIBE) == "intent_subscribe"
+    assert acl.check("hermes/intent/GetWeather", TopicAccess.SUBSCRIBE) == "intent"
+    assert acl.check("hermes/intent/GetWeather", TopicAccess.READ) == "intent"
+    # the broker doesn't deliver the intents of the other skills
+    assert acl.check("hermes/intent/GetTime", TopicAccess.READ) is None
+    assert acl.check("hermes/intent/weather/reload", TopicAccess.READ) == "skill_intent"
+
+
+def test_intent_index(tmp_path: pathlib.Path):
+    path = tmp_path / "sentences.ini"
+    path.write_text("[GetTime]\nwhat time is it\n[SetTimer]\nset a timer\n[GetTime]\n")
+    assert skill_intents(path.as_posix()) == ["GetTime", "SetTimer"]
+    assert skill_intents((tmp_path / "missing.ini").as_posix()) == []
+    skills = [
+        SkillModel(skill_name="time", hashed_password="", intents=["GetTime", "SetTimer"]),
+        SkillModel(skill_name="clock", hashed_password="", intents=["GetTime"]),
+        SkillModel(skill_name="legacy", hashed_password=""),
+    ]
+    assert intent_index(skills) == {"GetTime": ["time", "clock"], "SetTimer": ["time"]}
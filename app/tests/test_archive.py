@@ -0,0 +1,104 @@
+import io
+import pathlib
+import tarfile
+from typing import Optional
+
+import pytest
+
+from ..archive import SkillArchive, UnsafeArchiveError, copy_stream, split_bundle, temp_path
+from ..installer import open_skill_archive
+from ..routers.exceptions import SkillInstallException
+
+
+def write_tar(path: pathlib.Path, members: dict, links: Optional[dict] = None) -> str:
+    """a tar with the files of members and the symlinks of links, both by name"""
+    with tarfile.open(path, "w") as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        for name, target in (links or {}).items():
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.SYMTYPE
+            info.linkname = target
+            tar.addfile(info)
+    return path.as_posix()
+
+
+def test_copy_stream(tmp_path: pathlib.Path):
+    path = (tmp_path / "upload.tar").as_posix()
+    copy_stream(io.BytesIO(b"x" * 10), path, chunk_size=3, max_size=10)
+    assert pathlib.Path(path).read_bytes() == b"x" * 10
+
+
+def test_copy_stream_size_limit(tmp_path: pathlib.Path):
+    path = tmp_path / "upload.tar"
+    with pytest.raises(SkillInstallException) as e:
+        copy_stream(io.BytesIO(b"x" * 11), path.as_posix(), chunk_size=3, max_size=10)
+    assert e.value.status_code == 413
+    assert e.value.error_code == "archive_too_large"
+    # the partial upload is removed
+    assert not path.exists()
+
+
+def test_temp_path(tmp_path: pathlib.Path):
+    first = temp_path(tmp_path.as_posix(), "../../skill.tar")
+    assert pathlib.Path(first).parent == tmp_path
+    assert first.endswith("_skill.tar")
+    assert temp_path(tmp_path.as_posix(), "skill.tar") != temp_path(
+        tmp_path.as_posix(), "skill.tar"
+    )
+
+
+def test_skill_archive_index(tmp_path: pathlib.Path):
+    path = write_tar(
+        tmp_path / "skill.tar",
+        {"./manifest.json": b"{}", "app/main.py": b"print()"},
+        {"app/current": "main.py"},
+    )
+    archive = SkillArchive(path)
+    assert "manifest.json" in archive
+    assert archive.read("app/main.py") == b"print()"
+    archive.extract((tmp_path / "skill").as_posix())
+    archive.close()
+    assert (tmp_path / "skill" / "manifest.json").read_bytes() == b"{}"
+
+
+@pytest.mark.parametrize(
+    "members,links",
+    [
+        ({"../evil.py": b""}, {}),
+        ({"app/../../evil.py": b""}, {}),
+        ({"/etc/cron.d/evil": b""}, {}),
+        ({}, {"app/data": "../../.."}),
+        ({}, {"app/data": "/etc"}),
+    ],
+)
+def test_skill_archive_path_traversal(tmp_path: pathlib.Path, members: dict, links: dict):
+    path = write_tar(tmp_path / "skill.tar", {"manifest.json": b"{}", **members}, links)
+    with pytest.raises(UnsafeArchiveError):
+        SkillArchive(path)
+
+
+def test_unsafe_archive_removed(tmp_path: pathlib.Path):
+    path = write_tar(tmp_path / "skill.tar", {"manifest.json": b"{}", "../evil.py": b""})
+    with pytest.raises(SkillInstallException) as e:
+        open_skill_archive(path)
+    assert e.value.error_code == "unsafe_archive"
+    assert not pathlib.Path(path).exists()
+
+
+def test_split_bundle(tmp_path: pathlib.Path):
+    skill = pathlib.Path(write_tar(tmp_path / "clock.tar", {"manifest.json": b"{}"}))
+    bundle = write_tar(tmp_path / "bundle.tar", {"skills/clock.tar": skill.read_bytes()})
+    (tmp_path / "extracted").mkdir()
+
+    archives = split_bundle(bundle, (tmp_path / "extracted").as_posix())
+
+    [(name, path)] = archives
+    assert name == "skills/clock.tar"
+    assert pathlib.Path(path).parent == tmp_path / "extracted"
+    assert pathlib.Path(path).read_bytes() == skill.read_bytes()
+    # the bundle is removed, a skill archive is not a bundle
+    assert not pathlib.Path(bundle).exists()
+    assert split_bundle(skill.as_posix(), (tmp_path / "extracted").as_posix()) is None
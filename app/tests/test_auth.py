@@ -0,0 +1,38 @@
+import pathlib
+
+from ..auth import CredentialCache, SecretHasher
+
+
+def test_credential_cache():
+    cache = CredentialCache(max_size=2, ttl=60)
+    assert not cache.check("weather", "secret", "hash")
+    cache.add("weather", "secret", "hash")
+    assert cache.check("weather", "secret", "hash")
+    assert not cache.check("weather", "wrong", "hash")
+    # the password was re-issued
+    assert not cache.check("weather", "secret", "new_hash")
+    cache.add("weather", "secret", "hash")
+    cache.invalidate("weather")
+    assert not cache.check("weather", "secret", "hash")
+    for name in ("a", "b", "c"):
+        cache.add(name, "secret", "hash")
+    assert not cache.check("a", "secret", "hash")
+    assert cache.check("c", "secret", "hash")
+    assert cache.stats() == {"hits": 2, "misses": 5, "size": 2}
+
+
+def test_credential_cache_expire():
+    cache = CredentialCache(ttl=-1)
+    cache.add("weather", "secret", "hash")
+    assert not cache.check("weather", "secret", "hash")
+
+
+def test_secret_hasher(tmp_path: pathlib.Path):
+    key_path = (tmp_path / "credential.key").as_posix()
+    hasher = SecretHasher(key_path)
+    hashed = hasher.hash("secret")
+    assert hasher.verify(hashed, "secret")
+    assert not hasher.verify(hashed, "wrong")
+    # another process reads the same key
+    assert SecretHasher(key_path).verify(hashed, "secret")
+    assert not SecretHasher((tmp_path / "other.key").as_posix()).verify(hashed, "secret")
@@ -0,0 +1,191 @@
+import pathlib
+import threading
+from unittest.mock import Mock
+
+from docker.models.containers import Container
+from fastapi.testclient import TestClient
+
+from ..containers import ContainerIndex
+from ..database import DB
+from ..dependencies import get_container_index, get_db
+from ..main import app
+from ..models import SkillModel
+
+client = TestClient(app)
+
+
+def skill_event(
+    action: str, container_id: str, skill_name: str = "weather", name: str = "skill_weather"
+) -> dict:
+    return {
+        "Type": "container",
+        "Action": action,
+        "id": container_id,
+        "Actor": {"ID": container_id, "Attributes": {"skill_name": skill_name, "name": name}},
+    }
+
+
+def test_container_index_follows_events():
+    docker = Mock()
+    docker.containers.list.return_value = [
+        Container(
+            {
+                "Id": "1",
+                "Names": ["/skill_weather"],
+                "State": "exited",
+                "Labels": {"skill_name": "weather"},
+            }
+        ),
+        # left by an upgrade that failed
+        Container(
+            {
+                "Id": "3",
+                "Names": ["/skill_weather_next"],
+                "State": "exited",
+                "Labels": {"skill_name": "weather"},
+            }
+        ),
+    ]
+    docker.events.return_value = iter(
+        [skill_event("start", "1"), skill_event("exec_start: ls", "1")]
+    )
+    index = ContainerIndex(docker)
+    index.start()
+    index._thread.join()
+    assert index.containers["weather"].id == "1"
+    assert index.containers["weather"].status == "running"
+    docker.containers.list.assert_called_once()
+
+    index.handle_event(skill_event("die", "1"))
+    assert index.containers["weather"].status == "exited"
+    index.handle_event(skill_event("destroy", "1"))
+    assert "weather" not in index.containers
+
+    docker.containers.get.return_value = Container(
+        {"Id": "2", "Name": "/skill_weather", "State": {"Status": "created"}}
+    )
+    index.handle_event(skill_event("create", "2"))
+    index.handle_event(skill_event("start", "2"))
+    assert index.containers["weather"].id == "2"
+    assert index.containers["weather"].status == "running"
+
+
+def test_container_index_upgrade():
+    docker = Mock()
+    index = ContainerIndex(docker)
+    current = Container({"Id": "1", "Name": "/skill_weather", "State": {"Status": "running"}})
+    index.containers["weather"] = current
+
+    # a rolled back upgrade
+    index.handle_event(skill_event("create", "2", name="skill_weather_next"))
+    index.handle_event(skill_event("start", "2", name="skill_weather_next"))
+    index.handle_event(skill_event("destroy", "2", name="skill_weather_next"))
+    assert index.containers["weather"] is current
+    docker.containers.get.assert_not_called()
+
+    # a successful one, the containers are swapped by renaming them
+    index.handle_event(skill_event("create", "3", name="skill_weather_next"))
+    index.handle_event(skill_event("rename", "1", name="skill_weather_old"))
+    assert "weather" not in index.containers
+    docker.containers.get.return_value = Container(
+        {"Id": "3", "Name": "/skill_weather", "State": {"Status": "running"}}
+    )
+    index.handle_event(skill_event("rename", "3"))
+    docker.containers.get.assert_called_once_with("3")
+    index.handle_event(skill_event("destroy", "1", name="skill_weather_old"))
+    assert index.containers["weather"].id == "3"
+
+
+class BlockingEvents:
+    """an events stream without events that ends when closed"""
+
+    def __init__(self) -> None:
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.closed.wait()
+        raise StopIteration
+
+    def close(self):
+        self.closed.set()
+
+
+def test_skills_status(tmp_path: pathlib.Path):
+    docker = Mock()
+    running = Container(
+        {
+            "Id": "1",
+            "Names": ["/skill_weather"],
+            "State": "running",
+            "ImageID": "sha256:a",
+            "Labels": {"skill_name": "weather"},
+        },
+        client=docker,
+        collection=docker.containers,
+    )
+    docker.containers.list.return_value = [running]
+    docker.containers.get.return_value = Container(
+        {
+            "Id": "1",
+            "Name": "/skill_weather",
+            "Image": "sha256:a",
+            "State": {"Status": "running", "StartedAt": "2021-06-01T10:00:00Z"},
+        }
+    )
+    docker.api.stats.return_value = {
+        "cpu_stats": {
+            "cpu_usage": {"total_usage": 300},
+            "system_cpu_usage": 2000,
+            "online_cpus": 2,
+        },
+        "precpu_stats": {"cpu_usage": {"total_usage": 100}, "system_cpu_usage": 1000},
+        "memory_stats": {"usage": 1024, "limit": 4096},
+    }
+    events = BlockingEvents()
+    docker.events.return_value = events
+    index = ContainerIndex(docker)
+    db = DB((tmp_path / "store.json").as_posix(), use_cache=True)
+    db.insert_skill(SkillModel(skill_name="weather", hashed_password="hash"))
+    db.insert_skill(SkillModel(skill_name="time", hashed_password="hash"))
+    overrides = dict(app.dependency_overrides)
+    app.dependency_overrides[get_db] = lambda: db
+    app.dependency_overrides[get_container_index] = lambda: index
+    try:
+        response = client.get("/api/skills", params={"status": True, "stats": True})
+        skills = {skill["skill_name"]: skill for skill in response.json()}
+        assert skills["time"]["container"] is None
+        assert skills["weather"]["container"] == {
+            "id": "1",
+            "name": "skill_weather",
+            "status": "running",
+            "image": "sha256:a",
+            "started_at": "2021-06-01T10:00:00Z",
+        }
+        assert skills["weather"]["stats"] == {
+            "cpu_percent": 40.0,
+            "memory_usage": 1024,
+            "memory_limit": 4096,
+        }
+
+        etag = response.headers["etag"]
+        response = client.get(
+            "/api/skills",
+            params={"status": True, "stats": True},
+            headers={"If-None-Match": etag},
+        )
+        assert response.status_code == 304
+        docker.containers.list.assert_called_once()
+        docker.api.stats.assert_called_once()
+
+        index.handle_event(skill_event("die", "1"))
+        response = client.get(
+            "/api/skills", params={"status": True}, headers={"If-None-Match": etag}
+        )
+        assert response.status_code == 200
+        assert response.json()[0]["container"]["status"] == "exited"
+    finally:
+        events.close()
+        app.dependency_overrides = overrides
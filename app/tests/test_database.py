@@ -0,0 +1,118 @@
+import pathlib
+import threading
+import time
+
+from ..database import DB
+from ..storage import JsonBackend, SqliteBackend
+from ..models import DBFile, SkillModel
+
+
+def test_cached_db_reload_only_on_change(tmp_path: pathlib.Path):
+    path = tmp_path / "store.json"
+    db = DB(path.as_posix(), use_cache=True)
+    db.insert_skill(SkillModel(skill_name="weather", hashed_password="hash"))
+    assert db.get_skill("weather").hashed_password == "hash"
+    assert db.get_skill("weather") is not None
+    assert db.get_skill("time") is None
+    # the write updated the index in place
+    assert db.reloads == 1
+    assert db.hits == 3
+
+    # a write from another process must be picked up
+    other = DB(path.as_posix())
+    other.insert_skill(SkillModel(skill_name="time", hashed_password="other"))
+    assert db.get_skill("time").hashed_password == "other"
+    assert db.reloads == 2
+
+    current = db.get_skill("weather")
+    changed = current.copy(update={"hashed_password": "new"})
+    assert db.replace_skill(current, changed)
+    # compared with the stored skill, not replaced again
+    assert not db.replace_skill(current, current.copy(update={"hashed_password": "old"}))
+    assert DB(path.as_posix()).get_skill("weather").hashed_password == "new"
+
+    assert db.remove_skill("weather")
+    assert not db.remove_skill("weather")
+    assert [skill.skill_name for skill in db.get_skills()] == ["time"]
+
+
+def test_journal_compaction(tmp_path: pathlib.Path):
+    path = tmp_path / "store.json"
+    db = DB(backend=JsonBackend(path.as_posix(), compact_every=3), use_cache=True)
+    db.insert_skill(SkillModel(skill_name="weather", hashed_password="hash"))
+    db.insert_skill(SkillModel(skill_name="time", hashed_password="hash"))
+    assert not db.insert_skill(
+        SkillModel(skill_name="time", hashed_password="other"), over_write=False
+    )
+    assert len(open(db.backend.journal_path).readlines()) == 2
+    # the snapshot is not touched until the compaction
+    assert DBFile.parse_file(path).skills == []
+    db.remove_skill("weather")
+    assert open(db.backend.journal_path).read() == ""
+    assert [skill.skill_name for skill in DBFile.parse_file(path).skills] == ["time"]
+    assert [skill.skill_name for skill in DB(path.as_posix()).get_skills()] == ["time"]
+
+
+def test_journal_torn_write(tmp_path: pathlib.Path):
+    path = tmp_path / "store.json"
+    db = DB(path.as_posix())
+    db.insert_skill(SkillModel(skill_name="weather", hashed_password="hash"))
+    with open(db.backend.journal_path, "a") as f:
+        f.write('{"op": "put", "skill": {"skill_na')
+    assert [skill.skill_name for skill in DB(path.as_posix()).get_skills()] == ["weather"]
+    db.insert_skill(SkillModel(skill_name="time", hashed_password="hash"))
+    assert [skill.skill_name for skill in DB(path.as_posix()).get_skills()] == [
+        "weather",
+        "time",
+    ]
+
+
+def test_sqlite_backend(tmp_path: pathlib.Path):
+    json_path = (tmp_path / "store.json").as_posix()
+    DB(json_path).insert_skill(
+        SkillModel(skill_name="weather", hashed_password="hash", topic_access=None)
+    )
+    sqlite_path = (tmp_path / "store.sqlite3").as_posix()
+    db = DB(backend=SqliteBackend(sqlite_path, migrate_from=json_path), use_cache=True)
+    assert not (tmp_path / "store.json").exists()
+    assert db.get_skill("weather") == SkillModel(
+        skill_name="weather", hashed_password="hash", topic_access=None
+    )
+    skill = SkillModel(
+        skill_name="time", hashed_password="hash", topic_access={"a/#": 1, "b": 2}
+    )
+    db.insert_skill(skill)
+    # the commit of this process changes the signature as well
+    assert db.get_skill("time") == skill
+    assert db.reloads == 2
+    assert db.get_skill("time") == skill
+    assert db.reloads == 2
+
+    # a write from another process must be picked up
+    other = DB(backend=SqliteBackend(sqlite_path))
+    assert other.remove_skill("weather")
+    assert [skill.skill_name for skill in db.get_skills()] == ["time"]
+    assert db.reloads == 3
+
+
+def test_sqlite_signature_during_write(tmp_path: pathlib.Path):
+    backend = SqliteBackend((tmp_path / "store.sqlite3").as_posix())
+    writing = threading.Event()
+    done = threading.Event()
+
+    def write():
+        with backend.writing():
+            writing.set()
+            done.wait(5)
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    try:
+        writing.wait(5)
+        start = time.perf_counter()
+        backend.signature()
+        # not blocked by the transaction of the other thread
+        assert time.perf_counter() - start < 0.5
+    finally:
+        done.set()
+        thread.join()
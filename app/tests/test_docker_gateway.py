@@ -0,0 +1,58 @@
+import asyncio
+import time
+from unittest.mock import Mock
+
+import pytest
+from fastapi import HTTPException
+
+from ..docker_gateway import DockerGateway
+from ..metrics import DOCKER_SECONDS, DOCKER_TIMEOUTS
+
+
+def test_slow_stop_does_not_block_the_loop():
+    container = Mock()
+    container.stop.side_effect = lambda timeout: time.sleep(0.3)
+    index = Mock()
+    index.get.return_value = container
+    gateway = DockerGateway(Mock(), index, stop_timeout=5)
+    stops = DOCKER_SECONDS.count(operation="stop_container")
+    gets = DOCKER_SECONDS.count(operation="get_container")
+
+    async def scenario():
+        stopping = asyncio.ensure_future(
+            gateway.stop(await gateway.container("weather"))
+        )
+        start = time.perf_counter()
+        await asyncio.sleep(0.01)
+        # the loop kept serving while the container stops
+        assert time.perf_counter() - start < 0.2
+        assert not stopping.done()
+        await stopping
+
+    asyncio.get_event_loop().run_until_complete(scenario())
+    index.get.assert_called_once_with("weather")
+    container.stop.assert_called_once_with(timeout=5)
+    assert DOCKER_SECONDS.count(operation="stop_container") == stops + 1
+    assert DOCKER_SECONDS.count(operation="get_container") == gets + 1
+
+
+def test_timeout():
+    gateway = DockerGateway(Mock(), Mock(), timeout=0.05)
+    timeouts = DOCKER_TIMEOUTS.get(operation="start_container")
+    container = Mock()
+    container.start.side_effect = lambda: time.sleep(0.3)
+    with pytest.raises(HTTPException) as e:
+        asyncio.get_event_loop().run_until_complete(gateway.start(container))
+    assert e.value.status_code == 504
+    assert DOCKER_TIMEOUTS.get(operation="start_container") == timeouts + 1
+
+
+def test_container_lookup_timeout():
+    index = Mock()
+    index.get.side_effect = lambda skill_name: time.sleep(0.3)
+    gateway = DockerGateway(Mock(), index, timeout=0.05)
+    timeouts = DOCKER_TIMEOUTS.get(operation="get_container")
+    with pytest.raises(HTTPException) as e:
+        asyncio.get_event_loop().run_until_complete(gateway.container("weather"))
+    assert e.value.status_code == 504
+    assert DOCKER_TIMEOUTS.get(operation="get_container") == timeouts + 1
@@ -0,0 +1,95 @@
+import json
+import pathlib
+from unittest.mock import Mock, call
+
+import pytest
+
+from ..config import Settings
+from ..database import DB
+from ..hibernate import Hibernator, manager_password
+from ..metrics import SKILL_HIBERNATIONS, SKILL_WAKE_SECONDS
+from ..models import SkillModel
+
+
+@pytest.fixture
+def hibernator(tmp_path: pathlib.Path) -> Hibernator:
+    skill_path = tmp_path / "skills" / "weather"
+    skill_path.mkdir(parents=True)
+    (skill_path / "sentences.ini").write_text(
+        "[GetWeather]\nwhat is the weather\n\n[GetTemperature]\nhow hot is it\n"
+    )
+    db = DB((tmp_path / "store.json").as_posix())
+    db.insert_skill(SkillModel(skill_name="weather", hashed_password="hash", hibernate=True))
+    db.insert_skill(SkillModel(skill_name="time", hashed_password="hash"))
+    settings = Settings(
+        store_directory=tmp_path.as_posix(),
+        hibernate_idle_timeout=0,
+        hibernate_wake_timeout=5,
+    )
+    return Hibernator(settings, Mock(), db, Mock())
+
+
+def skill_container(skill_name: str, status: str) -> Mock:
+    return Mock(
+        attrs={"Labels": {"skill_name": skill_name}, "Names": ["/skill_" + skill_name]},
+        status=status,
+    )
+
+
+def test_manager_password(tmp_path: pathlib.Path):
+    password = manager_password(tmp_path.as_posix())
+    assert len(password) == 64
+    assert manager_password(tmp_path.as_posix()) == password
+    assert (tmp_path / "manager.secret").stat().st_mode & 0o777 == 0o600
+
+
+def test_wake_on_intent(hibernator: Hibernator):
+    hibernator.docker.containers.list.return_value = [
+        skill_container("weather", "exited"),
+        skill_container("time", "exited"),
+    ]
+    hibernator.refresh()
+    assert hibernator.intents == {"GetWeather": "weather", "GetTemperature": "weather"}
+    container = Mock()
+
+    def start():
+        # buffered until the skill subscribes again
+        assert hibernator.handle("hermes/intent/GetTemperature", b"{}", 1) is None
+        hibernator.activity.mark("weather", force=True)
+        container.status = "running"
+
+    container.start.side_effect = start
+    hibernator.docker.containers.get.return_value = container
+    wakes = SKILL_WAKE_SECONDS.count(result="connected")
+
+    assert hibernator.handle("hermes/intent/GetTime", b"{}", 1) is None
+    assert hibernator.handle("hermes/intent/GetWeather", b'{"a": 1}', 0) == "weather"
+    hibernator.executor.shutdown(wait=True)
+
+    hibernator.docker.containers.get.assert_called_once_with("skill_weather")
+    assert hibernator.client.publish.call_args_list == [
+        call("hermes/intent/GetWeather", b'{"a": 1}', qos=0),
+        call("hermes/intent/GetTemperature", b"{}", qos=1),
+    ]
+    assert hibernator.pending == {}
+    assert SKILL_WAKE_SECONDS.count(result="connected") == wakes + 1
+    state = json.loads(open(hibernator.state_path).read())["skills"]["weather"]
+    assert state["wakes"] == 1
+    assert state["last_wake_seconds"] >= 0
+    # the skill is awake, its intents are delivered by the broker
+    assert hibernator.handle("hermes/intent/GetWeather", b"{}", 0) is None
+
+
+def test_sweep_stops_idle_skills(hibernator: Hibernator):
+    weather = skill_container("weather", "running")
+    time_container = skill_container("time", "running")
+    hibernator.docker.containers.list.return_value = [weather, time_container]
+    hibernations = SKILL_HIBERNATIONS.get()
+
+    hibernator.sweep()
+
+    weather.stop.assert_called_once_with()
+    time_container.stop.assert_not_called()
+    assert SKILL_HIBERNATIONS.get() == hibernations + 1
+    state = json.loads(open(hibernator.state_path).read())["skills"]["weather"]
+    assert state["hibernated"] is not None
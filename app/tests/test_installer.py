@@ -0,0 +1,163 @@
+import asyncio
+import pathlib
+import tarfile
+import threading
+from unittest.mock import Mock
+
+import pytest
+from rhasspy_skills_cli.manifest import Manifest
+
+from ..archive import SkillArchive
+from ..installer import (
+    CONTEXT_DIGEST_LABEL,
+    SkillInstaller,
+    image_reference,
+    prepare_build_context,
+)
+from ..jobs import Job, JobManager
+from ..routers.exceptions import SkillInstallException
+
+
+def make_skill(path: pathlib.Path, dockerfile: str = "FROM alpine\nCOPY app.py /\n"):
+    path.mkdir(exist_ok=True)
+    (path / "Dockerfile").write_text(dockerfile)
+    (path / "app.py").write_text("print('hello')\n")
+    (path / "sentences.ini").write_text("[GetTime]\nwhat time is it\n")
+    (path / "data").mkdir(exist_ok=True)
+    (path / "data" / "state.json").write_text("{}")
+
+
+def test_build_context_digest(tmp_path: pathlib.Path):
+    make_skill(tmp_path)
+    digest, size = prepare_build_context(tmp_path.as_posix())
+    ignored = (tmp_path / ".dockerignore").read_text().splitlines()
+    assert {"data", "config.json", "sentences.ini"} <= set(ignored)
+    assert size == len("FROM alpine\nCOPY app.py /\n") + len("print('hello')\n")
+
+    # the skill data and sentences are not part of the image
+    (tmp_path / "sentences.ini").write_text("[GetTime]\nwhat's the time\n")
+    (tmp_path / "data" / "state.json").write_text('{"a": 1}')
+    assert prepare_build_context(tmp_path.as_posix())[0] == digest
+
+    (tmp_path / "app.py").write_text("print('hi')\n")
+    assert prepare_build_context(tmp_path.as_posix())[0] != digest
+
+
+def test_build_context_copy_all(tmp_path: pathlib.Path):
+    make_skill(tmp_path, "FROM alpine\nCOPY . /app\n")
+    digest, _ = prepare_build_context(tmp_path.as_posix())
+    assert "sentences.ini" not in (tmp_path / ".dockerignore").read_text()
+    (tmp_path / "sentences.ini").write_text("[GetTime]\nwhat's the time\n")
+    assert prepare_build_context(tmp_path.as_posix())[0] != digest
+
+
+def test_build_context_copy_pattern(tmp_path: pathlib.Path):
+    make_skill(tmp_path, "FROM alpine\nCOPY app.py \\\n  *.ini /app/\n")
+    digest, _ = prepare_build_context(tmp_path.as_posix())
+    assert "sentences.ini" not in (tmp_path / ".dockerignore").read_text()
+    (tmp_path / "sentences.ini").write_text("[GetTime]\nwhat's the time\n")
+    assert prepare_build_context(tmp_path.as_posix())[0] != digest
+
+
+def test_build_skipped(tmp_path: pathlib.Path):
+    make_skill(tmp_path)
+    digest, _ = prepare_build_context(tmp_path.as_posix())
+    docker = Mock()
+    docker.images.get.return_value.labels = {CONTEXT_DIGEST_LABEL: digest}
+    installer = SkillInstaller(Mock(), docker, Mock(), tmp_path.as_posix(), Mock(), Mock())
+    build = installer._build(Job("install"), tmp_path.as_posix(), "skill_time")
+    assert build["skipped"]
+    docker.api.build.assert_not_called()
+
+    (tmp_path / "app.py").write_text("print('hi')\n")
+    docker.api.build.return_value = iter([{"aux": {"ID": "sha256:new"}}])
+    build = installer._build(Job("install"), tmp_path.as_posix(), "skill_time")
+    assert not build["skipped"]
+    assert docker.api.build.call_args[1]["labels"] == {
+        CONTEXT_DIGEST_LABEL: prepare_build_context(tmp_path.as_posix())[0]
+    }
+    docker.images.remove.assert_called_once_with(docker.images.get.return_value.id)
+
+
+def test_image_reference():
+    assert image_reference("weather:1.0", None) == "weather:1.0"
+    assert image_reference("weather:1.0", "localhost:5000") == "localhost:5000/weather:1.0"
+    assert image_reference("skills/weather", "localhost:5000/") == (
+        "localhost:5000/skills/weather"
+    )
+    assert image_reference("ghcr.io/skills/weather", "localhost:5000") == (
+        "ghcr.io/skills/weather"
+    )
+
+
+def test_pull_image(tmp_path: pathlib.Path):
+    docker = Mock()
+    docker.api.pull.return_value = iter(
+        [
+            {"status": "Pulling from skills/weather", "id": "1.0"},
+            {"status": "Pulling fs layer", "id": "a"},
+            {
+                "status": "Downloading",
+                "id": "a",
+                "progressDetail": {"current": 25_000_000, "total": 50_000_000},
+            },
+            {
+                "status": "Downloading",
+                "id": "a",
+                "progressDetail": {"current": 26_000_000, "total": 50_000_000},
+            },
+            {"status": "Download complete", "id": "a", "progressDetail": {}},
+            {"status": "Digest: sha256:abc"},
+        ]
+    )
+    pulled = docker.images.get.return_value
+    pulled.attrs = {"RepoDigests": ["localhost:5000/skills/weather@sha256:abc"]}
+    settings = Mock(image_registry="localhost:5000")
+    installer = SkillInstaller(Mock(), docker, settings, tmp_path.as_posix(), Mock(), Mock())
+    job = Job("install")
+    result = installer._pull(job, "skills/weather:1.0", "skill_weather")
+    docker.api.pull.assert_called_once_with(
+        "localhost:5000/skills/weather:1.0", stream=True, decode=True
+    )
+    pulled.tag.assert_called_once_with("skill_weather")
+    assert result["digest"] == "sha256:abc"
+    assert not result["skipped"]
+    assert [line for line in job.model.log if line.startswith("downloaded")] == [
+        "downloaded 50% of 50.0 MB",
+        "downloaded 100% of 50.0 MB",
+    ]
+    assert "a: Download complete" in job.model.log
+
+    # pinned by digest and already present
+    docker.api.pull.reset_mock()
+    result = installer._pull(job, "skills/weather@sha256:abc", "skill_weather")
+    assert result["skipped"]
+    docker.api.pull.assert_not_called()
+
+
+def test_failed_install_cleaned_up_off_the_loop(tmp_path: pathlib.Path):
+    make_skill(tmp_path / "archive")
+    with tarfile.open(tmp_path / "clock.tar", "w") as tar:
+        for name in ("Dockerfile", "sentences.ini"):
+            tar.add(tmp_path / "archive" / name, name)
+    (tmp_path / "skills").mkdir()
+    db = Mock()
+    threads = []
+    db.remove_skill.side_effect = lambda slug: threads.append(threading.current_thread().name)
+    installer = SkillInstaller(
+        db, Mock(), Mock(), (tmp_path / "skills").as_posix(), JobManager(), Mock()
+    )
+    installer._remove_conflicting = Mock()
+    installer._build = Mock(side_effect=SkillInstallException(422, "build_failed", "boom"))
+    manifest = Manifest(name="clock", slug="clock", version="1.0.0")
+    archive = SkillArchive((tmp_path / "clock.tar").as_posix())
+
+    with pytest.raises(SkillInstallException):
+        asyncio.get_event_loop().run_until_complete(
+            installer.install(Job("install"), archive, manifest, False, False)
+        )
+
+    db.remove_skill.assert_called_once_with("clock")
+    assert threads[0].startswith("job")
+    assert not (tmp_path / "skills" / "clock").exists()
+    assert not (tmp_path / "clock.tar").exists()
@@ -0,0 +1,75 @@
+import asyncio
+import os
+import pathlib
+from typing import Optional
+
+from ..jobs import Job, JobManager
+from ..models import JobStage, JobState
+
+
+def test_jobs_shared_between_workers(tmp_path: pathlib.Path):
+    worker = JobManager(directory=tmp_path.as_posix())
+    other = JobManager(directory=tmp_path.as_posix())
+
+    async def install(job: Job):
+        job.set_stage(JobStage.BUILD)
+        # the other worker sees the stage before the job is finished
+        assert other.get(job.id).model.stage == JobStage.BUILD
+        return {"state": "success"}
+
+    async def run():
+        job = worker.submit("install", install)
+        return await worker.wait(job)
+
+    job = asyncio.get_event_loop().run_until_complete(run())
+    seen = other.get(job.id)
+    assert seen.model.state == JobState.SUCCESS
+    assert seen.model.result == {"state": "success"}
+    assert [job.id for job in other.list()] == [job.id]
+    assert other.get("missing") is None
+
+
+def saved_job(
+    directory: pathlib.Path, finished: bool, age: float, worker: Optional[str] = None
+) -> Job:
+    job = Job("install", directory.as_posix())
+    job.model.worker = worker
+    if finished:
+        job.model.state = JobState.SUCCESS
+        job.model.finished = job.model.created
+    job.save(force=True)
+    os.utime(job.path, (job.model.created - age, job.model.created - age))
+    return job
+
+
+def test_prune_files_of_all_workers(tmp_path: pathlib.Path):
+    worker = JobManager(max_finished=2, directory=tmp_path.as_posix())
+    old = [saved_job(tmp_path, finished=True, age=100 + index) for index in range(3)]
+    # queued for a long time
+    pending = saved_job(tmp_path, finished=False, age=200, worker=worker.worker)
+    recent = [saved_job(tmp_path, finished=True, age=index) for index in range(2)]
+
+    worker._prune()
+
+    assert sorted(job.id for job in worker.list()) == sorted(
+        [pending.id] + [job.id for job in recent]
+    )
+    assert not any(os.path.exists(job.path) for job in old)
+
+
+def test_recover_jobs_of_stopped_workers(tmp_path: pathlib.Path):
+    running = JobManager(directory=tmp_path.as_posix())
+    stopped = JobManager(directory=tmp_path.as_posix())
+    alive = saved_job(tmp_path, finished=False, age=0, worker=running.worker)
+    orphan = saved_job(tmp_path, finished=False, age=0, worker=stopped.worker)
+    # the process of the worker exits
+    stopped._worker_lock.close()
+
+    JobManager(directory=tmp_path.as_posix()).recover()
+
+    assert running.get(alive.id).model.state == JobState.PENDING
+    recovered = running.get(orphan.id)
+    assert recovered.model.state == JobState.FAILED
+    assert recovered.model.finished is not None
+    assert recovered.model.error["error_code"] == "job_interrupted"
+    assert not (tmp_path / "workers" / (stopped.worker + ".lock")).exists()
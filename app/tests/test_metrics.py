@@ -0,0 +1,36 @@
+import os
+import pathlib
+import time
+
+from ..metrics import Counter, Histogram, Registry
+
+
+def test_metrics_merged_between_workers(tmp_path: pathlib.Path):
+    worker = Registry()
+    requests = worker.register(Counter("requests_total", "requests", ["path"]))
+    latency = worker.register(Histogram("latency_seconds", "latency", buckets=(0.1, 1)))
+    requests.inc(path="/api/acl")
+    latency.observe(0.05)
+    latency.observe(0.5)
+
+    # the values saved by another worker are summed to the ones of this process
+    with open(tmp_path / "1.json", "w") as f:
+        f.write(
+            '{"requests_total": [[["/api/acl"], 2]],'
+            ' "latency_seconds": [[[], [[0, 0], 3.0, 1]]]}'
+        )
+    # a worker that stopped saving is gone
+    (tmp_path / "2.json").write_text('{"requests_total": [[["/api/acl"], 100]]}')
+    old = time.time() - 120
+    os.utime(tmp_path / "2.json", (old, old))
+
+    text = worker.render(worker.collect(tmp_path.as_posix()))
+    assert 'requests_total{path="/api/acl"} 3' in text.splitlines()
+    assert 'latency_seconds_bucket{le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{le="1"} 2' in text
+    assert 'latency_seconds_bucket{le="+Inf"} 3' in text
+    assert "latency_seconds_sum 3.55" in text
+    assert not (tmp_path / "2.json").exists()
+
+    worker.save(tmp_path.as_posix())
+    assert (tmp_path / f"{os.getpid()}.json").exists()
@@ -0,0 +1,182 @@
+import pathlib
+
+import fastapi.dependencies.utils
+import pytest
+from fastapi.testclient import TestClient
+
+from ..config import Settings
+from ..database import DB
+from ..dependencies import get_auth_db, get_auth_settings, get_settings, ph
+from ..hibernate import MANAGER_USERNAME, manager_password
+from ..main import app
+from ..metrics import ACL_CHECKS, LOGIN_SECONDS
+from ..models import SkillModel, TopicAccess
+
+client = TestClient(app)
+
+
+@pytest.fixture
+def auth_db(tmp_path: pathlib.Path):
+    db = DB((tmp_path / "store.json").as_posix(), use_cache=True)
+    db.insert_skill(
+        SkillModel(
+            skill_name="weather",
+            hashed_password=ph.hash("secret"),
+            topic_access={"weather/+/state": TopicAccess.WRITE},
+        )
+    )
+
+    async def override_get_auth_db():
+        return db
+
+    app.dependency_overrides[get_auth_db] = override_get_auth_db
+    yield db
+    del app.dependency_overrides[get_auth_db]
+
+
+def test_login(auth_db: DB):
+    data = {"username": "weather", "password": "secret"}
+    assert client.post("/api/login", data=data).status_code == 200
+    assert client.post("/api/login", data=data).status_code == 200
+    data["password"] = "wrong"
+    assert client.post("/api/login", data=data).status_code == 401
+    data["username"] = "time"
+    assert client.post("/api/login", data=data).status_code == 404
+
+
+def test_acl(auth_db: DB):
+    def acl(topic: str, acc: int, username: str = "weather") -> int:
+        return client.post(
+            "/api/acl", data={"username": username, "topic": topic, "acc": acc}
+        ).status_code
+
+    assert acl("hermes/intent/GetWeather", TopicAccess.SUBSCRIBE) == 204
+    assert acl("weather/kitchen/state", TopicAccess.WRITE) == 204
+    assert acl("weather/kitchen/state", TopicAccess.READ) == 403
+    assert acl("weather/kitchen/state", TopicAccess.WRITE, "time") == 404
+
+
+def test_acl_batch(auth_db: DB):
+    response = client.post(
+        "/api/acl/batch",
+        json=[
+            {"username": "weather", "topic": "weather/a/state", "acc": TopicAccess.WRITE},
+            {"username": "weather", "topic": "weather/a/state", "acc": TopicAccess.READ},
+            {"username": "time", "topic": "weather/a/state", "acc": TopicAccess.WRITE},
+        ],
+    )
+    assert response.status_code == 200
+    assert response.json() == [
+        {"allowed": True, "status_code": 204},
+        {"allowed": False, "status_code": 403},
+        {"allowed": False, "status_code": 404},
+    ]
+
+
+
+def test_acl_batch_single_snapshot(auth_db: DB, tmp_path: pathlib.Path):
+    # another worker installs a skill
+    DB((tmp_path / "store.json").as_posix()).insert_skill(
+        SkillModel(skill_name="time", hashed_password=ph.hash("secret"))
+    )
+    reloads, hits = auth_db.reloads, auth_db.hits
+    response = client.post(
+        "/api/acl/batch",
+        json=[
+            {"username": name, "topic": "hermes/intent/GetTime", "acc": TopicAccess.READ}
+            for name in ["time", "weather", "time", "weather"]
+        ],
+    )
+    assert [verdict["allowed"] for verdict in response.json()] == [True] * 4
+    # loaded once for the whole batch, the checks don't look at the store
+    assert (auth_db.reloads, auth_db.hits) == (reloads + 1, hits)
+
+def test_metrics(auth_db: DB):
+    allowed = ACL_CHECKS.get(verdict="allow", rule="topic_access")
+    denied = LOGIN_SECONDS.count(result="denied")
+    client.post(
+        "/api/acl", data={"username": "weather", "topic": "weather/a/state", "acc": 2}
+    )
+    client.post("/api/login", data={"username": "weather", "password": "wrong"})
+    assert ACL_CHECKS.get(verdict="allow", rule="topic_access") == allowed + 1
+    assert LOGIN_SECONDS.count(result="denied") == denied + 1
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert (
+        'rhasspy_skills_acl_checks_total{verdict="allow",rule="topic_access"}'
+        in response.text
+    )
+    assert 'rhasspy_skills_login_seconds_count{result="denied"}' in response.text
+
+
+@pytest.fixture
+def tmp_settings(tmp_path: pathlib.Path):
+    settings = Settings(store_directory=tmp_path.as_posix())
+
+    async def override_get_auth_settings():
+        return settings
+
+    overrides = dict(app.dependency_overrides)
+    app.dependency_overrides[get_settings] = lambda: settings
+    app.dependency_overrides[get_auth_settings] = override_get_auth_settings
+    yield settings
+    app.dependency_overrides = overrides
+
+
+def test_hibernation(auth_db: DB, tmp_settings: Settings, tmp_path: pathlib.Path):
+    password = manager_password(tmp_path.as_posix())
+    data = {"username": MANAGER_USERNAME, "password": password}
+    assert client.post("/api/login", data=data).status_code == 200
+    data["password"] = "wrong"
+    assert client.post("/api/login", data=data).status_code == 401
+    data = {"username": MANAGER_USERNAME, "topic": "hermes/intent/#", "acc": 4}
+    assert client.post("/api/acl", data=data).status_code == 204
+    data["topic"] = "weather/a/state"
+    assert client.post("/api/acl", data=data).status_code == 403
+
+    data = {"username": "weather", "topic": "hermes/intent/GetWeather", "acc": 4}
+    client.post("/api/acl", data=data)
+    assert not (tmp_path / "activity" / "weather").exists()
+    auth_db.insert_skill(auth_db.get_skill("weather").copy(update={"hibernate": True}))
+    assert client.post("/api/acl", data=data).status_code == 204
+    assert (tmp_path / "activity" / "weather").exists()
+
+
+def test_login_upgrades_argon2(auth_db: DB, tmp_settings: Settings):
+    password = "0123456789abcdef" * 4
+    auth_db.insert_skill(SkillModel(skill_name="clock", hashed_password=ph.hash(password)))
+    data = {"username": "clock", "password": password}
+    assert client.post("/api/login", data=data).status_code == 200
+    skill = auth_db.get_skill("clock")
+    assert skill.password_scheme == "hmac-sha256"
+    assert not skill.hashed_password.startswith("$argon2")
+    keyed = LOGIN_SECONDS.count(result="keyed")
+    assert client.post("/api/login", data=data).status_code == 200
+    assert LOGIN_SECONDS.count(result="keyed") == keyed + 1
+    data["password"] = "wrong"
+    assert client.post("/api/login", data=data).status_code == 401
+    # the short passwords are not generated ones, they stay on argon2
+    assert client.post(
+        "/api/login", data={"username": "weather", "password": "secret"}
+    ).status_code == 200
+    assert auth_db.get_skill("weather").password_scheme == "argon2"
+
+
+def test_auth_without_thread_hops(
+    auth_db: DB, tmp_settings: Settings, monkeypatch: pytest.MonkeyPatch
+):
+    hops = []
+    run_in_threadpool = fastapi.dependencies.utils.run_in_threadpool
+
+    async def recording(func, *args, **kwargs):
+        hops.append(func.__name__)
+        return await run_in_threadpool(func, *args, **kwargs)
+
+    # the sync dependencies are run in the threadpool
+    monkeypatch.setattr(fastapi.dependencies.utils, "run_in_threadpool", recording)
+    data = {"username": "weather", "topic": "weather/a/state", "acc": TopicAccess.WRITE}
+    assert client.post("/api/acl", data=data).status_code == 204
+    assert client.post("/api/acl/batch", json=[data]).status_code == 200
+    data = {"username": "weather", "password": "secret"}
+    assert client.post("/api/login", data=data).status_code == 200
+    assert hops == []
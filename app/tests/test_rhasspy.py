@@ -0,0 +1,96 @@
+import asyncio
+import json
+import pathlib
+
+import httpx
+import pytest
+
+from pytest_httpx import HTTPXMock
+
+from ..rhasspy import RhasspyClient, TrainingScheduler
+
+
+def test_training_coalesced(httpx_mock: HTTPXMock):
+    httpx_mock.add_response(method="POST")
+    rhasspy = RhasspyClient("http://rhasspy/api/")
+    trainer = TrainingScheduler(rhasspy, quiet_window=0.05)
+
+    async def submit_all():
+        return await asyncio.gather(
+            trainer.submit("install a", {"a/sentences.ini": "[A]"}),
+            trainer.submit("delete b", {"b/sentences.ini": ""}),
+        )
+
+    loop = asyncio.get_event_loop()
+    first, second = loop.run_until_complete(submit_all())
+    loop.run_until_complete(rhasspy.aclose())
+    assert first is second
+    assert first.operations == ["install a", "delete b"]
+    requests = httpx_mock.get_requests()
+    assert [request.url.path for request in requests] == [
+        "/api/sentences",
+        "/api/train",
+        "/api/restart",
+    ]
+    assert json.loads(requests[0].read()) == {
+        "a/sentences.ini": "[A]",
+        "b/sentences.ini": "",
+    }
+
+
+def test_rhasspy_client_retry(httpx_mock: HTTPXMock):
+    attempts = []
+
+    def unreachable(request, *args, **kwargs):
+        attempts.append(request)
+        raise httpx.ConnectError("unreachable", request=request)
+
+    httpx_mock.add_callback(unreachable)
+    rhasspy = RhasspyClient("http://rhasspy/api/", retries=2, backoff=0)
+    loop = asyncio.get_event_loop()
+    with pytest.raises(httpx.ConnectError):
+        loop.run_until_complete(rhasspy.post("train"))
+    loop.run_until_complete(rhasspy.aclose())
+    assert len(attempts) == 3
+    assert rhasspy.latency["train"]["errors"] == 3
+
+
+def test_rhasspy_client_no_retry_after_sent(httpx_mock: HTTPXMock):
+    attempts = []
+
+    def slow(request, *args, **kwargs):
+        attempts.append(request)
+        raise httpx.ReadTimeout("no answer", request=request)
+
+    httpx_mock.add_callback(slow)
+    rhasspy = RhasspyClient("http://rhasspy/api/", retries=2, backoff=0)
+    loop = asyncio.get_event_loop()
+    with pytest.raises(httpx.ReadTimeout):
+        loop.run_until_complete(rhasspy.post("train"))
+    loop.run_until_complete(rhasspy.aclose())
+    # rhasspy may be training already, the request is not sent again
+    assert len(attempts) == 1
+    assert rhasspy.latency["train"]["errors"] == 1
+
+
+def test_training_skipped_when_deployed(httpx_mock: HTTPXMock, tmp_path: pathlib.Path):
+    httpx_mock.add_response(method="POST")
+    rhasspy = RhasspyClient("http://rhasspy/api/")
+    state_path = (tmp_path / "rhasspy_state.json").as_posix()
+    trainer = TrainingScheduler(rhasspy, quiet_window=0, state_path=state_path)
+    loop = asyncio.get_event_loop()
+    first = loop.run_until_complete(trainer.submit("install a", {"a/sentences.ini": "[A]"}))
+    assert not first.skipped
+
+    # another process with the same state
+    trainer = TrainingScheduler(rhasspy, quiet_window=0, state_path=state_path)
+    again = loop.run_until_complete(trainer.submit("install a", {"a/sentences.ini": "[A]"}))
+    assert again.skipped
+    both = loop.run_until_complete(
+        trainer.submit("install a, b", {"a/sentences.ini": "[A]", "b/sentences.ini": "[B]"})
+    )
+    loop.run_until_complete(rhasspy.aclose())
+    assert not both.skipped
+    assert both.files == ["b/sentences.ini"]
+    assert len(httpx_mock.get_requests()) == 6
+    assert json.loads(httpx_mock.get_requests()[3].read()) == {"b/sentences.ini": "[B]"}
@@ -1,9 +1,14 @@
+import io
+import json
 import pathlib
+import tarfile
+from typing import Dict
 from docker.models.containers import Container
 from docker.models.networks import Network
 from fastapi.testclient import TestClient
 
 from ..config import Settings
+from ..database import DB
 from ..main import app
 from ..dependencies import get_db, get_docker, get_settings, get_temp_directory
 from ..models import SkillModel
@@ -40,7 +45,7 @@ def get_test_resource(name: str) -> Path:
 def tmp_dir(tmp_path_factory: pytest.TempPathFactory):
     tmp_path = tmp_path_factory.getbasetemp()
     app.dependency_overrides[get_settings] = lambda: Settings(
-        store_directory=tmp_path.as_posix()
+        store_directory=tmp_path.as_posix(), train_quiet_window=0
     )
     app.dependency_overrides[get_temp_directory] = lambda: tmp_path.resolve()
     return tmp_path
@@ -87,6 +92,7 @@ def test_install_skill(tmp_dir: pathlib.Path, httpx_mock: HTTPXMock):
     docker.containers.list.return_value = [Container({"Name": "rhasspy"})]
     db.insert_skill.return_value = True
     docker.networks.list.return_value = [Network()]
+    docker.api.build.return_value = iter([{"stream": "Step 1/2 : FROM alpine\n"}])
     docker.api.inspect_container.return_value = {
         "Mounts": [
             {
@@ -98,16 +104,20 @@ def test_install_skill(tmp_dir: pathlib.Path, httpx_mock: HTTPXMock):
     }
     response = client.post(
         "/api/skills",
+        params={"wait": True},
         files={"file": get_test_resource("manifest_docker_sentences.tar").read_bytes()},
     )
+    assert response.status_code == 200
     install_path = response.json()["detail"].replace(f"installed {slug} in", "").strip()
     assert response.json()["state"] == "success"
     db.insert_skill.assert_called_once_with(
         SkillModel(
             skill_name=slug,
             hashed_password=db.insert_skill.call_args[0][0].hashed_password,
+            password_scheme="hmac-sha256",
             topic_access=None,
             start_on_boot=False,
+            intents=["GetTime"],
         )
     )
     tag = "skill_" + slug
@@ -123,3 +133,122 @@ def test_install_skill(tmp_dir: pathlib.Path, httpx_mock: HTTPXMock):
         labels={"skill_name": slug},
         volumes={os.path.join(install_path, "data"): {"bind": "/data", "mode": "rw"}},
     )
+
+    jobs = client.get("/api/jobs").json()
+    assert jobs[-1]["state"] == "success"
+    assert jobs[-1]["stage"] == "done"
+    assert "Step 1/2 : FROM alpine" in jobs[-1]["log"]
+    job = client.get(f"/api/jobs/{jobs[-1]['id']}", params={"since": 1}).json()
+    assert job["log"] == jobs[-1]["log"][1:]
+
+
+def test_job_not_found():
+    assert client.get("/api/jobs/unknown").status_code == 404
+
+
+def test_get_intents():
+    db.get_skills.return_value = [
+        SkillModel(skill_name="time", hashed_password="", intents=["GetTime"]),
+        SkillModel(skill_name="weather", hashed_password=""),
+    ]
+    response = client.get("/api/intents")
+    assert response.status_code == 200
+    assert response.json() == {"intents": {"GetTime": ["time"]}, "unscoped": ["weather"]}
+
+
+def make_skill_archive(slug: str) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for name, content in (
+            ("manifest.json", f'{{"slug": "{slug}", "name": "{slug}", "version": "1.0.0"}}'),
+            ("Dockerfile", "FROM alpine\n"),
+            ("sentences.ini", f"[{slug}]\n{slug}\n"),
+        ):
+            info = tarfile.TarInfo(name)
+            info.size = len(content.encode())
+            tar.addfile(info, io.BytesIO(content.encode()))
+    return buffer.getvalue()
+
+
+def make_bundle(archives: Dict[str, bytes]) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for name, content in archives.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+def test_install_skills_bulk(tmp_dir: pathlib.Path, httpx_mock: HTTPXMock):
+    httpx_mock.add_response(method="POST")
+    docker.reset_mock()
+    docker.containers.list.return_value = []
+    docker.api.build.side_effect = lambda **kwargs: iter([{"stream": "Step 1/1\n"}])
+    docker.api.inspect_container.return_value = {
+        "Mounts": [{"Type": "bind", "Source": "/path/to/data", "Destination": "/data"}]
+    }
+    bundle = make_bundle(
+        {"clock.tar": make_skill_archive("clock"), "timer.tar": make_skill_archive("timer")}
+    )
+    response = client.post(
+        "/api/skills/bulk",
+        params={"wait": True},
+        files={"files": ("bundle.tar", bundle)},
+    )
+    docker.api.build.side_effect = None
+    assert response.status_code == 200
+    result = response.json()
+    assert result["state"] == "success", result
+    assert set(result["skills"]) == {"clock", "timer"}
+    assert docker.containers.run.call_count == 2
+    # a single training for both skills
+    sentences = [
+        json.loads(request.read())
+        for request in httpx_mock.get_requests()
+        if request.url.path.endswith("/sentences")
+    ]
+    assert sentences == [
+        {
+            "intents/skills/clock/sentences.ini": "[clock]\nclock\n",
+            "intents/skills/timer/sentences.ini": "[timer]\ntimer\n",
+        }
+    ]
+
+
+def test_install_skills_bulk_invalid(tmp_dir: pathlib.Path):
+    docker.reset_mock()
+    response = client.post(
+        "/api/skills/bulk",
+        files=[
+            ("files", ("alarm.tar", make_skill_archive("alarm"))),
+            ("files", ("invalid.tar", b"invalid data")),
+        ],
+    )
+    assert response.status_code == 422
+    assert response.json()["error_code"] == "invalid_archives"
+    assert list(response.json()["detail"]) == ["invalid.tar"]
+    docker.api.build.assert_not_called()
+
+
+def test_hibernate_skill_keeps_concurrent_changes(tmp_path: pathlib.Path):
+    store = (tmp_path / "store.json").as_posix()
+    skill_db = DB(store)
+    skill_db.insert_skill(SkillModel(skill_name="clock", hashed_password="old"))
+    replace_skill = skill_db.replace_skill
+
+    def reissued_meanwhile(current: SkillModel, skill: SkillModel) -> bool:
+        if current.hashed_password == "old":
+            DB(store).insert_skill(current.copy(update={"hashed_password": "new"}))
+        return replace_skill(current, skill)
+
+    skill_db.replace_skill = reissued_meanwhile
+    app.dependency_overrides[get_db] = lambda: skill_db
+    try:
+        response = client.post("/api/skills/clock/hibernate")
+    finally:
+        app.dependency_overrides[get_db] = override_get_db
+    assert response.status_code == 200
+    skill = skill_db.get_skill("clock")
+    assert skill.hibernate
+    assert skill.hashed_password == "new"
@@ -0,0 +1,149 @@
+import pathlib
+import socket
+import threading
+import time
+from unittest.mock import Mock
+
+import pytest
+from docker.errors import ImageNotFound
+from pytest_httpx import HTTPXMock
+
+from .. import start_skills
+from ..config import Settings
+from ..database import DB
+from ..models import SkillModel
+from ..start_skills import start_skill, wait_ready
+
+
+@pytest.fixture
+def broker():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+    yield listener.getsockname()[1]
+    listener.close()
+
+
+def closed_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_wait_ready(httpx_mock: HTTPXMock, broker: int):
+    httpx_mock.add_response(url="http://api/docs", status_code=404)
+    settings = Settings(api_url="http://api/docs", broker_port=broker, boot_timeout=5)
+    assert wait_ready(settings)
+
+
+def test_wait_ready_timeout(httpx_mock: HTTPXMock):
+    httpx_mock.add_response(url="http://api/docs")
+    settings = Settings(api_url="http://api/docs", broker_port=closed_port(), boot_timeout=0.3)
+    start = time.monotonic()
+    assert not wait_ready(settings)
+    assert time.monotonic() - start < 2
+
+
+def skill_container(status: str) -> Mock:
+    return Mock(status=status)
+
+
+def test_start_skill_states(tmp_path: pathlib.Path):
+    docker = Mock()
+    db = DB((tmp_path / "store.json").as_posix())
+    skills_dir = (tmp_path / "skills").as_posix()
+    skill = SkillModel(skill_name="clock", hashed_password="hash")
+
+    running = skill_container("running")
+    assert start_skill(docker, db, skills_dir, skill, running)[1] == "running"
+    running.start.assert_not_called()
+
+    exited = skill_container("exited")
+    assert start_skill(docker, db, skills_dir, skill, exited)[1] == "started"
+    exited.start.assert_called_once_with()
+
+    hibernating = skill.copy(update={"hibernate": True})
+    exited = skill_container("exited")
+    assert start_skill(docker, db, skills_dir, hibernating, exited)[1] == "hibernated"
+    exited.start.assert_not_called()
+
+    exited = skill_container("exited")
+    exited.start.side_effect = RuntimeError("docker is gone")
+    assert start_skill(docker, db, skills_dir, skill, exited)[1] == "failed"
+
+
+def test_start_skill_recreates_container(tmp_path: pathlib.Path):
+    skill_path = tmp_path / "skills" / "clock"
+    skill_path.mkdir(parents=True)
+    (skill_path / "manifest.json").write_text(
+        '{"slug": "clock", "name": "clock", "version": "1.0.0", "internet_access": true}'
+    )
+    docker = Mock()
+    docker.api.inspect_container.return_value = {
+        "Mounts": [{"Destination": "/data", "Source": "/srv/skills/data"}]
+    }
+    bridge = Mock()
+    docker.networks.list.return_value = [bridge]
+    db = DB((tmp_path / "store.json").as_posix())
+    skill = SkillModel(
+        skill_name="clock",
+        hashed_password="hash",
+        topic_access={"clock/#": 1},
+        intents=["GetTime"],
+    )
+    db.insert_skill(skill)
+
+    _, state, _ = start_skill(docker, db, (tmp_path / "skills").as_posix(), skill, None)
+
+    assert state == "recreated"
+    docker.images.get.assert_called_once_with("skill_clock")
+    _, kwargs = docker.containers.run.call_args
+    assert kwargs["name"] == "skill_clock"
+    assert kwargs["labels"] == {"skill_name": "clock"}
+    bridge.connect.assert_called_once()
+    # new credentials, the acl of the skill is kept
+    recreated = db.get_skill("clock")
+    assert recreated.hashed_password != "hash"
+    assert recreated.topic_access == {"clock/#": 1}
+    assert recreated.intents == ["GetTime"]
+
+    docker.images.get.side_effect = ImageNotFound("no image")
+    _, state, _ = start_skill(docker, db, (tmp_path / "skills").as_posix(), skill, None)
+    assert state == "missing"
+
+
+def test_boot_concurrency(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    db = DB((tmp_path / "store.json").as_posix())
+    for index in range(6):
+        db.insert_skill(
+            SkillModel(skill_name=f"skill{index}", hashed_password="hash", start_on_boot=True)
+        )
+    db.insert_skill(SkillModel(skill_name="manual", hashed_password="hash"))
+    docker = Mock()
+    docker.containers.list.return_value = []
+    lock = threading.Lock()
+    running = []
+    started = []
+    peak = 0
+
+    def slow_start(docker, db, skills_dir, skill, container, hasher=None):
+        nonlocal peak
+        with lock:
+            running.append(skill.skill_name)
+            peak = max(peak, len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(skill.skill_name)
+            started.append(skill.skill_name)
+        return skill.skill_name, "started", 0.05
+
+    monkeypatch.setenv("STORE_DIRECTORY", tmp_path.as_posix())
+    monkeypatch.setenv("BOOT_CONCURRENCY", "2")
+    monkeypatch.setattr(start_skills, "wait_ready", lambda settings: True)
+    monkeypatch.setattr(start_skills.dc, "from_env", lambda: docker)
+    monkeypatch.setattr(start_skills, "start_skill", slow_start)
+
+    start_skills.main()
+
+    assert sorted(started) == [f"skill{index}" for index in range(6)]
+    assert peak == 2
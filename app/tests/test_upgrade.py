@@ -0,0 +1,146 @@
+import asyncio
+import pathlib
+import socket
+import tarfile
+from unittest.mock import Mock
+
+import pytest
+from docker.errors import APIError, NotFound
+from rhasspy_skills_cli.manifest import Manifest
+
+from ..archive import SkillArchive
+from ..config import Settings
+from ..dependencies import ph
+from ..jobs import JobManager
+from ..models import SkillModel
+from ..routers.exceptions import SkillInstallException
+from ..upgrade import SkillUpgrader
+
+
+def make_upgrade(tmp_path: pathlib.Path, new_state: dict):
+    skills_dir = tmp_path / "skills"
+    (skills_dir / "clock" / "data").mkdir(parents=True)
+    (skills_dir / "clock" / "Dockerfile").write_text("FROM alpine\n")
+    (skills_dir / "clock" / "data" / "alarms.json").write_text("[7]")
+    archive_dir = tmp_path / "archive"
+    archive_dir.mkdir()
+    (archive_dir / "Dockerfile").write_text("FROM alpine:3\n")
+    (archive_dir / "sentences.ini").write_text("[clock]\n")
+    with tarfile.open(tmp_path / "clock.tar", "w") as tar:
+        for name in ("Dockerfile", "sentences.ini"):
+            tar.add(archive_dir / name, name)
+
+    old = Mock(attrs={"Config": {"Env": ["MQTT_USER=clock", "MQTT_PASS=secret"]}})
+    new = Mock(attrs={"State": new_state})
+    new.logs.return_value = b"boom"
+    containers = {"skill_clock": old, "skill_clock_next": new}
+    docker = Mock()
+    docker.containers.list.return_value = []
+
+    def get_container(name):
+        if name == socket.gethostname():
+            return Mock(id="self")
+        if name not in containers:
+            raise NotFound(name)
+        return containers[name]
+
+    docker.containers.get.side_effect = get_container
+    docker.api.build.return_value = iter([])
+    docker.api.inspect_container.return_value = {
+        "Mounts": [{"Type": "bind", "Source": "/path/to/data", "Destination": "/data"}]
+    }
+    db = Mock()
+    upgrader = SkillUpgrader(
+        db,
+        docker,
+        Settings(upgrade_health_window=0, upgrade_timeout=1),
+        skills_dir.as_posix(),
+        JobManager(),
+        Mock(),
+    )
+    skill = SkillModel(skill_name="clock", hashed_password=ph.hash("secret"))
+    manifest = Manifest(name="clock", slug="clock", version="2.0.0", auto_train=False)
+    archive = SkillArchive((tmp_path / "clock.tar").as_posix())
+    job = Mock()
+    run = upgrader.upgrade(job, archive, manifest, skill)
+    return run, upgrader, skill, old, new
+
+
+def test_upgrade(tmp_path: pathlib.Path):
+    run, upgrader, skill, old, new = make_upgrade(
+        tmp_path, {"Status": "running", "Health": {"Status": "healthy"}}
+    )
+    result = asyncio.get_event_loop().run_until_complete(run)
+    assert result["state"] == "success"
+    assert not result["credentials_reissued"]
+    # the new container uses the credentials of the running one
+    run_kwargs = upgrader.docker.containers.run.call_args[1]
+    assert run_kwargs["name"] == "skill_clock_next"
+    assert run_kwargs["environment"]["MQTT_PASS"] == "secret"
+    old.rename.assert_called_once_with("skill_clock_old")
+    new.rename.assert_called_once_with("skill_clock")
+    old.remove.assert_called_once()
+    skill_path = tmp_path / "skills" / "clock"
+    assert (skill_path / "Dockerfile").read_text() == "FROM alpine:3\n"
+    assert (skill_path / "data" / "alarms.json").read_text() == "[7]"
+    assert not (tmp_path / "skills" / "clock.next").exists()
+    # the topic access and the intents come from the new skill
+    upgrader.db.insert_skill.assert_called_once_with(
+        skill.copy(update={"topic_access": None, "intents": ["clock"]})
+    )
+
+
+def test_upgrade_rollback(tmp_path: pathlib.Path):
+    run, upgrader, skill, old, new = make_upgrade(
+        tmp_path, {"Status": "exited", "ExitCode": 1}
+    )
+    with pytest.raises(SkillInstallException) as e:
+        asyncio.get_event_loop().run_until_complete(run)
+    assert e.value.error_code == "unhealthy_upgrade"
+    assert "boom" in e.value.detail
+    new.remove.assert_called_once_with(v=True, force=True)
+    old.rename.assert_not_called()
+    old.remove.assert_not_called()
+    skill_path = tmp_path / "skills" / "clock"
+    assert (skill_path / "Dockerfile").read_text() == "FROM alpine\n"
+    assert not (tmp_path / "skills" / "clock.next").exists()
+    upgrader.db.insert_skill.assert_not_called()
+
+
+def test_upgrade_rollback_on_docker_error(tmp_path: pathlib.Path):
+    run, upgrader, skill, old, new = make_upgrade(tmp_path, {"Status": "running"})
+    new.reload.side_effect = NotFound("skill_clock_next")
+    with pytest.raises(SkillInstallException) as e:
+        asyncio.get_event_loop().run_until_complete(run)
+    assert e.value.error_code == "upgrade_failed"
+    new.remove.assert_called_once_with(v=True, force=True)
+    old.rename.assert_not_called()
+    assert not (tmp_path / "skills" / "clock.next").exists()
+
+
+def test_upgrade_image_cleanup_failure(tmp_path: pathlib.Path):
+    run, upgrader, skill, old, new = make_upgrade(
+        tmp_path, {"Status": "running", "Health": {"Status": "healthy"}}
+    )
+    upgrader.docker.images.remove.side_effect = APIError("image is in use")
+    result = asyncio.get_event_loop().run_until_complete(run)
+    assert result["state"] == "success"
+    new.rename.assert_called_once_with("skill_clock")
+    new.remove.assert_not_called()
+    upgrader.db.insert_skill.assert_called_once()
+
+
+def test_upgrade_incomplete_after_swap(tmp_path: pathlib.Path):
+    run, upgrader, skill, old, new = make_upgrade(
+        tmp_path, {"Status": "running", "Health": {"Status": "healthy"}}
+    )
+    upgrader._replace_files = Mock(side_effect=OSError("disk full"))
+    with pytest.raises(SkillInstallException) as e:
+        asyncio.get_event_loop().run_until_complete(run)
+    assert e.value.error_code == "upgrade_incomplete"
+    # the new container is the skill now, the store describes it
+    new.rename.assert_called_once_with("skill_clock")
+    new.remove.assert_not_called()
+    upgrader.db.insert_skill.assert_called_once_with(
+        skill.copy(update={"topic_access": None, "intents": ["clock"]})
+    )
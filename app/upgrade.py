@@ -0,0 +1,332 @@
+import logging
+import os
+import secrets
+import shutil
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from docker.errors import APIError, NotFound
+from docker.models.containers import Container
+from fastapi import status
+from rhasspy_skills_cli.manifest import Manifest
+
+from .archive import SkillArchive
+from .auth import HMAC_SHA256
+from .dependencies import credential_cache, get_secret_hasher, ph
+from .installer import SkillInstaller, run_skill_container
+from .intents import skill_intents
+from .jobs import Job
+from .metrics import DOCKER_SECONDS
+from .models import JobStage, SkillModel
+from .routers.exceptions import SkillInstallException
+
+logger = logging.getLogger(__name__)
+
+
+class SkillUpgrader(SkillInstaller):
+    """upgrades an installed skill while its container keeps running.
+
+    The new image is built, or pulled, as skill_<slug>_next and a container with the same name
+    is started next to the running one, with the same data directory and mqtt credentials. Once
+    it is healthy the new container and image take the place of the old ones, otherwise
+    everything new is removed and the running container is left untouched.
+    """
+
+    def submit_upgrade(self, tar: SkillArchive, manifest: Manifest, skill: SkillModel) -> Job:
+        return self.jobs.submit(
+            "upgrade", lambda job: self.upgrade(job, tar, manifest, skill)
+        )
+
+    async def upgrade(
+        self, job: Job, tar: SkillArchive, manifest: Manifest, skill: SkillModel
+    ) -> Dict[str, Any]:
+        slug = manifest.slug
+        tag = "skill_" + slug
+        next_tag = tag + "_next"
+        skill_path = os.path.join(self.skill_dir, slug)
+        next_path = skill_path + ".next"
+        reissued = False
+        try:
+            job.set_stage(JobStage.EXTRACT)
+            await self.jobs.run_blocking(self._extract_next, tar, next_path)
+            # left by an upgrade that was interrupted
+            await self.jobs.run_blocking(self._remove_conflicting, next_tag, True)
+            if manifest.image:
+                job.set_stage(JobStage.PULL)
+                image = await self.jobs.run_blocking(self._pull, job, manifest.image, next_tag)
+            else:
+                job.set_stage(JobStage.BUILD)
+                image = await self.jobs.run_blocking(self._build, job, next_path, next_tag)
+            job.set_stage(JobStage.RUN)
+            password, credentials, reissued = await self.jobs.run_blocking(
+                self._credentials, job, skill
+            )
+            container = await self.jobs.run_blocking(
+                self._run_next, manifest, skill, next_tag, skill_path, password
+            )
+            job.set_stage(JobStage.HEALTH)
+            await self.jobs.run_blocking(self._wait_healthy, job, container)
+            job.set_stage(JobStage.SWAP)
+            swap_seconds = await self.jobs.run_blocking(
+                self._swap, job, tag, container, next_tag
+            )
+        except Exception as e:
+            error = e
+            if not isinstance(error, SkillInstallException):
+                logger.exception("upgrade of %s failed", slug)
+                error = SkillInstallException(
+                    status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail=f"upgrade failed: {e}",
+                    error_code="upgrade_failed",
+                )
+            logger.warning(
+                "upgrade failed skill=%s error=%s, rolling back", slug, error.error_code
+            )
+            job.log(f"rolling back: {error.detail}")
+            await self.jobs.run_blocking(self._rollback, skill, next_tag, next_path, reissued)
+            if error is e:
+                raise
+            raise error from e
+        finally:
+            tar.close()
+            if os.path.isfile(tar.path):
+                os.remove(tar.path)
+        try:
+            await self.jobs.run_blocking(
+                self._commit, skill, credentials, manifest, skill_path, next_path
+            )
+        except Exception as e:
+            # the old container is gone, the new one can't be rolled back anymore
+            logger.exception("upgrade of %s not completed after the swap", slug)
+            raise SkillInstallException(
+                status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"the new container runs but the upgrade was not completed: {e}",
+                error_code="upgrade_incomplete",
+            ) from e
+        result = {
+            "state": "success",
+            "detail": f"upgraded {manifest.name} to {manifest.version}",
+            "pull" if manifest.image else "build": image,
+            "swap_seconds": swap_seconds,
+            "credentials_reissued": reissued,
+        }
+        if manifest.auto_train:
+            job.set_stage(JobStage.TRAIN)
+            run = await self._train(job, manifest, "upgrade")
+            result["training"] = run.dict(include={"id", "operations", "skipped"})
+        return result
+
+    def _extract_next(self, tar: SkillArchive, next_path: str):
+        if os.path.isdir(next_path):
+            shutil.rmtree(next_path)
+        os.mkdir(next_path)
+        try:
+            tar.extract(next_path)
+        finally:
+            tar.close()
+            os.remove(tar.path)
+
+    def _get_container(self, name: str) -> Optional[Container]:
+        try:
+            with DOCKER_SECONDS.time(operation="get_container"):
+                return self.docker.containers.get(name)
+        except NotFound:
+            return None
+
+    def _credentials(
+        self, job: Job, skill: SkillModel
+    ) -> Tuple[str, Dict[str, str], bool]:
+        """the password of the running container, a new one only if it is not valid anymore
+
+        Returns:
+            Tuple[str, Dict[str, str], bool]: the password, its hashed_password and
+                password_scheme and whether it was issued again
+        """
+        current = self._get_container("skill_" + skill.skill_name)
+        config = (current.attrs.get("Config") or {}) if current is not None else {}
+        hasher = get_secret_hasher(self.settings)
+        for variable in config.get("Env") or []:
+            name, _, value = variable.partition("=")
+            if name == "MQTT_PASS":
+                try:
+                    if skill.password_scheme == HMAC_SHA256:
+                        valid = hasher.verify(skill.hashed_password, value)
+                    else:
+                        valid = ph.verify(skill.hashed_password, value)
+                except Exception:
+                    valid = False
+                if valid:
+                    return value, {
+                        "hashed_password": skill.hashed_password,
+                        "password_scheme": skill.password_scheme,
+                    }, False
+                break
+        job.log("the credentials of the running container are not valid, issuing new ones")
+        password = secrets.token_hex(32)
+        credentials = {
+            "hashed_password": hasher.hash(password),
+            "password_scheme": HMAC_SHA256,
+        }
+        # the old container loses its access, the rollback restores it
+        self.db.insert_skill(skill.copy(update=credentials))
+        credential_cache.invalidate(skill.skill_name)
+        return password, credentials, True
+
+    def _run_next(
+        self,
+        manifest: Manifest,
+        skill: SkillModel,
+        next_tag: str,
+        skill_path: str,
+        password: str,
+    ) -> Container:
+        try:
+            with DOCKER_SECONDS.time(operation="run_container"):
+                run_skill_container(
+                    self.docker,
+                    self.db,
+                    manifest.slug,
+                    next_tag,
+                    os.path.join(skill_path, "data"),
+                    manifest.topic_access,
+                    skill.start_on_boot,
+                    manifest.internet_access,
+                    name=next_tag,
+                    password=password,
+                )
+                return self.docker.containers.get(next_tag)
+        except Exception as e:
+            raise SkillInstallException(
+                status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=str(e),
+                error_code="container_creation",
+            )
+
+    def _wait_healthy(self, job: Job, container: Container):
+        """wait for the healthcheck of the image or, without one, until the container stays up"""
+        start = time.monotonic()
+        while True:
+            container.reload()
+            state = container.attrs.get("State") or {}
+            health = (state.get("Health") or {}).get("Status")
+            elapsed = time.monotonic() - start
+            problem = None
+            if state.get("Status") in ("exited", "dead"):
+                problem = f"exited with code {state.get('ExitCode')}"
+            elif health == "unhealthy":
+                problem = "is unhealthy"
+            elif health == "healthy" or (
+                health is None
+                and state.get("Status") == "running"
+                and elapsed >= self.settings.upgrade_health_window
+            ):
+                job.log(f"new container healthy after {elapsed:.1f}s")
+                return
+            elif elapsed >= self.settings.upgrade_timeout:
+                problem = f"is not healthy after {elapsed:.0f}s"
+            if problem:
+                logs = container.logs(tail=20).decode(errors="replace")
+                raise SkillInstallException(
+                    status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail=f"the new container {problem}. Logs:\n{logs}",
+                    error_code="unhealthy_upgrade",
+                )
+            time.sleep(0.5)
+
+    def _swap(self, job: Job, tag: str, container: Container, next_tag: str) -> float:
+        """give to the new container and image the name of the old ones, then remove these"""
+        start = time.perf_counter()
+        old = self._get_container(tag)
+        try:
+            with DOCKER_SECONDS.time(operation="rename_container"):
+                if old is not None:
+                    old.rename(tag + "_old")
+                container.rename(tag)
+        except APIError as e:
+            if old is not None:
+                old.rename(tag)
+            raise SkillInstallException(
+                status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"unable to swap the containers: {e}",
+                error_code="upgrade_swap",
+            )
+        swap_seconds = time.perf_counter() - start
+        job.log(f"swapped the containers in {swap_seconds:.2f}s")
+        if old is not None:
+            try:
+                with DOCKER_SECONDS.time(operation="remove_container"):
+                    old.remove(v=True, force=True)
+            except APIError as e:
+                logger.warning("old container of %s not removed: %s", tag, e)
+        # the new container already runs as the skill, a failed cleanup must not undo the upgrade
+        try:
+            current = self._current_image(tag)
+            new = self._current_image(next_tag)
+            if new is not None:
+                with DOCKER_SECONDS.time(operation="tag_image"):
+                    new.tag(tag)
+                # only the tag is removed, the image is still tagged as the skill
+                self.docker.images.remove(next_tag)
+                self._remove_replaced(current, new.id, tag)
+        except Exception as e:
+            logger.warning("images of %s not cleaned up after the upgrade: %s", tag, e)
+            job.log(f"the previous image was not cleaned up: {e}")
+        return swap_seconds
+
+    def _commit(
+        self,
+        skill: SkillModel,
+        credentials: Dict[str, str],
+        manifest: Manifest,
+        skill_path: str,
+        next_path: str,
+    ):
+        """record the new version and move its files in place of the old ones.
+
+        The store is written first, it then matches the running container even if the files
+        can't be moved.
+        """
+        self.db.insert_skill(
+            skill.copy(
+                update={
+                    **credentials,
+                    "topic_access": manifest.topic_access,
+                    "intents": skill_intents(os.path.join(next_path, "sentences.ini")),
+                }
+            )
+        )
+        credential_cache.invalidate(skill.skill_name)
+        self._replace_files(skill_path, next_path)
+
+    def _replace_files(self, skill_path: str, next_path: str):
+        """replace the skill files with the new ones, the data directory is kept"""
+        for name in os.listdir(skill_path):
+            if name == "data":
+                continue
+            path = os.path.join(skill_path, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        for name in os.listdir(next_path):
+            if name != "data":
+                os.replace(os.path.join(next_path, name), os.path.join(skill_path, name))
+        shutil.rmtree(next_path)
+        data_config_path = os.path.join(skill_path, "data", "config.json")
+        config_path = os.path.join(skill_path, "config.json")
+        if os.path.isfile(config_path) and not os.path.isfile(data_config_path):
+            shutil.copy(config_path, data_config_path)
+
+    def _rollback(self, skill: SkillModel, next_tag: str, next_path: str, reissued: bool):
+        container = self._get_container(next_tag)
+        try:
+            if container is not None:
+                container.remove(v=True, force=True)
+            self.docker.images.remove(next_tag)
+        except APIError as e:
+            logger.warning("upgrade of %s not cleaned up: %s", skill.skill_name, e)
+        if os.path.isdir(next_path):
+            shutil.rmtree(next_path)
+        if reissued:
+            self.db.insert_skill(skill)
+            credential_cache.invalidate(skill.skill_name)
@@ -0,0 +1,126 @@
+"""Load benchmark of the broker ACL endpoints.
+
+Run from the repository root:
+
+    python -m benchmarks.acl_benchmark --skills 10 100 --topics 5 50
+
+For every combination of skills and topics per skill a temporary store is generated, then the
+same random checks are sent one per request to /api/acl and in chunks to /api/acl/batch.
+"""
+import argparse
+import random
+import statistics
+import tempfile
+import time
+from typing import Callable, List, Tuple
+
+from fastapi.testclient import TestClient
+
+from app.database import DB
+from app.dependencies import get_auth_db
+from app.main import app
+from app.models import SkillModel, TopicAccess
+
+
+def build_store(path: str, skills: int, topics: int) -> DB:
+    db = DB(path, use_cache=True)
+    for i in range(skills):
+        db.insert_skill(
+            SkillModel(
+                skill_name=f"skill{i}",
+                hashed_password="",
+                topic_access={
+                    f"skill{i}/topic{j}/+": TopicAccess.READWRITE for j in range(topics)
+                },
+            )
+        )
+    return db
+
+
+def generate_checks(skills: int, topics: int, count: int) -> List[dict]:
+    checks = []
+    for _ in range(count):
+        skill = random.randrange(skills)
+        topic = random.choice(
+            [
+                f"skill{skill}/topic{random.randrange(topics)}/state",
+                f"hermes/intent/Intent{random.randrange(topics)}",
+                f"skill{random.randrange(skills)}/forbidden",
+            ]
+        )
+        checks.append(
+            {
+                "username": f"skill{skill}",
+                "topic": topic,
+                "acc": random.choice([TopicAccess.READ, TopicAccess.WRITE]),
+            }
+        )
+    return checks
+
+
+def measure(requests: int, send: Callable[[int], None]) -> Tuple[float, float, float]:
+    """return requests per second, p50 and p99 latency in milliseconds"""
+    latencies = []
+    start = time.perf_counter()
+    for i in range(requests):
+        request_start = time.perf_counter()
+        send(i)
+        latencies.append((time.perf_counter() - request_start) * 1000)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return requests / elapsed, statistics.median(latencies), p99
+
+
+def run(skills: int, topics: int, checks_count: int, batch_size: int):
+    client = TestClient(app)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = build_store(f"{tmp_dir}/store.json", skills, topics)
+
+        async def override_get_auth_db():
+            return db
+
+        app.dependency_overrides[get_auth_db] = override_get_auth_db
+        checks = generate_checks(skills, topics, checks_count)
+        batches = [
+            checks[i : i + batch_size] for i in range(0, len(checks), batch_size)
+        ]
+        try:
+            single = measure(
+                len(checks), lambda i: client.post("/api/acl", data=checks[i])
+            )
+            batch = measure(
+                len(batches), lambda i: client.post("/api/acl/batch", json=batches[i])
+            )
+        finally:
+            del app.dependency_overrides[get_auth_db]
+    for mode, (rate, p50, p99), per_request in (
+        ("single", single, 1),
+        ("batch", batch, batch_size),
+    ):
+        print(
+            f"{skills:>6} {topics:>6} {mode:>6} {rate:>10.1f} {rate * per_request:>12.1f}"
+            f" {p50:>8.3f} {p99:>8.3f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--skills", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--topics", type=int, nargs="+", default=[5, 50])
+    parser.add_argument("--checks", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    print(
+        f"{'skills':>6} {'topics':>6} {'mode':>6} {'req/s':>10} {'checks/s':>12}"
+        f" {'p50 ms':>8} {'p99 ms':>8}"
+    )
+    for skills in args.skills:
+        for topics in args.topics:
+            run(skills, topics, args.checks, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
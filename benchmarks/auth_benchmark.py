@@ -0,0 +1,108 @@
+"""Micro benchmark of the skill password verification.
+
+Run from the repository root:
+
+    python -m benchmarks.auth_benchmark --logins 200
+
+The same generated password is verified against its argon2 hash and its keyed digest, first
+directly and then with requests to /api/login, where argon2 also pays for the auth executor.
+"""
+import argparse
+import secrets
+import statistics
+import tempfile
+import time
+from typing import Callable, Tuple
+
+from fastapi.testclient import TestClient
+
+from app.auth import HMAC_SHA256, SecretHasher
+from app.config import Settings
+from app.database import DB
+from app.dependencies import credential_cache, get_auth_db, get_auth_settings, ph
+from app.main import app
+from app.models import SkillModel
+
+
+def measure(count: int, verify: Callable[[], object]) -> Tuple[float, float, float]:
+    """return verifications per second, p50 and p99 latency in microseconds"""
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(count):
+        verify_start = time.perf_counter()
+        verify()
+        latencies.append((time.perf_counter() - verify_start) * 1e6)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return count / elapsed, statistics.median(latencies), p99
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=200)
+    args = parser.parse_args()
+    password = secrets.token_hex(32)
+    # shorter than a generated password so the login route keeps it on argon2, the cost of
+    # argon2 doesn't depend on the password length
+    argon2_password = secrets.token_hex(8)
+    client = TestClient(app)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        hasher = SecretHasher(f"{tmp_dir}/credential.key")
+        argon2_hash = ph.hash(password)
+        keyed_hash = hasher.hash(password)
+        db = DB(f"{tmp_dir}/store.json", use_cache=True)
+        db.insert_skill(
+            SkillModel(skill_name="argon2", hashed_password=ph.hash(argon2_password))
+        )
+        db.insert_skill(
+            SkillModel(
+                skill_name="keyed", hashed_password=keyed_hash, password_scheme=HMAC_SHA256
+            )
+        )
+
+        async def override_get_auth_db():
+            return db
+
+        def login(skill_name: str, password: str):
+            # every login pays for the verification, as with a new broker connection
+            credential_cache.invalidate(skill_name)
+            response = client.post(
+                "/api/login", data={"username": skill_name, "password": password}
+            )
+            assert response.status_code == 200
+
+        async def override_get_auth_settings():
+            return Settings(store_directory=tmp_dir)
+
+        app.dependency_overrides[get_auth_db] = override_get_auth_db
+        app.dependency_overrides[get_auth_settings] = override_get_auth_settings
+        try:
+            results = [
+                (
+                    "argon2",
+                    "direct",
+                    measure(args.logins, lambda: ph.verify(argon2_hash, password)),
+                ),
+                (
+                    "keyed",
+                    "direct",
+                    measure(args.logins, lambda: hasher.verify(keyed_hash, password)),
+                ),
+                (
+                    "argon2",
+                    "login",
+                    measure(args.logins, lambda: login("argon2", argon2_password)),
+                ),
+                ("keyed", "login", measure(args.logins, lambda: login("keyed", password))),
+            ]
+        finally:
+            del app.dependency_overrides[get_auth_db]
+            del app.dependency_overrides[get_auth_settings]
+    print(f"{'scheme':>8} {'mode':>8} {'verify/s':>12} {'p50 us':>12} {'p99 us':>12}")
+    for scheme, mode, (rate, p50, p99) in results:
+        print(f"{scheme:>8} {mode:>8} {rate:>12.1f} {p50:>12.1f} {p99:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -19,8 +19,8 @@ fi
 python3 bin/setup_network.py
 python3 bin/generate_config.py
 
-gosu rhasspy-skills uvicorn app.main:app --port 9090 --host 0.0.0.0 & 
+gosu rhasspy-skills uvicorn app.main:app --port 9090 --host 0.0.0.0 --workers "${API_WORKERS:-$(nproc)}" &
 gosu mosquitto:mosquitto mosquitto -c /etc/mosquitto/mosquitto.conf &
-sleep 5
-python3 -m app.start_skills
+gosu rhasspy-skills python3 -m app.hibernate &
+gosu rhasspy-skills python3 -m app.start_skills
 wait
\ No newline at end of file